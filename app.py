@@ -1,7 +1,17 @@
-# Этот файл нужен для совместимости с Amvera
-# Он импортирует FastAPI приложение из webhook_server.py
+# Этот файл нужен для совместимости с Amvera и запуска через uvicorn:
+# uvicorn app:app или uvicorn app:create_app --factory (так запускаются воркеры
+# при WEB_WORKERS > 1). Импорт модуля ничего не создает: приложение роли APP_ROLE
+# (all или web) строит фабрика из main.py при первом обращении
 
-from webhook_server import app
+def create_app():
+    from main import create_worker_app
+    return create_worker_app()
 
-# Amvera будет использовать этот файл для запуска веб-сервера
-# Основной код бота запускается через main.py
+
+# Ленивый атрибут app для uvicorn app:app
+def __getattr__(name):
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
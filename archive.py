@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from database import DB_PATH, ARCHIVE_TABLES, incremental_vacuum
+from metrics import ARCHIVED_ROWS
+from subscribers import subscriber_index
+from tracing import traced
+
+logger = logging.getLogger('archive')
+
+# Каталог сегментов архива: <ARCHIVE_DIR>/<YYYY-MM>/<таблица>-<хэш>.jsonl.gz
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.join('data', 'archive'))
+# Сколько дней записи остаются в рабочей базе. Архивируются только целые месяцы
+ARCHIVE_RETENTION_DAYS = int(os.getenv('ARCHIVE_RETENTION_DAYS', 90))
+# Размер порции записей (одна порция - один сегмент на месяц)
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 5000))
+# Сколько свободных страниц возвращать за одно обслуживание (0 - все)
+VACUUM_PAGES = int(os.getenv('VACUUM_PAGES', 0))
+
+
+# Граница архивации: начало месяца, в который попадает now - retention_days (UTC)
+def archive_cutoff(now=None, retention_days=ARCHIVE_RETENTION_DAYS):
+    moment = datetime.fromtimestamp(now if now is not None else time.time(), timezone.utc)
+    moment -= timedelta(days=retention_days)
+    return int(moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+
+def _month(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m')
+
+
+# Запись сегмента: сначала во временный файл, затем атомарное переименование.
+# Имя зависит от ключей записей, поэтому повтор после сбоя (записи уже в архиве,
+# но еще не удалены из базы) перезаписывает тот же сегмент, а не создает дубликат
+def _write_segment(table, month, keys, rows):
+    first = tuple(rows[0][key] for key in keys)
+    last = tuple(rows[-1][key] for key in keys)
+    digest = hashlib.sha1(repr((first, last)).encode()).hexdigest()[:12]
+    directory = os.path.join(ARCHIVE_DIR, month)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{table}-{digest}.jsonl.gz")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as segment:
+            for row in rows:
+                segment.write(json.dumps(row, ensure_ascii=False).encode() + b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+# Перенос старых завершенных записей одной таблицы в сегменты по месяцам.
+# Сегменты порции записываются внутри транзакции, которая затем удаляет ее записи.
+# Возвращает число удаленных из базы записей
+def archive_table(table, before, batch_size=ARCHIVE_BATCH_SIZE, now=None):
+    _, keys, time_column, _ = next(spec for spec in ARCHIVE_TABLES if spec[0] == table)
+    # Подписчики без своей даты попадают в месяц архивации
+    default_month = _month(now if now is not None else time.time())
+
+    def store(rows):
+        by_month = {}
+        for row in rows:
+            month = _month(row[time_column]) if time_column else default_month
+            by_month.setdefault(month, []).append(row)
+        for month, month_rows in by_month.items():
+            _write_segment(table, month, keys, month_rows)
+
+    archived = 0
+    while True:
+        deleted = subscriber_index.archive_batch(table, before, batch_size, store)
+        archived += len(deleted)
+        ARCHIVED_ROWS.inc(len(deleted), table=table)
+        if len(deleted) < batch_size:
+            break
+    return archived
+
+
+# Архивация всех таблиц. Возвращает {таблица: число записей}
+def archive_old_records(now=None, retention_days=ARCHIVE_RETENTION_DAYS):
+    before = archive_cutoff(now, retention_days)
+    archived = {}
+    for table, *_ in ARCHIVE_TABLES:
+        count = archive_table(table, before, now=now)
+        if count:
+            archived[table] = count
+    return archived
+
+
+# Ежедневное обслуживание базы: архивация старых записей и возврат освободившегося
+# места файловой системе (incremental_vacuum), чтобы база на томе data не росла
+@traced('maintenance')
+def run_maintenance():
+    size_before = _db_size()
+    try:
+        archived = archive_old_records()
+        if archived:
+            logger.info("Archived old records to %s: %s", ARCHIVE_DIR, archived)
+        freed = incremental_vacuum(VACUUM_PAGES or None)
+        logger.info(
+            "Database maintenance finished: %s pages freed, size %.1f MB -> %.1f MB",
+            freed, size_before / 2 ** 20, _db_size() / 2 ** 20
+        )
+    except Exception as e:
+        logger.error("Error during database maintenance: %s", e, exc_info=True)
+
+
+def _db_size():
+    return sum(
+        os.path.getsize(path) for path in (DB_PATH, DB_PATH + '-wal')
+        if os.path.exists(path)
+    )
@@ -0,0 +1,183 @@
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# Клиент, оборвавший соединение (например, остановленный процесс бота во время
+# long polling), - не ошибка заглушки, поэтому трассировка не печатается.
+# Очередь соединений больше стандартных 5: иначе при параллельных клиентах стенда
+# переполняется backlog и повторы SYN добавляют секундные хвосты задержек
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+# Общая часть локальных заглушек: HTTP-сервер в отдельном потоке с заданной задержкой
+# ответа и счетчиками запросов. Слушает только 127.0.0.1, сеть не нужна
+class _FakeServer:
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.counts = {}
+        self.inflight = 0
+        self.last_request = 0.0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server._handle(self)
+
+            def do_POST(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = _HTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    # Нет запросов в обработке и не было новых последние idle секунд
+    def is_idle(self, idle=0.2):
+        with self._lock:
+            return self.inflight == 0 and time.monotonic() - self.last_request >= idle
+
+    def _handle(self, request):
+        with self._lock:
+            self.inflight += 1
+            self.last_request = time.monotonic()
+        try:
+            length = int(request.headers.get('Content-Length') or 0)
+            body = request.rfile.read(length) if length else b''
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay:
+                time.sleep(delay)
+            status, payload = self.respond(request.command, urlparse(request.path), body)
+            data = json.dumps(payload).encode()
+            request.send_response(status)
+            request.send_header('Content-Type', 'application/json')
+            request.send_header('Content-Length', str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+                self.last_request = time.monotonic()
+
+    def respond(self, method, url, body):
+        raise NotImplementedError
+
+
+# Заглушка Lava API: POST /api/v2/invoice возвращает новый инвойс,
+# GET /api/v1/invoices/<id> - его статус (меняется через set_status).
+# С вероятностью error_rate отвечает 503 (проверка повторов клиента)
+class FakeLava(_FakeServer):
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0):
+        super().__init__(latency, jitter)
+        self.error_rate = error_rate
+        self.invoices = {}
+
+    def set_status(self, payment_id, status):
+        with self._lock:
+            self.invoices[payment_id] = status
+
+    def respond(self, method, url, body):
+        if random.random() < self.error_rate:
+            self.count('error')
+            return 503, {'error': 'Service unavailable'}
+        if method == 'POST' and url.path == '/api/v2/invoice':
+            self.count('invoice')
+            payment_id = str(uuid.uuid4())
+            self.set_status(payment_id, 'new')
+            return 201, {'id': payment_id, 'paymentUrl': f"https://pay.lava.top/invoice/{payment_id}"}
+        if method == 'GET' and url.path.startswith('/api/v1/invoices/'):
+            payment_id = url.path.rsplit('/', 1)[1]
+            status = self.invoices.get(payment_id)
+            if status is not None:
+                self.count('invoice_status')
+                return 200, {'id': payment_id, 'status': status}
+        self.count('not_found')
+        return 404, {'error': 'Not found'}
+
+
+# Заглушка Telegram Bot API: /bot<token>/<method> с ответами нужной формы.
+# С вероятностью rate_limit_rate отвечает 429 с retry_after, как настоящий Telegram
+class FakeTelegram(_FakeServer):
+    def __init__(self, latency=0.05, jitter=0.0, rate_limit_rate=0.0, retry_after=1):
+        super().__init__(latency, jitter)
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._message_id = 0
+
+    def respond(self, method, url, body):
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            self.count('not_found')
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        api_method = parts[1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if random.random() < self.rate_limit_rate:
+            self.count('429')
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }
+        self.count(api_method)
+        return 200, {'ok': True, 'result': self._result(api_method, params)}
+
+    def _result(self, api_method, params):
+        if api_method == 'sendMessage':
+            with self._lock:
+                self._message_id += 1
+                message_id = self._message_id
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        if api_method in ('createChatInviteLink', 'revokeChatInviteLink'):
+            return {
+                'invite_link': params.get('invite_link') or f"https://t.me/+{uuid.uuid4().hex[:16]}",
+                'creator': {'id': 1, 'is_bot': True, 'first_name': 'bench'},
+                'creates_join_request': False,
+                'is_primary': False,
+                'is_revoked': api_method == 'revokeChatInviteLink',
+                'member_limit': int(params.get('member_limit', 1)),
+            }
+        if api_method == 'getUpdates':
+            return []
+        if api_method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        return True
@@ -0,0 +1,443 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+# Нагрузочный стенд: поднимает webhook_server.app и обработчики main.py против
+# локальных заглушек Lava и Telegram (bench/fakes.py) и прогоняет сценарии:
+# нажатия кнопки оплаты, пачку вебхуков PAID/CANCELED с повторами и массовое истечение.
+# Запуск из корня репозитория: python -m bench.run --users 500
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from bench.fakes import FakeLava, FakeTelegram
+
+TOKEN = '123456:BENCH'
+CHANNEL_ID = '-1001'
+WEBHOOK_AUTH = ('bench', 'bench')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(name, latencies, elapsed, errors=0):
+    count = len(latencies)
+    return {
+        'scenario': name,
+        'requests': count,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(count / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0) * 1000, 2),
+    }
+
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? (\S+)$')
+
+
+# Разбор текстового формата Prometheus, как это делает сборщик метрик
+def scrape(text):
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE_RE.match(line)
+        if match:
+            samples[(match.group(1), match.group(2) or '')] = float(match.group(3))
+    return samples
+
+
+# Конкуренция за базу между двумя снимками метрик: ожидание блокировки записи
+# (BEGIN IMMEDIATE) и число/время операций репозитория
+def db_contention(before, after):
+    def delta(name, labels=''):
+        return after.get((name, labels), 0) - before.get((name, labels), 0)
+
+    waits = delta('db_lock_wait_seconds_count')
+    wait_total = delta('db_lock_wait_seconds_sum')
+    slow = waits - delta('db_lock_wait_seconds_bucket', '{le="0.01"}')
+    operations = {}
+    for name, labels in after:
+        if name == 'db_operation_duration_seconds_count':
+            count = delta(name, labels)
+            if count:
+                operation = labels.split('"')[1]
+                total = delta('db_operation_duration_seconds_sum', labels)
+                operations[operation] = {'count': int(count), 'avg_ms': round(total / count * 1000, 2)}
+    return {
+        'write_transactions': int(waits),
+        'lock_wait_total_s': round(wait_total, 3),
+        'lock_wait_avg_ms': round(wait_total / waits * 1000, 3) if waits else 0.0,
+        'lock_waits_over_10ms': int(slow),
+        'operations': operations,
+    }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.lava = FakeLava(args.lava_latency, args.lava_jitter, args.lava_error_rate).start()
+        self.telegram = FakeTelegram(args.tg_latency, args.tg_jitter, args.tg_429_rate, args.tg_retry_after).start()
+        self.workdir = tempfile.mkdtemp(prefix='buryatfilms-bench-')
+
+        # Настройки читаются модулями при импорте, поэтому задаются до него.
+        # База и логи создаются во временной директории
+        os.chdir(self.workdir)
+        os.environ.update({
+            'TELEGRAM_BOT_TOKEN': TOKEN,
+            'PRIVATE_CHANNEL_ID': CHANNEL_ID,
+            'LAVA_API_KEY': 'bench',
+            'LAVA_OFFER_ID': 'bench-offer',
+            'LAVA_API_URL': self.lava.url,
+            'LAVA_BACKOFF_BASE': '0.05',
+            # Пул соединений по числу параллельных клиентов: иначе лишние соединения
+            # закрываются ("Connection pool is full") и замеряется их пересоздание
+            'LAVA_POOL_SIZE': str(args.concurrency),
+            'WEBHOOK_USERNAME': WEBHOOK_AUTH[0],
+            'WEBHOOK_PASSWORD': WEBHOOK_AUTH[1],
+            'TELEGRAM_GLOBAL_RATE': str(args.tg_rate),
+            'TELEGRAM_WORKERS': str(args.tg_workers),
+            'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+            'LOG_DIR': os.path.join(self.workdir, 'logs'),
+            'NO_PROXY': '127.0.0.1,localhost',
+        })
+        os.environ.pop('PUBLIC_URL', None)
+        os.environ.pop('ADMIN_TELEGRAM_ID', None)
+
+        import telebot
+        telebot.apihelper.API_URL = self.telegram.url + '/bot{0}/{1}'
+
+        import main
+        main.init_process()
+        import webhook_server
+        from database import init_db
+        from metrics import REGISTRY
+        self.main = main
+        self.registry = REGISTRY
+
+        init_db()
+        main.dispatcher.start()
+        webhook_server.set_bot_instance(main.bot, CHANNEL_ID)
+        from notifications import init_notifications
+        from outbox import init_outbox_worker
+        init_notifications(main.bot, CHANNEL_ID)
+        self.outbox_worker = init_outbox_worker()
+        self.outbox_worker.start()
+        self.invite_pool = None
+        if args.invite_pool:
+            from invite_links import init_invite_pool
+            self.invite_pool = init_invite_pool(main.bot, CHANNEL_ID, size=args.invite_pool)
+            self.invite_pool.replenish()
+            self.invite_pool.start()
+        self._start_server(webhook_server.app)
+
+    def _start_server(self, app):
+        import uvicorn
+        port = _free_port()
+        self.server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+        self.server_thread = threading.Thread(target=self.server.run, name='bench-uvicorn', daemon=True)
+        self.server_thread.start()
+        self.base_url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + 10
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("uvicorn did not start")
+            time.sleep(0.05)
+
+    def close(self):
+        self.server.should_exit = True
+        self.server_thread.join(5)
+        self.outbox_worker.stop(timeout=5)
+        if self.invite_pool:
+            self.invite_pool.stop(timeout=5)
+        self.main.dispatcher.stop(timeout=5)
+        self.lava.stop()
+        self.telegram.stop()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def snapshot(self):
+        return scrape(self.registry.render())
+
+    # Ожидание, пока outbox и очередь исходящих вызовов Telegram не опустеют
+    def drain(self, timeout=300):
+        from database import count_outbox_by_status
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if (self.main.dispatcher.qsize() == 0 and self.telegram.is_idle()
+                    and not count_outbox_by_status().get('pending')):
+                break
+            time.sleep(0.05)
+        return time.perf_counter() - start
+
+    def run_scenario(self, name, func):
+        before = self.snapshot()
+        telegram_before = dict(self.telegram.counts)
+        result = func()
+        result['telegram_drain_s'] = round(self.drain(), 3)
+        after = self.snapshot()
+        result['db'] = db_contention(before, after)
+        invites = {
+            labels.split('"')[1]: int(value - before.get((name, labels), 0))
+            for (name, labels), value in after.items()
+            if name == 'invite_links_issued_total' and value != before.get((name, labels), 0)
+        }
+        if invites:
+            result['invite_links'] = invites
+        result['telegram_calls'] = {
+            method: count - telegram_before.get(method, 0)
+            for method, count in self.telegram.counts.items()
+            if count != telegram_before.get(method, 0)
+        }
+        return result
+
+    # N пользователей нажимают «Оплатить доступ» по taps раз: первый раз создается
+    # инвойс в Lava, повторные нажатия должны обслуживаться из кэша
+    def pay_taps(self):
+        users = range(1_000_000, 1_000_000 + self.args.users)
+        taps = [user_id for _ in range(self.args.taps) for user_id in users]
+        lava_before = self.lava.counts.get('invoice', 0)
+
+        def tap(user_id):
+            message = SimpleNamespace(
+                from_user=SimpleNamespace(id=user_id, username=f"user{user_id}"),
+                chat=SimpleNamespace(id=user_id, type='private'),
+                text="✅ Оплатить доступ",
+            )
+            start = time.perf_counter()
+            self.main.process_payment(message)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.args.concurrency) as pool:
+            latencies = list(pool.map(tap, taps))
+        result = summarize('pay_taps', latencies, time.perf_counter() - start)
+        result['lava_invoices_created'] = self.lava.counts.get('invoice', 0) - lava_before
+        return result
+
+    # Пачка вебхуков Lava: PAID и CANCELED по созданным инвойсам, часть событий
+    # доставляется повторно (dup_rate), как это делает Lava при таймаутах
+    def callbacks(self):
+        # httpx нужен только стенду (pip install httpx), приложение его не использует
+        import httpx
+        from database import get_pool
+
+        with get_pool().connection() as conn:
+            payment_ids = [row[0] for row in conn.execute(
+                "SELECT payment_id FROM invoices WHERE status = 'pending' LIMIT ?", (self.args.callbacks,)
+            )]
+        events = []
+        for i, payment_id in enumerate(payment_ids):
+            events.append({'id': payment_id, 'status': 'CANCELED' if i % 4 == 3 else 'PAID'})
+        duplicates = int(len(events) * self.args.dup_rate)
+        events += events[:duplicates]
+
+        async def burst():
+            latencies, errors = [], 0
+            semaphore = asyncio.Semaphore(self.args.concurrency)
+            limits = httpx.Limits(max_connections=self.args.concurrency)
+            async with httpx.AsyncClient(base_url=self.base_url, auth=WEBHOOK_AUTH, limits=limits,
+                                         trust_env=False, timeout=30) as client:
+                async def send(event):
+                    nonlocal errors
+                    async with semaphore:
+                        start = time.perf_counter()
+                        response = await client.post('/webhook/lava', json=event)
+                        latencies.append(time.perf_counter() - start)
+                        if response.status_code != 200 or response.json().get('status') != 'success':
+                            errors += 1
+
+                start = time.perf_counter()
+                await asyncio.gather(*(send(event) for event in events))
+                return latencies, errors, time.perf_counter() - start
+
+        latencies, errors, elapsed = asyncio.run(burst())
+        result = summarize('callbacks', latencies, elapsed, errors)
+        result['duplicates_sent'] = duplicates
+        return result
+
+    # Массовое истечение: в базу добавляется expired активных подписок с прошедшей
+    # датой, затем выполняется полная проверка check_expired_subscriptions
+    def expiry_sweep(self):
+        from database import get_pool
+
+        past = int(time.time()) - 60
+        rows = [(str(2_000_000 + i), 'active', past) for i in range(self.args.expired)]
+        with get_pool().transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO subscribers (telegram_id, status, expiry_date) VALUES (?, ?, ?)", rows
+            )
+        # Подписки добавлены в обход индекса подписчиков - перечитываем его
+        from subscribers import subscriber_index
+        subscriber_index.load()
+
+        start = time.perf_counter()
+        self.main.check_expired_subscriptions()
+        elapsed = time.perf_counter() - start
+        with get_pool().connection() as conn:
+            by_status = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM subscribers WHERE CAST(telegram_id AS INTEGER) >= 2000000 GROUP BY status"
+            ).fetchall())
+        return {
+            'scenario': 'expiry_sweep',
+            'subscriptions': len(rows),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round(len(rows) / elapsed, 1) if elapsed else 0.0,
+            'statuses_after': by_status,
+        }
+
+    # Потерянные вебхуки: для lost_callbacks новых пользователей создаются инвойсы,
+    # в заглушке Lava они помечаются оплаченными без вызова вебхука, затем выполняется
+    # сверка InvoiceReconciler. Инвойсы создаются здесь, а не берутся из pay_taps:
+    # те к этому моменту уже закрыты сценарием callbacks
+    def reconcile(self):
+        from database import get_pool
+        from invoices import invoice_cache
+        from reconcile import InvoiceReconciler
+
+        users = range(4_000_000, 4_000_000 + self.args.lost_callbacks)
+        with ThreadPoolExecutor(self.args.concurrency) as pool:
+            invoices = list(pool.map(lambda user_id: invoice_cache.get_or_create(user_id, self.main.create_lava_invoice), users))
+        lost = [invoice['id'] for invoice in invoices if invoice]
+        for payment_id in lost:
+            self.lava.set_status(payment_id, 'completed')
+        with get_pool().connection() as conn:
+            pending = conn.execute("SELECT COUNT(*) FROM invoices WHERE status = 'pending'").fetchone()[0]
+
+        reconciler = InvoiceReconciler(self.main.lava_client, concurrency=self.args.concurrency,
+                                       rate=self.args.reconcile_rate, min_age=0)
+        start = time.perf_counter()
+        checked, applied = reconciler.run()
+        elapsed = time.perf_counter() - start
+        # Проверяются все неоплаченные инвойсы, применяются ровно потерянные
+        if len(lost) != self.args.lost_callbacks or applied != len(lost) or checked != pending:
+            raise AssertionError(
+                f"reconcile: {len(lost)} lost of {self.args.lost_callbacks}, "
+                f"checked {checked} of {pending} pending, applied {applied}"
+            )
+        return {
+            'scenario': 'reconcile',
+            'checked': checked,
+            'lost_callbacks': len(lost),
+            'applied': applied,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round(checked / elapsed, 1) if elapsed else 0.0,
+        }
+
+    # Рассылка: в базу добавляется recipients активных подписчиков, затем рассылка
+    # выполняется BroadcastEngine до конца через очередь Telegram
+    def broadcast(self):
+        from broadcast import BroadcastEngine
+        from database import get_pool, create_broadcast, get_running_broadcast
+
+        future = int(time.time()) + 30 * 24 * 3600
+        rows = [(str(3_000_000 + i), 'active', future) for i in range(self.args.recipients)]
+        with get_pool().transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO subscribers (telegram_id, status, expiry_date) VALUES (?, ?, ?)", rows
+            )
+
+        broadcast_id = create_broadcast("Новый фильм на канале BuryatFilms!")
+        start = time.perf_counter()
+        BroadcastEngine().run_broadcast(*get_running_broadcast())
+        elapsed = time.perf_counter() - start
+        with get_pool().connection() as conn:
+            sent, failed = conn.execute(
+                "SELECT sent, failed FROM broadcasts WHERE id = ?", (broadcast_id,)
+            ).fetchone()
+        return {
+            'scenario': 'broadcast',
+            'sent': sent,
+            'failed': failed,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round((sent + failed) / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+SCENARIOS = ('pay_taps', 'callbacks', 'expiry_sweep', 'reconcile', 'broadcast')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test against local Lava and Telegram stand-ins")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="comma-separated subset of: " + ', '.join(SCENARIOS))
+    parser.add_argument('--users', type=int, default=200, help="users tapping the pay button")
+    parser.add_argument('--taps', type=int, default=3, help="pay taps per user")
+    parser.add_argument('--callbacks', type=int, default=200, help="Lava webhook events in the burst")
+    parser.add_argument('--dup-rate', type=float, default=0.2, help="share of webhook events delivered twice")
+    parser.add_argument('--expired', type=int, default=500, help="subscriptions expiring in the sweep")
+    parser.add_argument('--lost-callbacks', type=int, default=50, help="paid invoices whose webhook never arrives")
+    parser.add_argument('--reconcile-rate', type=float, default=100, help="reconciler Lava requests per second")
+    parser.add_argument('--recipients', type=int, default=2000, help="active subscribers receiving the broadcast")
+    parser.add_argument('--concurrency', type=int, default=32, help="concurrent clients")
+    parser.add_argument('--lava-latency', type=float, default=0.05)
+    parser.add_argument('--lava-jitter', type=float, default=0.02)
+    parser.add_argument('--lava-error-rate', type=float, default=0.0, help="share of Lava 503 responses")
+    parser.add_argument('--tg-latency', type=float, default=0.03)
+    parser.add_argument('--tg-jitter', type=float, default=0.01)
+    parser.add_argument('--tg-429-rate', type=float, default=0.0, help="share of Telegram 429 responses")
+    parser.add_argument('--tg-retry-after', type=int, default=1)
+    parser.add_argument('--tg-rate', type=float, default=200, help="dispatcher global rate (TELEGRAM_GLOBAL_RATE)")
+    parser.add_argument('--tg-workers', type=int, default=8, help="dispatcher workers (TELEGRAM_WORKERS)")
+    parser.add_argument('--invite-pool', type=int, default=20, help="pre-generated invite links (0 disables the pool)")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+def _print_result(result):
+    print(f"== {result['scenario']}")
+    for key, value in result.items():
+        if key == 'scenario':
+            continue
+        if isinstance(value, dict):
+            value = json.dumps(value, ensure_ascii=False)
+        print(f"  {key:24} {value}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    bench = Bench(args)
+    results = []
+    try:
+        for name in scenarios:
+            result = bench.run_scenario(name, getattr(bench, name))
+            results.append(result)
+            if not args.json:
+                _print_result(result)
+    finally:
+        bench.close()
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+# Стенд запуска: стартует `python main.py --role <роль>` против локальных заглушек
+# Lava и Telegram (bench/fakes.py) и измеряет время до готовности, время до начала
+# работы ведущего, память процесса (VmRSS, пик VmHWM) и число потоков, а также время
+# остановки по SIGTERM (от него зависит, как быстро после редеплоя начнет работу новый процесс).
+# Запуск из корня репозитория: python -m bench.startup --roles all,web,bot,scheduler --runs 3
+# Пороги --max-startup-s и --max-rss-mb превращают стенд в проверку на регрессии
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from bench.fakes import FakeLava, FakeTelegram
+from bench.run import TOKEN, CHANNEL_ID, WEBHOOK_AUTH, _free_port
+
+ROLES = ('all', 'web', 'bot', 'scheduler')
+WEB_ROLES = ('all', 'web')
+# Аренды ведущего, которые разыгрывает процесс каждой роли (см. main.ROLE_DUTIES)
+ROLE_LEASES = {'all': ('bot', 'scheduler'), 'web': (), 'bot': ('bot',), 'scheduler': ('scheduler',)}
+
+
+# Поля /proc/<pid>/status в килобайтах (VmRSS, VmHWM) и число потоков
+def proc_status(pid):
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM', 'Threads'):
+                values[key] = int(value.split()[0])
+    return values
+
+
+# Вывод процесса читается в отдельном потоке; строки с отметкой времени
+class _Output:
+    def __init__(self, stream, started):
+        self.lines = []
+        self._started = started
+        self._cond = threading.Condition()
+        threading.Thread(target=self._read, args=(stream,), daemon=True).start()
+
+    def _read(self, stream):
+        for line in stream:
+            with self._cond:
+                self.lines.append((time.perf_counter() - self._started, line.rstrip()))
+                self._cond.notify_all()
+
+    # Время появления строк со всеми подстроками needles или None по таймауту
+    def wait_for(self, needles, timeout):
+        deadline = time.monotonic() + timeout
+        found = {}
+        with self._cond:
+            while True:
+                for elapsed, line in self.lines:
+                    for needle in needles:
+                        if needle not in found and needle in line:
+                            found[needle] = elapsed
+                if len(found) == len(needles):
+                    return max(found.values(), default=0.0)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+
+def _wait_http(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            time.sleep(0.02)
+    return False
+
+
+def run_role(role, args, lava, telegram):
+    workdir = tempfile.mkdtemp(prefix=f'buryatfilms-startup-{role}-')
+    port = _free_port()
+    env = dict(os.environ)
+    env.update({
+        'APP_ROLE': role,
+        'TELEGRAM_BOT_TOKEN': TOKEN,
+        'PRIVATE_CHANNEL_ID': CHANNEL_ID,
+        'LAVA_API_KEY': 'bench',
+        'LAVA_OFFER_ID': 'bench-offer',
+        'LAVA_API_URL': lava.url,
+        'TELEGRAM_API_URL': telegram.url,
+        'WEBHOOK_USERNAME': WEBHOOK_AUTH[0],
+        'WEBHOOK_PASSWORD': WEBHOOK_AUTH[1],
+        'PORT': str(port),
+        'WEB_WORKERS': '1',
+        'LOG_LEVEL': 'INFO',
+        'LOG_DIR': os.path.join(workdir, 'logs'),
+        'TRACE_EXPORT': 'off',
+        'PYTHONUNBUFFERED': '1',
+        'NO_PROXY': '127.0.0.1,localhost',
+    })
+    for name in ('PUBLIC_URL', 'AMVERA_APP_HOST', 'ADMIN_TELEGRAM_ID'):
+        env.pop(name, None)
+
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, 'main.py'), '--role', role],
+        cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    output = _Output(process.stdout, started)
+    result = {'role': role}
+    try:
+        # Готовность: веб-роли отвечают на /, остальные пишут "Role <роль> started"
+        if role in WEB_ROLES:
+            ready = _wait_http(f"http://127.0.0.1:{port}/", process, args.timeout)
+            ready_s = time.perf_counter() - started if ready else None
+        else:
+            ready_s = output.wait_for([f"Role {role} started"], args.timeout)
+        if ready_s is None:
+            raise RuntimeError(f"role {role} did not start:\n" + "\n".join(line for _, line in output.lines[-20:]))
+        result['ready_s'] = round(ready_s, 3)
+        # Начало работы ведущего: все аренды роли получены (при редеплое старый процесс
+        # освобождает их при остановке, иначе новый ждет истечения LEADER_LEASE_TTL)
+        leases = ROLE_LEASES[role]
+        leader_s = output.wait_for([f"became leader for {name}" for name in leases], args.timeout) if leases else None
+        result['leader_s'] = round(leader_s, 3) if leader_s is not None else None
+
+        # Память после того, как фоновые потоки роли запустились и отработали первый цикл
+        time.sleep(args.settle)
+        status = proc_status(process.pid)
+        result['rss_mb'] = round(status['VmRSS'] / 1024, 1)
+        result['peak_rss_mb'] = round(status['VmHWM'] / 1024, 1)
+        result['threads'] = status['Threads']
+        result['budget_pct'] = round(100 * status['VmHWM'] / 1024 / args.budget_mb, 1)
+
+        # uvicorn после корректной остановки повторно поднимает SIGTERM, поэтому
+        # веб-роли завершаются с кодом -15; освобождение аренд видно по логу
+        stop_started = time.perf_counter()
+        process.send_signal(signal.SIGTERM)
+        process.wait(args.timeout)
+        result['shutdown_s'] = round(time.perf_counter() - stop_started, 3)
+        result['exit_code'] = process.returncode
+        result['leases_released'] = output.wait_for(
+            [f"no longer leader for {name}" for name in leases], 1.0
+        ) is not None if leases else None
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def summarize(role, runs):
+    summary = {'role': role, 'runs': len(runs)}
+    for key in ('ready_s', 'leader_s', 'rss_mb', 'peak_rss_mb', 'threads', 'budget_pct', 'shutdown_s'):
+        values = [run[key] for run in runs if run.get(key) is not None]
+        summary[key] = round(statistics.median(values), 3) if values else None
+    summary['exit_codes'] = sorted({run['exit_code'] for run in runs})
+    summary['leases_released'] = all(run['leases_released'] for run in runs) if ROLE_LEASES[role] else None
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Startup time and memory of each process role")
+    parser.add_argument('--roles', default=','.join(ROLES), help="comma-separated subset of: " + ', '.join(ROLES))
+    parser.add_argument('--runs', type=int, default=3, help="starts per role (the median is reported)")
+    parser.add_argument('--settle', type=float, default=2.0, help="seconds between readiness and the memory sample")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--budget-mb', type=float, default=512, help="container memory limit (Amvera: 512Mi)")
+    parser.add_argument('--max-startup-s', type=float, help="fail if the median ready_s of a role is above this")
+    parser.add_argument('--max-rss-mb', type=float, help="fail if the median peak RSS of a role is above this")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    roles = [name.strip() for name in args.roles.split(',') if name.strip()]
+    unknown = set(roles) - set(ROLES)
+    if unknown:
+        raise SystemExit(f"Unknown roles: {', '.join(sorted(unknown))}")
+
+    lava = FakeLava(latency=0.0).start()
+    telegram = FakeTelegram(latency=0.0).start()
+    summaries = []
+    try:
+        for role in roles:
+            runs = [run_role(role, args, lava, telegram) for _ in range(args.runs)]
+            summary = summarize(role, runs)
+            summaries.append(summary)
+            if not args.json:
+                print(f"== {role}")
+                for key, value in summary.items():
+                    if key != 'role':
+                        print(f"  {key:16} {value}")
+    finally:
+        lava.stop()
+        telegram.stop()
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+
+    failures = []
+    for summary in summaries:
+        if args.max_startup_s is not None and summary['ready_s'] > args.max_startup_s:
+            failures.append(f"{summary['role']}: ready_s {summary['ready_s']} > {args.max_startup_s}")
+        if args.max_rss_mb is not None and summary['peak_rss_mb'] > args.max_rss_mb:
+            failures.append(f"{summary['role']}: peak_rss_mb {summary['peak_rss_mb']} > {args.max_rss_mb}")
+    if failures:
+        raise SystemExit("Regression: " + "; ".join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+import time
+
+from database import (create_broadcast, get_running_broadcast, advance_broadcast, finish_broadcast,
+                      get_active_subscribers_page)
+from dispatcher import get_dispatcher, PRIORITY_LOW, PRIORITY_NORMAL, TELEGRAM_RESULT_TIMEOUT
+from metrics import BROADCAST_MESSAGES
+from tracing import start_trace
+
+logger = logging.getLogger('broadcast')
+
+# Сколько получателей читать из базы и отправлять за один шаг (шаг - единица контрольной точки)
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', 500))
+# Как часто проверять новые рассылки, созданные в других процессах
+BROADCAST_POLL_INTERVAL = float(os.getenv('BROADCAST_POLL_INTERVAL', 10))
+
+
+# Рассылка сообщения активным подписчикам.
+# Получатели читаются страницами по telegram_id (короткие запросы вместо долгого
+# открытого курсора, который мешал бы записи в WAL), сообщения идут через очередь
+# Telegram с низким приоритетом и ее ограничением частоты. После каждой страницы
+# прогресс сохраняется в broadcasts: после перезапуска рассылка продолжается,
+# повторно может быть отправлена не более одной страницы
+class BroadcastEngine:
+    def __init__(self, admin_id=None, page_size=BROADCAST_PAGE_SIZE, poll_interval=BROADCAST_POLL_INTERVAL):
+        self.admin_id = admin_id
+        self.page_size = page_size
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="broadcast", daemon=True)
+        self._thread.start()
+        logger.info("Broadcast engine started")
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def notify(self):
+        self._wake.set()
+
+    # Отправка одной страницы. Возвращает (отправлено, не доставлено)
+    def _send_page(self, text, recipients):
+        futures = [
+            get_dispatcher().send_message(telegram_id, text, priority=PRIORITY_LOW)
+            for telegram_id in recipients
+        ]
+        sent = failed = 0
+        for future in futures:
+            try:
+                future.result(timeout=TELEGRAM_RESULT_TIMEOUT)
+                sent += 1
+            except Exception:
+                # Пользователь заблокировал бота или удалил аккаунт - ошибка уже в логе очереди
+                failed += 1
+        BROADCAST_MESSAGES.inc(sent, outcome='sent')
+        BROADCAST_MESSAGES.inc(failed, outcome='failed')
+        return sent, failed
+
+    # Выполнение (или продолжение) рассылки до конца или до остановки
+    def run_broadcast(self, broadcast_id, text, last_telegram_id, sent, failed, elapsed):
+        with start_trace('broadcast.run', broadcast_id=broadcast_id):
+            self._run_broadcast(broadcast_id, text, last_telegram_id, sent, failed, elapsed)
+
+    def _run_broadcast(self, broadcast_id, text, last_telegram_id, sent, failed, elapsed):
+        logger.info("Running broadcast %s from recipient %r", broadcast_id, last_telegram_id)
+        while not self._stopped.is_set():
+            recipients = get_active_subscribers_page(last_telegram_id, self.page_size)
+            if not recipients:
+                break
+            start = time.monotonic()
+            page_sent, page_failed = self._send_page(text, recipients)
+            page_elapsed = time.monotonic() - start
+            last_telegram_id = recipients[-1]
+            advance_broadcast(broadcast_id, last_telegram_id, page_sent, page_failed, page_elapsed)
+            sent, failed, elapsed = sent + page_sent, failed + page_failed, elapsed + page_elapsed
+            logger.info("Broadcast %s: %s sent, %s failed so far", broadcast_id, sent, failed)
+        else:
+            return
+        sent, failed, elapsed = finish_broadcast(broadcast_id)
+        logger.info("Broadcast %s finished: %s sent, %s failed in %.1fs", broadcast_id, sent, failed, elapsed)
+        self._report(broadcast_id, sent, failed, elapsed)
+
+    # Итог рассылки администратору
+    def _report(self, broadcast_id, sent, failed, elapsed):
+        if not self.admin_id:
+            return
+        rate = (sent + failed) / elapsed if elapsed else 0
+        get_dispatcher().send_message(
+            self.admin_id,
+            f"Рассылка #{broadcast_id} завершена.\n"
+            f"Доставлено: {sent}\nНе доставлено: {failed}\n"
+            f"Время: {elapsed:.0f} с ({rate:.1f} сообщений/с)",
+            priority=PRIORITY_NORMAL
+        )
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.clear()
+            try:
+                broadcast = get_running_broadcast()
+                if broadcast:
+                    self.run_broadcast(*broadcast)
+                    continue
+            except Exception as e:
+                logger.error("Error running broadcast: %s", e, exc_info=True)
+            self._wake.wait(self.poll_interval)
+
+
+_engine = None
+
+
+def init_broadcast_engine(**kwargs):
+    global _engine
+    _engine = BroadcastEngine(**kwargs)
+    return _engine
+
+
+# Создание рассылки. Ее выполнит движок ведущего процесса; возвращает id рассылки
+def start_broadcast(text):
+    broadcast_id = create_broadcast(text)
+    if _engine is not None:
+        _engine.notify()
+    return broadcast_id
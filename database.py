@@ -0,0 +1,741 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import DB_LOCK_WAIT_SECONDS, DB_OPERATION_SECONDS, timed
+from migrations import migrate
+from tracing import traced, current_traceparent
+
+logger = logging.getLogger('db')
+
+# Путь к базе данных (для Amvera используем постоянное хранилище)
+DB_PATH = os.path.join('data', os.getenv('DATABASE', 'subscribers.db'))
+os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+
+# Параметры пула соединений и SQLite
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 4))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL')
+DB_CACHED_STATEMENTS = int(os.getenv('DB_CACHED_STATEMENTS', 128))
+
+
+# Пул долгоживущих соединений с SQLite.
+# Соединения создаются лениво, переиспользуются между потоками бота и вебхук-сервера
+# и держат кэш подготовленных выражений (cached_statements), поэтому повторные
+# запросы не парсятся заново.
+class ConnectionPool:
+    def __init__(self, db_path, size=DB_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,  # транзакциями управляем явно
+            check_same_thread=False,
+            cached_statements=DB_CACHED_STATEMENTS,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def acquire(self):
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        # Все соединения заняты - ждем освобождения
+        return self._idle.get(timeout=DB_BUSY_TIMEOUT_MS / 1000)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    # Явная транзакция: BEGIN IMMEDIATE сразу берет блокировку на запись,
+    # поэтому параллельные писатели ждут в busy_timeout, а не падают посреди транзакции
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            with DB_LOCK_WAIT_SECONDS.time():
+                conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+
+# Операция с базой: время попадает в гистограмму DB_OPERATION_SECONDS и в span db.<name>
+def db_operation(name):
+    def decorator(func):
+        return traced(f"db.{name}")(timed(DB_OPERATION_SECONDS, operation=name)(func))
+    return decorator
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+# Инициализация базы данных: применяем миграции схемы
+def init_db():
+    try:
+        with get_pool().connection() as conn:
+            version = migrate(conn)
+        logger.info("Database initialized successfully at %s (schema version %s)", DB_PATH, version)
+    except Exception as e:
+        logger.error("Error initializing database: %s", e)
+        raise
+
+
+# Сохранение нового инвойса пользователя: запись в историю инвойсов и
+# привязка инвойса к подписчику. Статус активного подписчика не сбрасывается, как и
+# статус expiring: иначе неудаленный из канала пользователь выпал бы из повторов удаления
+@db_operation('save_pending_payment')
+def save_pending_payment(telegram_id, payment_id, payment_url=None, reusable_until=None):
+    now = int(time.time())
+    with get_pool().transaction() as conn:
+        if payment_id is not None:
+            conn.execute(
+                "INSERT OR IGNORE INTO invoices (payment_id, telegram_id, payment_url, status, created_at, reusable_until) "
+                "VALUES (?, ?, ?, 'pending', ?, ?)",
+                (payment_id, str(telegram_id), payment_url, now, reusable_until)
+            )
+        conn.execute(
+            "INSERT INTO subscribers (telegram_id, payment_id, status) VALUES (?, ?, 'pending') "
+            "ON CONFLICT (telegram_id) DO UPDATE SET payment_id = excluded.payment_id, "
+            "status = CASE WHEN status IN ('active', 'expiring') THEN status ELSE excluded.status END",
+            (str(telegram_id), payment_id)
+        )
+
+
+# Последний неоплаченный инвойс пользователя, который еще можно выдать повторно.
+# Возвращает (payment_id, payment_url, reusable_until) или None
+@db_operation('get_reusable_invoice')
+def get_reusable_invoice(telegram_id, now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT payment_id, payment_url, reusable_until FROM invoices "
+            "WHERE telegram_id = ? AND status = 'pending' AND payment_url IS NOT NULL AND reusable_until > ? "
+            "ORDER BY created_at DESC LIMIT 1",
+            (str(telegram_id), now)
+        ).fetchone()
+
+
+# Можно ли еще выдать инвойс повторно: не оплачен, не отменен и срок повторной выдачи не истек
+@db_operation('is_invoice_reusable')
+def is_invoice_reusable(payment_id, now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT 1 FROM invoices WHERE payment_id = ? AND status = 'pending' AND reusable_until > ?",
+            (payment_id, now)
+        ).fetchone() is not None
+
+
+# Поиск пользователя по любому выданному ему инвойсу (включая старые)
+def _find_invoice_owner(conn, payment_id):
+    row = conn.execute("SELECT telegram_id FROM invoices WHERE payment_id = ?", (payment_id,)).fetchone()
+    if not row:
+        row = conn.execute("SELECT telegram_id FROM subscribers WHERE payment_id = ?", (payment_id,)).fetchone()
+    return row[0] if row else None
+
+
+# Активация подписки пользователя по оплаченному инвойсу.
+# Остальные неоплаченные инвойсы пользователя больше не выдаются повторно
+def _activate(conn, telegram_id, payment_id, expiry_date):
+    now = int(time.time())
+    conn.execute("UPDATE invoices SET status = 'paid' WHERE payment_id = ?", (payment_id,))
+    conn.execute(
+        "UPDATE invoices SET reusable_until = ? WHERE telegram_id = ? AND status = 'pending' AND reusable_until > ?",
+        (now, telegram_id, now)
+    )
+    # payment_id освобождаем у другой записи, если инвойс по какой-то причине привязан к ней
+    conn.execute(
+        "UPDATE subscribers SET payment_id = NULL WHERE payment_id = ? AND telegram_id != ?",
+        (payment_id, telegram_id)
+    )
+    conn.execute(
+        "INSERT INTO subscribers (telegram_id, payment_id, status, expiry_date) VALUES (?, ?, 'active', ?) "
+        "ON CONFLICT (telegram_id) DO UPDATE SET payment_id = excluded.payment_id, "
+        "status = excluded.status, expiry_date = excluded.expiry_date, claimed_at = NULL, kick_attempts = 0",
+        (telegram_id, payment_id, expiry_date)
+    )
+
+
+# Отмена или истечение инвойса. Статус подписчика меняется, только если это его текущий
+# инвойс и подписка не активна и не ожидает удаления из канала ('expiring' сохраняется,
+# чтобы неудавшееся удаление было повторено)
+def _set_status(conn, payment_id, status):
+    conn.execute("UPDATE invoices SET status = ? WHERE payment_id = ?", (status, payment_id))
+    conn.execute(
+        "UPDATE subscribers SET status = ? WHERE payment_id = ? AND status NOT IN ('active', 'expiring')",
+        (status, payment_id)
+    )
+
+
+# Виды записей outbox для побочных эффектов событий оплаты
+OUTBOX_ACTIVATION_INVITE = 'activation_invite'
+OUTBOX_PAYMENT_STATUS = 'payment_status'
+
+
+# Добавление побочного эффекта в outbox внутри текущей транзакции.
+# Контекст трассировки сохраняется в payload: доставка продолжит трассу события
+def _enqueue_outbox(conn, kind, telegram_id, payload, now=None):
+    now = int(now if now is not None else time.time())
+    traceparent = current_traceparent()
+    if traceparent:
+        payload = dict(payload, traceparent=traceparent)
+    conn.execute(
+        "INSERT INTO outbox (kind, telegram_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+        (kind, str(telegram_id), json.dumps(payload), now, now)
+    )
+
+
+# Порядок статусов инвойса: событие применяется, только если переводит инвойс
+# в более старший статус. Поэтому CANCELED после PAID игнорируется,
+# а PAID после CANCELED (деньги все-таки пришли) активирует подписку
+INVOICE_STATUS_RANK = {'pending': 0, 'canceled': 1, 'expired': 1, 'paid': 2}
+
+# Результаты обработки события
+EVENT_APPLIED = 'applied'
+EVENT_DUPLICATE = 'duplicate'
+EVENT_IGNORED = 'ignored'
+EVENT_UNKNOWN_PAYMENT = 'unknown_payment'
+
+
+# Идемпотентная обработка события Lava (status: PAID, CANCELED, EXPIRED) в одной транзакции
+# вместе с записью в журнал processed_events и уведомлением пользователя в outbox.
+# Возвращает (результат, telegram_id).
+# Владелец инвойса, уже известный вызывающему (telegram_id), не ищется в базе повторно
+@db_operation('apply_payment_event')
+def apply_payment_event(payment_id, status, expiry_date=None, telegram_id=None):
+    new_status = 'paid' if status == 'PAID' else status.lower()
+    with get_pool().transaction() as conn:
+        row = conn.execute(
+            "SELECT outcome FROM processed_events WHERE payment_id = ? AND status = ?", (payment_id, status)
+        ).fetchone()
+        telegram_id = telegram_id or _find_invoice_owner(conn, payment_id)
+        if row:
+            return EVENT_DUPLICATE, telegram_id
+        if not telegram_id:
+            # В журнал не пишем: вебхук отвечает Lava ошибкой, и ее повтор сможет найти
+            # пользователя, когда инвойс будет сохранен
+            return EVENT_UNKNOWN_PAYMENT, None
+
+        current = conn.execute("SELECT status FROM invoices WHERE payment_id = ?", (payment_id,)).fetchone()
+        current_rank = INVOICE_STATUS_RANK.get(current[0] if current else 'pending', 0)
+        if INVOICE_STATUS_RANK[new_status] <= current_rank:
+            outcome = EVENT_IGNORED
+        else:
+            outcome = EVENT_APPLIED
+            if new_status == 'paid':
+                _activate(conn, telegram_id, payment_id, expiry_date)
+                _enqueue_outbox(conn, OUTBOX_ACTIVATION_INVITE, telegram_id, {'expiry_date': expiry_date})
+            else:
+                _set_status(conn, payment_id, new_status)
+                _enqueue_outbox(conn, OUTBOX_PAYMENT_STATUS, telegram_id, {'status': new_status})
+        conn.execute(
+            "INSERT INTO processed_events (payment_id, status, outcome, processed_at) VALUES (?, ?, ?, ?)",
+            (payment_id, status, outcome, int(time.time()))
+        )
+    return outcome, telegram_id
+
+
+# Захват порции истекших подписок для удаления из канала: статус 'expiring'.
+# Выборка и обновление выполняются одним запросом, поэтому подписка, истекшая
+# между ними, не может быть помечена без обработки. Повторно захватываются
+# подписки, удаление которых не завершилось за claim_timeout секунд.
+# Возвращает список telegram_id
+@db_operation('claim_expired_subscribers')
+def claim_expired_subscribers(limit, claim_timeout, max_attempts, now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().transaction() as conn:
+        rows = conn.execute(
+            "UPDATE subscribers SET status = 'expiring', claimed_at = ?, kick_attempts = kick_attempts + 1 "
+            "WHERE telegram_id IN ("
+            "  SELECT telegram_id FROM subscribers "
+            "  WHERE (status = 'active' AND expiry_date < ?) "
+            "     OR (status = 'expiring' AND claimed_at < ? AND kick_attempts < ?) "
+            "  LIMIT ?"
+            ") RETURNING telegram_id",
+            (now, now, now - claim_timeout, max_attempts, limit)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+# Захват конкретных подписчиков, если их подписка действительно истекла
+# (не была продлена в последний момент). Возвращает список telegram_id
+@db_operation('claim_subscribers')
+def claim_subscribers(telegram_ids, now=None):
+    now = int(now if now is not None else time.time())
+    claimed = []
+    with get_pool().transaction() as conn:
+        for telegram_id in telegram_ids:
+            row = conn.execute(
+                "UPDATE subscribers SET status = 'expiring', claimed_at = ?, kick_attempts = kick_attempts + 1 "
+                "WHERE telegram_id = ? AND status = 'active' AND expiry_date <= ? RETURNING telegram_id",
+                (now, str(telegram_id), now)
+            ).fetchone()
+            if row:
+                claimed.append(row[0])
+    return claimed
+
+
+# Захваченные подписки, последняя попытка удаления которых не завершилась за
+# claim_timeout секунд (например, процесс упал во время нее): повторно они уже
+# не захватываются, поэтому переводятся в expired. Возвращает список telegram_id
+@db_operation('abandon_stale_expiries')
+def abandon_stale_expiries(claim_timeout, max_attempts, now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().transaction() as conn:
+        rows = conn.execute(
+            "UPDATE subscribers SET status = 'expired', claimed_at = NULL "
+            "WHERE status = 'expiring' AND claimed_at < ? AND kick_attempts >= ? RETURNING telegram_id",
+            (now - claim_timeout, max_attempts)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+# Завершение обработки захваченных подписок: успешно удаленные переводятся в expired.
+# Неудачные остаются захваченными и будут повторены после таймаута, а исчерпавшие
+# max_attempts попыток тоже переводятся в expired. Возвращает список сдавшихся telegram_id
+@db_operation('finish_expiry')
+def finish_expiry(succeeded, failed, max_attempts):
+    gave_up = []
+    with get_pool().transaction() as conn:
+        for telegram_id in succeeded:
+            conn.execute(
+                "UPDATE subscribers SET status = 'expired', claimed_at = NULL "
+                "WHERE telegram_id = ? AND status = 'expiring'",
+                (telegram_id,)
+            )
+        for telegram_id in failed:
+            row = conn.execute(
+                "UPDATE subscribers SET status = 'expired', claimed_at = NULL "
+                "WHERE telegram_id = ? AND status = 'expiring' AND kick_attempts >= ? RETURNING telegram_id",
+                (telegram_id, max_attempts)
+            ).fetchone()
+            if row:
+                gave_up.append(row[0])
+    return gave_up
+
+
+# Активные подписки, истекающие не позже until (unix-время): [(telegram_id, expiry_date)]
+@db_operation('get_upcoming_expiries')
+def get_upcoming_expiries(until):
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT telegram_id, expiry_date FROM subscribers WHERE status = 'active' AND expiry_date <= ?",
+            (int(until),)
+        ).fetchall()
+
+
+# Добавление созданных ссылок-приглашений в пул: [(invite_link, expire_date)]
+@db_operation('add_invite_links')
+def add_invite_links(links, now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO invite_links (invite_link, status, created_at, expire_date) "
+            "VALUES (?, 'available', ?, ?)",
+            [(invite_link, now, int(expire_date)) for invite_link, expire_date in links]
+        )
+
+
+# Выдача пользователю ссылки из пула, действующей не меньше чем до min_expire.
+# Выбор и пометка выполняются одним запросом, поэтому одна ссылка не достанется двоим.
+# Возвращает (invite_link, expire_date) или None, если пул пуст
+@db_operation('take_invite_link')
+def take_invite_link(telegram_id, min_expire, now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().transaction() as conn:
+        return conn.execute(
+            "UPDATE invite_links SET status = 'issued', telegram_id = ?, issued_at = ? "
+            "WHERE invite_link = ("
+            "  SELECT invite_link FROM invite_links WHERE status = 'available' AND expire_date >= ? "
+            "  ORDER BY expire_date LIMIT 1"
+            ") RETURNING invite_link, expire_date",
+            (str(telegram_id), now, int(min_expire))
+        ).fetchone()
+
+
+# Число ссылок в пуле, действующих не меньше чем до min_expire
+@db_operation('count_available_invite_links')
+def count_available_invite_links(min_expire):
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM invite_links WHERE status = 'available' AND expire_date >= ?",
+            (int(min_expire),)
+        ).fetchone()[0]
+
+
+# Невыданные ссылки, срок действия которых подходит к концу (раньше min_expire).
+# Они помечаются revoked сразу, чтобы их уже нельзя было выдать. Возвращает список ссылок
+@db_operation('retire_stale_invite_links')
+def retire_stale_invite_links(min_expire, limit=100):
+    with get_pool().transaction() as conn:
+        rows = conn.execute(
+            "UPDATE invite_links SET status = 'revoked' "
+            "WHERE invite_link IN ("
+            "  SELECT invite_link FROM invite_links WHERE status = 'available' AND expire_date < ? LIMIT ?"
+            ") RETURNING invite_link",
+            (int(min_expire), limit)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+# Удаление записей о ссылках, истекших раньше before
+@db_operation('delete_old_invite_links')
+def delete_old_invite_links(before):
+    with get_pool().transaction() as conn:
+        return conn.execute(
+            "DELETE FROM invite_links WHERE status != 'available' AND expire_date < ?", (int(before),)
+        ).rowcount
+
+
+# Захват порции записей outbox, которые пора доставить. Захваченные записи
+# откладываются на lease секунд: если обработчик упадет, их возьмут повторно.
+# Возвращает [(entry_id, kind, telegram_id, payload, attempts)]
+@db_operation('claim_outbox')
+def claim_outbox(limit, lease, now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().transaction() as conn:
+        rows = conn.execute(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? "
+            "WHERE id IN ("
+            "  SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?"
+            ") RETURNING id, kind, telegram_id, payload, attempts",
+            (now + lease, now, limit)
+        ).fetchall()
+    return sorted((entry_id, kind, telegram_id, json.loads(payload), attempts)
+                  for entry_id, kind, telegram_id, payload, attempts in rows)
+
+
+# Запись результатов доставки: done - [entry_id], retry - [(entry_id, next_attempt_at, error)],
+# dead - [(entry_id, error)] для записей, исчерпавших попытки
+@db_operation('finish_outbox')
+def finish_outbox(done=(), retry=(), dead=()):
+    with get_pool().transaction() as conn:
+        conn.executemany("UPDATE outbox SET status = 'done', last_error = NULL WHERE id = ?", [(entry_id,) for entry_id in done])
+        conn.executemany(
+            "UPDATE outbox SET next_attempt_at = ?, last_error = ? WHERE id = ?",
+            [(int(next_attempt_at), error, entry_id) for entry_id, next_attempt_at, error in retry]
+        )
+        conn.executemany("UPDATE outbox SET status = 'dead', last_error = ? WHERE id = ?",
+                         [(error, entry_id) for entry_id, error in dead])
+
+
+# Удаление доставленных записей outbox, созданных раньше before
+@db_operation('delete_done_outbox')
+def delete_done_outbox(before):
+    with get_pool().transaction() as conn:
+        return conn.execute("DELETE FROM outbox WHERE status = 'done' AND created_at < ?", (int(before),)).rowcount
+
+
+# Число записей outbox по статусам: {status: count}
+@db_operation('count_outbox_by_status')
+def count_outbox_by_status():
+    with get_pool().connection() as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+
+# Захват или продление аренды name владельцем owner на ttl секунд.
+# Удается, если аренда свободна, истекла или уже принадлежит owner. Возвращает True/False
+@db_operation('acquire_lease')
+def acquire_lease(name, owner, ttl, now=None):
+    now = now if now is not None else time.time()
+    with get_pool().transaction() as conn:
+        row = conn.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at < ? "
+            "RETURNING owner",
+            (name, owner, now + ttl, now)
+        ).fetchone()
+    return row is not None
+
+
+# Освобождение аренды, если она принадлежит owner
+@db_operation('release_lease')
+def release_lease(name, owner):
+    with get_pool().transaction() as conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+
+# Страница неоплаченных инвойсов, созданных в интервале [created_from, created_until],
+# в порядке (created_at, payment_id) после позиции after. Возвращает [(payment_id, created_at)]
+@db_operation('get_pending_invoices_page')
+def get_pending_invoices_page(created_from, created_until, after=None, limit=100):
+    after_created, after_payment = after or (0, '')
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT payment_id, created_at FROM invoices "
+            "WHERE status = 'pending' AND created_at BETWEEN ? AND ? AND (created_at, payment_id) > (?, ?) "
+            "ORDER BY created_at, payment_id LIMIT ?",
+            (int(created_from), int(created_until), after_created, after_payment, limit)
+        ).fetchall()
+
+
+# Контрольная точка задания name (значение, сохраненное save_checkpoint) или None
+def get_checkpoint(name):
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT position FROM checkpoints WHERE name = ?", (name,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def save_checkpoint(name, position):
+    with get_pool().transaction() as conn:
+        conn.execute(
+            "INSERT INTO checkpoints (name, position, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET position = excluded.position, updated_at = excluded.updated_at",
+            (name, json.dumps(position), int(time.time()))
+        )
+
+
+def clear_checkpoint(name):
+    with get_pool().transaction() as conn:
+        conn.execute("DELETE FROM checkpoints WHERE name = ?", (name,))
+
+
+# Новая рассылка. Возвращает ее id
+@db_operation('create_broadcast')
+def create_broadcast(text):
+    with get_pool().transaction() as conn:
+        return conn.execute(
+            "INSERT INTO broadcasts (text, created_at) VALUES (?, ?)", (text, int(time.time()))
+        ).lastrowid
+
+
+# Самая ранняя незавершенная рассылка: (id, text, last_telegram_id, sent, failed, elapsed) или None
+@db_operation('get_running_broadcast')
+def get_running_broadcast():
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT id, text, last_telegram_id, sent, failed, elapsed FROM broadcasts "
+            "WHERE status = 'running' ORDER BY id LIMIT 1"
+        ).fetchone()
+
+
+# Сохранение прогресса рассылки после очередной страницы получателей
+@db_operation('advance_broadcast')
+def advance_broadcast(broadcast_id, last_telegram_id, sent, failed, elapsed):
+    with get_pool().transaction() as conn:
+        conn.execute(
+            "UPDATE broadcasts SET last_telegram_id = ?, sent = sent + ?, failed = failed + ?, elapsed = elapsed + ? "
+            "WHERE id = ?",
+            (last_telegram_id, sent, failed, elapsed, broadcast_id)
+        )
+
+
+@db_operation('finish_broadcast')
+def finish_broadcast(broadcast_id):
+    with get_pool().transaction() as conn:
+        return conn.execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ? "
+            "RETURNING sent, failed, elapsed",
+            (int(time.time()), broadcast_id)
+        ).fetchone()
+
+
+# Страница активных подписчиков в порядке telegram_id после позиции after: [telegram_id]
+@db_operation('get_active_subscribers_page')
+def get_active_subscribers_page(after='', limit=500, now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().connection() as conn:
+        return [row[0] for row in conn.execute(
+            "SELECT telegram_id FROM subscribers "
+            "WHERE telegram_id > ? AND status = 'active' AND expiry_date > ? ORDER BY telegram_id LIMIT ?",
+            (after, now, limit)
+        )]
+
+
+# Все подписчики для загрузки индекса в память: [(telegram_id, status, expiry_date, payment_id)]
+@db_operation('load_subscribers')
+def load_subscribers():
+    with get_pool().connection() as conn:
+        return conn.execute("SELECT telegram_id, status, expiry_date, payment_id FROM subscribers").fetchall()
+
+
+# Один подписчик: (status, expiry_date, payment_id) или None
+@db_operation('get_subscriber')
+def get_subscriber(telegram_id):
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT status, expiry_date, payment_id FROM subscribers WHERE telegram_id = ?", (str(telegram_id),)
+        ).fetchone()
+
+
+# Владельцы неоплаченных инвойсов: [(payment_id, telegram_id)]
+@db_operation('load_pending_invoice_owners')
+def load_pending_invoice_owners():
+    with get_pool().connection() as conn:
+        return conn.execute("SELECT payment_id, telegram_id FROM invoices WHERE status = 'pending'").fetchall()
+
+
+# Число подписчиков по статусам: {status: count}
+@db_operation('count_subscribers_by_status')
+def count_subscribers_by_status():
+    with get_pool().connection() as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM subscribers GROUP BY status").fetchall())
+
+
+# Число неоплаченных инвойсов, которые еще можно выдать повторно
+@db_operation('count_reusable_invoices')
+def count_reusable_invoices(now=None):
+    now = int(now if now is not None else time.time())
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM invoices WHERE status = 'pending' AND reusable_until > ?", (now,)
+        ).fetchone()[0]
+
+
+# Счетчики подписчиков по статусам из stats_counters (поддерживаются триггерами): {status: count}
+@db_operation('get_stats_counters')
+def get_stats_counters():
+    with get_pool().connection() as conn:
+        rows = conn.execute("SELECT name, value FROM stats_counters").fetchall()
+    return {
+        name[len('subscribers_'):]: value
+        for name, value in rows
+        if name.startswith('subscribers_') and value
+    }
+
+
+# Дневные итоги начиная с дня since ('YYYY-MM-DD', UTC): {day: {name: value}}
+@db_operation('get_daily_stats')
+def get_daily_stats(since):
+    daily = {}
+    with get_pool().connection() as conn:
+        for day, name, value in conn.execute(
+            "SELECT day, name, value FROM stats_daily WHERE day >= ? ORDER BY day", (since,)
+        ):
+            daily.setdefault(day, {})[name] = value
+    return daily
+
+
+# Таблицы, старые завершенные записи которых переносятся в архив:
+# (таблица, ключевые колонки, колонка времени для месяца сегмента или None, условие архивации).
+# Подписчик без активной подписки архивируется, если у него нет новых инвойсов;
+# инвойс - только когда на него уже не ссылается подписчик, поэтому подписчики идут первыми
+ARCHIVE_TABLES = (
+    ('events', ('id',), 'created_at', "created_at < :before"),
+    ('processed_events', ('payment_id', 'status'), 'processed_at', "processed_at < :before"),
+    ('outbox', ('id',), 'created_at', "created_at < :before AND status != 'pending'"),
+    ('subscribers', ('telegram_id',), None,
+     "status IN ('pending', 'canceled', 'expired') AND COALESCE(expiry_date, 0) < :before "
+     "AND NOT EXISTS (SELECT 1 FROM invoices i WHERE i.telegram_id = subscribers.telegram_id AND i.created_at >= :before)"),
+    ('invoices', ('payment_id',), 'created_at',
+     "created_at < :before AND NOT EXISTS (SELECT 1 FROM subscribers s WHERE s.payment_id = invoices.payment_id)"),
+)
+
+
+def _archive_spec(table):
+    for spec in ARCHIVE_TABLES:
+        if spec[0] == table:
+            return spec
+    raise ValueError(f"Table {table} is not archivable")
+
+
+# Перенос порции записей таблицы в архив. Выборка, сохранение записей (store) и их
+# удаление по ключам выполняются в одной транзакции записи: между выборкой и удалением
+# записи никто не изменит, поэтому удаляются ровно сохраненные в архив записи.
+# Транзакция держит блокировку записи, пока store пишет сегмент (размер порции - ARCHIVE_BATCH_SIZE).
+# Возвращает ключи удаленных записей
+@db_operation('archive_batch')
+def archive_batch(table, before, limit, store):
+    _, keys, _, condition = _archive_spec(table)
+    key_condition = ' AND '.join(f"{key} = ?" for key in keys)
+    with get_pool().transaction() as conn:
+        cursor = conn.execute(
+            f"SELECT * FROM {table} WHERE {condition} ORDER BY {', '.join(keys)} LIMIT :limit",
+            {'before': int(before), 'limit': limit}
+        )
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor]
+        if not rows:
+            return []
+        store(rows)
+        deleted = [tuple(row[key] for key in keys) for row in rows]
+        conn.executemany(f"DELETE FROM {table} WHERE {key_condition}", deleted)
+    return deleted
+
+
+# Возврат свободных страниц файлу системы (не больше pages, None - все) и сокращение WAL.
+# Возвращает число освобожденных страниц
+@db_operation('incremental_vacuum')
+def incremental_vacuum(pages=None):
+    with get_pool().connection() as conn:
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript выполняет прагму до конца (execute освобождает только одну страницу)
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages) if pages else 0});")
+        free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return free_before - free_after
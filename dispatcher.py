@@ -0,0 +1,267 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from telebot.apihelper import ApiTelegramException
+
+from metrics import TELEGRAM_REQUEST_SECONDS, TELEGRAM_REQUESTS
+from tracing import span, current_span
+
+logger = logging.getLogger('dispatcher')
+
+# Приоритеты очереди: меньшее значение обрабатывается раньше
+PRIORITY_HIGH = 0    # ссылки-приглашения после оплаты
+PRIORITY_NORMAL = 1  # ответы на действия пользователя
+PRIORITY_LOW = 2     # уведомления об истечении подписки и массовые рассылки
+
+# Ограничения Telegram Bot API: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+TELEGRAM_WORKERS = int(os.getenv('TELEGRAM_WORKERS', 4))
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 25))
+# Часть общего лимита для ответов пользователям, которые отправляют воркеры веб-сервера;
+# остальное получает процесс, выполняющий фоновые задачи (рассылки, истечение подписок)
+TELEGRAM_WEB_RATE = min(float(os.getenv('TELEGRAM_WEB_RATE', 5)), TELEGRAM_GLOBAL_RATE)
+TELEGRAM_PER_CHAT_RATE = float(os.getenv('TELEGRAM_PER_CHAT_RATE', 1))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', 5))
+# Сколько секунд вызывающий код ждет результата вызова из очереди (future.result)
+TELEGRAM_RESULT_TIMEOUT = float(os.getenv('TELEGRAM_RESULT_TIMEOUT', 300))
+
+
+# Очередь остановлена: вызов не был и не будет выполнен
+class DispatcherStopped(Exception):
+    pass
+
+
+# Потокобезопасный token bucket: rate токенов в секунду, не более capacity в запасе
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    # Смена лимита: токены, накопленные по прежнему лимиту, сохраняются в пределах нового запаса
+    def set_rate(self, rate):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.rate = rate
+            self.capacity = rate
+            self._tokens = min(self._tokens, self.capacity)
+
+    # Пауза на время retry_after после ответа 429 без привязки к чату
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class _Job:
+    __slots__ = ('func', 'args', 'kwargs', 'chat_id', 'priority', 'future', 'attempts', 'parent', 'submitted_at')
+
+    def __init__(self, func, args, kwargs, chat_id, priority):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future = Future()
+        self.attempts = 0
+        # Вызов выполняется в другом потоке: span вызова привязывается к трассе постановщика
+        self.parent = current_span()
+        self.submitted_at = time.monotonic()
+
+
+# Единая очередь исходящих вызовов Telegram API.
+# Пул рабочих потоков разбирает задачи по приоритету, соблюдая общий лимит
+# и лимит на один чат; при ответе 429 задача откладывается на retry_after
+class MessageDispatcher:
+    def __init__(self, bot, workers=TELEGRAM_WORKERS, global_rate=TELEGRAM_GLOBAL_RATE,
+                 per_chat_rate=TELEGRAM_PER_CHAT_RATE, max_retries=TELEGRAM_MAX_RETRIES):
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_interval = 1 / per_chat_rate
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(global_rate)
+        self._ready = []    # (priority, seq, job)
+        self._delayed = []  # (ready_at, seq, job)
+        self._seq = itertools.count()
+        self._chat_next = {}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopped = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"tg-dispatcher-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Telegram dispatcher started with %s workers", self.workers)
+
+    # Остановка: рабочие потоки дорабатывают готовые задачи, а оставшиеся (в том числе
+    # отложенные после 429) завершаются DispatcherStopped, чтобы ожидающие их не зависли
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        with self._cond:
+            jobs = [job for _, _, job in self._ready + self._delayed]
+            self._ready, self._delayed = [], []
+        for job in jobs:
+            self._fail_stopped(job)
+        if jobs:
+            logger.warning("Telegram dispatcher stopped with %s pending calls", len(jobs))
+
+    @staticmethod
+    def _fail_stopped(job):
+        if not job.future.done():
+            job.future.set_exception(DispatcherStopped("Telegram dispatcher stopped"))
+
+    # Общий лимит меняется, когда процесс получает или теряет фоновые задачи ведущего
+    @property
+    def rate(self):
+        return self._bucket.rate
+
+    def set_rate(self, rate):
+        self._bucket.set_rate(rate)
+        logger.info("Telegram dispatcher rate set to %.2f requests per second", rate)
+
+    def qsize(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed)
+
+    # Постановка произвольного вызова Telegram API в очередь. Возвращает Future
+    def submit(self, func, *args, chat_id=None, priority=PRIORITY_NORMAL, **kwargs):
+        job = _Job(func, args, kwargs, chat_id, priority)
+        with self._cond:
+            if not self._stopped:
+                heapq.heappush(self._ready, (priority, next(self._seq), job))
+                self._cond.notify()
+                return job.future
+        self._fail_stopped(job)
+        return job.future
+
+    def send_message(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        return self.submit(self.bot.send_message, chat_id, text, chat_id=chat_id, priority=priority, **kwargs)
+
+    def _defer(self, job, delay):
+        with self._cond:
+            if not self._stopped:
+                heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), job))
+                self._cond.notify()
+                return
+        self._fail_stopped(job)
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (job.priority, seq, job))
+                if self._ready:
+                    return heapq.heappop(self._ready)[2]
+                if self._stopped:
+                    return None
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    # Резервирует слот отправки в чат. Возвращает 0 или время ожидания в секундах
+    def _reserve_chat(self, chat_id):
+        if chat_id is None:
+            return 0
+        with self._cond:
+            now = time.monotonic()
+            next_at = self._chat_next.get(chat_id, 0)
+            if next_at > now:
+                return next_at - now
+            self._chat_next[chat_id] = now + self.per_chat_interval
+            if len(self._chat_next) > 10000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+            return 0
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            if not job.future.running() and not job.future.set_running_or_notify_cancel():
+                continue
+            wait = self._reserve_chat(job.chat_id)
+            if wait > 0:
+                self._defer(job, wait)
+                continue
+            self._bucket.acquire()
+            method = getattr(job.func, '__name__', 'call')
+            with span(f"telegram.{method}", parent=job.parent, chat_id=job.chat_id, attempt=job.attempts + 1,
+                      queued_ms=round((time.monotonic() - job.submitted_at) * 1000, 1)) as call_span:
+                start = time.perf_counter()
+                try:
+                    result = job.func(*job.args, **job.kwargs)
+                except ApiTelegramException as e:
+                    call_span.set_error(e)
+                    TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method)
+                    TELEGRAM_REQUESTS.inc(method=method, outcome='rate_limited' if e.error_code == 429 else 'error')
+                    if e.error_code == 429 and job.attempts < self.max_retries:
+                        job.attempts += 1
+                        retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                        logger.warning("Telegram rate limit hit for chat %s, retrying in %ss", job.chat_id, retry_after)
+                        if job.chat_id is None:
+                            self._bucket.pause(retry_after)
+                        else:
+                            with self._cond:
+                                self._chat_next[job.chat_id] = time.monotonic() + retry_after
+                        self._defer(job, retry_after)
+                        continue
+                    logger.error("Telegram API call failed for chat %s: %s", job.chat_id, e)
+                    job.future.set_exception(e)
+                except Exception as e:
+                    call_span.set_error(e)
+                    TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method)
+                    TELEGRAM_REQUESTS.inc(method=method, outcome='error')
+                    logger.error("Telegram API call failed for chat %s: %s", job.chat_id, e)
+                    job.future.set_exception(e)
+                else:
+                    TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method)
+                    TELEGRAM_REQUESTS.inc(method=method, outcome='ok')
+                    job.future.set_result(result)
+
+
+_dispatcher = None
+
+
+def init_dispatcher(bot, **kwargs):
+    global _dispatcher
+    _dispatcher = MessageDispatcher(bot, **kwargs)
+    return _dispatcher
+
+
+def get_dispatcher():
+    return _dispatcher
@@ -0,0 +1,130 @@
+import heapq
+import logging
+import os
+import threading
+import time
+
+from database import get_upcoming_expiries
+
+logger = logging.getLogger('expiry')
+
+# Как часто перечитывать ближайшие истечения из базы (изменения из других процессов)
+EXPIRY_RESYNC_INTERVAL = int(os.getenv('EXPIRY_RESYNC_INTERVAL', 600))
+# Горизонт планирования: в памяти держим только подписки, истекающие в этом окне
+EXPIRY_HORIZON = int(os.getenv('EXPIRY_HORIZON', 3600))
+
+
+# Планировщик истечения подписок на min-куче.
+# В куче лежат только ближайшие истечения (в пределах горизонта), поэтому память
+# не растет вместе с таблицей. Продление подписки не удаляет старую запись из кучи:
+# она отбрасывается при извлечении, если не совпадает с актуальным временем в _latest
+class ExpiryScheduler:
+    def __init__(self, on_expire, resync_interval=EXPIRY_RESYNC_INTERVAL, horizon=EXPIRY_HORIZON):
+        self.on_expire = on_expire
+        self.resync_interval = resync_interval
+        self.horizon = max(horizon, resync_interval)
+        self._heap = []     # (expiry_date, telegram_id)
+        self._latest = {}   # telegram_id -> expiry_date
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._next_resync = 0
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="expiry-scheduler", daemon=True)
+        self._thread.start()
+        logger.info("Expiry scheduler started")
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._latest)
+
+    # Планирование (или перенос) истечения подписки пользователя
+    def schedule(self, telegram_id, expiry_date):
+        telegram_id = str(telegram_id)
+        expiry_date = int(expiry_date)
+        with self._cond:
+            if expiry_date > time.time() + self.horizon:
+                # Далекое истечение подхватит очередная синхронизация с базой
+                self._latest.pop(telegram_id, None)
+                return
+            self._latest[telegram_id] = expiry_date
+            heapq.heappush(self._heap, (expiry_date, telegram_id))
+            self._cond.notify()
+
+    def cancel(self, telegram_id):
+        with self._cond:
+            self._latest.pop(str(telegram_id), None)
+
+    # Перечитывание ближайших истечений из базы
+    def resync(self):
+        now = time.time()
+        rows = get_upcoming_expiries(now + self.horizon)
+        with self._cond:
+            self._latest = {str(telegram_id): int(expiry_date) for telegram_id, expiry_date in rows}
+            self._heap = [(expiry_date, telegram_id) for telegram_id, expiry_date in self._latest.items()]
+            heapq.heapify(self._heap)
+            self._next_resync = now + self.resync_interval
+            self._cond.notify()
+        logger.debug("Expiry scheduler resynced: %s subscriptions within horizon", len(rows))
+
+    # Извлечение всех наступивших истечений; ждет до ближайшего или до синхронизации
+    def _pop_due(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                if now >= self._next_resync:
+                    return None
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    expiry_date, telegram_id = heapq.heappop(self._heap)
+                    if self._latest.get(telegram_id) == expiry_date:
+                        del self._latest[telegram_id]
+                        due.append(telegram_id)
+                if due:
+                    return due
+                wake_at = self._next_resync
+                if self._heap:
+                    wake_at = min(wake_at, self._heap[0][0])
+                self._cond.wait(max(0, wake_at - now))
+            return []
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                due = self._pop_due()
+                if due is None:
+                    self.resync()
+                elif due:
+                    logger.info("%s subscriptions reached expiry", len(due))
+                    self.on_expire(due)
+            except Exception as e:
+                logger.error("Error in expiry scheduler: %s", e)
+                time.sleep(5)
+
+
+_scheduler = None
+
+
+def init_expiry_scheduler(on_expire, **kwargs):
+    global _scheduler
+    _scheduler = ExpiryScheduler(on_expire, **kwargs)
+    return _scheduler
+
+
+# Уведомление планировщика об активации или продлении подписки.
+# В процессе без планировщика ничего не делает - изменение подхватит синхронизация
+def schedule_expiry(telegram_id, expiry_date):
+    if _scheduler is not None:
+        _scheduler.schedule(telegram_id, expiry_date)
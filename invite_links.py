@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+from database import (add_invite_links, take_invite_link, count_available_invite_links,
+                      retire_stale_invite_links, delete_old_invite_links)
+from dispatcher import get_dispatcher, PRIORITY_LOW, TELEGRAM_RESULT_TIMEOUT
+from metrics import INVITE_LINKS_AVAILABLE
+
+logger = logging.getLogger('invite_links')
+
+# Сколько готовых ссылок держать в пуле
+INVITE_POOL_SIZE = int(os.getenv('INVITE_POOL_SIZE', 20))
+# Срок действия создаваемых ссылок и минимальный остаток срока у выдаваемой ссылки:
+# ссылки с меньшим остатком не выдаются и отзываются
+INVITE_LINK_TTL = int(os.getenv('INVITE_LINK_TTL', 2 * 24 * 3600))
+INVITE_LINK_MIN_VALIDITY = int(os.getenv('INVITE_LINK_MIN_VALIDITY', 24 * 3600))
+# Как часто проверять пул, если ссылки не выдаются
+INVITE_POOL_CHECK_INTERVAL = int(os.getenv('INVITE_POOL_CHECK_INTERVAL', 300))
+
+
+# Пул заранее созданных одноразовых ссылок-приглашений.
+# Ссылки хранятся в таблице invite_links, поэтому выдача атомарна и переживает перезапуск.
+# Фоновый поток пополняет пул до size через очередь Telegram с низким приоритетом
+# и отзывает невыданные ссылки, срок действия которых подходит к концу
+class InviteLinkPool:
+    def __init__(self, bot, channel_id, size=INVITE_POOL_SIZE, ttl=INVITE_LINK_TTL,
+                 min_validity=INVITE_LINK_MIN_VALIDITY, check_interval=INVITE_POOL_CHECK_INTERVAL):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.size = size
+        self.ttl = max(ttl, min_validity + 3600)
+        self.min_validity = min_validity
+        self.check_interval = check_interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="invite-link-pool", daemon=True)
+        self._thread.start()
+        logger.info("Invite link pool started (size %s)", self.size)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Ссылка для пользователя: (invite_link, expire_date) или None, если пул пуст
+    def take(self, telegram_id):
+        link = take_invite_link(telegram_id, time.time() + self.min_validity)
+        self._wake.set()
+        return link
+
+    # Пополнение пула и отзыв устаревших ссылок
+    def replenish(self):
+        now = time.time()
+        self._revoke(retire_stale_invite_links(now + self.min_validity))
+        delete_old_invite_links(now - 24 * 3600)
+
+        missing = self.size - count_available_invite_links(now + self.min_validity)
+        if missing > 0:
+            expire_date = int(now + self.ttl)
+            futures = [
+                get_dispatcher().submit(
+                    self.bot.create_chat_invite_link, self.channel_id,
+                    member_limit=1, expire_date=expire_date, priority=PRIORITY_LOW
+                )
+                for _ in range(missing)
+            ]
+            links = []
+            for future in futures:
+                try:
+                    links.append((future.result(timeout=TELEGRAM_RESULT_TIMEOUT).invite_link, expire_date))
+                except Exception as e:
+                    logger.error("Error creating pooled invite link: %s", e)
+            add_invite_links(links)
+            logger.info("Added %s invite links to the pool", len(links))
+        INVITE_LINKS_AVAILABLE.set(count_available_invite_links(time.time() + self.min_validity))
+
+    def _revoke(self, links):
+        futures = [
+            (link, get_dispatcher().submit(self.bot.revoke_chat_invite_link, self.channel_id, link,
+                                           priority=PRIORITY_LOW))
+            for link in links
+        ]
+        for link, future in futures:
+            try:
+                future.result(timeout=TELEGRAM_RESULT_TIMEOUT)
+            except ApiTelegramException as e:
+                # Ссылка уже истекла или отозвана - считаем отозванной
+                logger.warning("Error revoking invite link %s: %s", link, e)
+            except Exception as e:
+                logger.error("Error revoking invite link %s: %s", link, e)
+        if links:
+            logger.info("Revoked %s stale invite links", len(links))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.clear()
+            try:
+                self.replenish()
+            except Exception as e:
+                logger.error("Error replenishing invite link pool: %s", e)
+            self._wake.wait(self.check_interval)
+
+
+_pool = None
+
+
+def init_invite_pool(bot, channel_id, **kwargs):
+    global _pool
+    _pool = InviteLinkPool(bot, channel_id, **kwargs)
+    return _pool
+
+
+# Ссылка из пула для пользователя или None (пул не запущен в этом процессе или пуст)
+def take_pooled_invite(telegram_id):
+    if _pool is None:
+        return None
+    try:
+        return _pool.take(telegram_id)
+    except Exception as e:
+        logger.error("Error taking invite link from pool: %s", e)
+        return None
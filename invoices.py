@@ -0,0 +1,97 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from database import get_reusable_invoice, is_invoice_reusable
+from subscribers import subscriber_index
+
+logger = logging.getLogger('invoices')
+
+# Сколько секунд неоплаченный инвойс выдается повторно вместо создания нового
+INVOICE_REUSE_TTL = int(os.getenv('INVOICE_REUSE_TTL', 3600))
+
+
+# Кэш неоплаченных инвойсов по telegram_id. Источник истины - таблица invoices,
+# память лишь избавляет повторные нажатия кнопки от запроса к базе и к Lava.
+# invalidate действует только в своем процессе, поэтому при нескольких процессах
+# инвойс из памяти перед выдачей проверяется по базе (его могли оплатить или отменить)
+class InvoiceCache:
+    def __init__(self, ttl=INVOICE_REUSE_TTL):
+        self.ttl = ttl
+        self._entries = {}  # telegram_id -> (payment_id, payment_url, reusable_until)
+        self._lock = threading.Lock()
+        # Блокировки по пользователю: двойное нажатие не создает два инвойса, а медленный
+        # ответ Lava задерживает только этого пользователя. Запись удаляется, когда
+        # блокировку больше никто не ждет
+        self._user_locks = {}  # telegram_id -> [lock, число владельцев и ожидающих]
+
+    @contextmanager
+    def _user_lock(self, telegram_id):
+        key = str(telegram_id)
+        with self._lock:
+            entry = self._user_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._user_locks[key]
+
+    def get(self, telegram_id, now=None):
+        now = now if now is not None else time.time()
+        key = str(telegram_id)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[2] > now and (not subscriber_index.shared or is_invoice_reusable(entry[0], now)):
+            return entry
+        with self._lock:
+            self._entries.pop(key, None)
+        row = get_reusable_invoice(key, now)
+        if row:
+            with self._lock:
+                self._entries[key] = tuple(row)
+            return tuple(row)
+        return None
+
+    def put(self, telegram_id, payment_id, payment_url, reusable_until):
+        with self._lock:
+            self._entries[str(telegram_id)] = (payment_id, payment_url, reusable_until)
+
+    def invalidate(self, telegram_id):
+        with self._lock:
+            self._entries.pop(str(telegram_id), None)
+
+    # Возвращает действующий инвойс пользователя или создает новый через create_invoice.
+    # Результат в формате ответа Lava: {'id': ..., 'paymentUrl': ...} или None
+    def get_or_create(self, telegram_id, create_invoice):
+        with self._user_lock(telegram_id):
+            cached = self.get(telegram_id)
+            if cached:
+                payment_id, payment_url, _ = cached
+                logger.info("Reusing pending invoice %s for user %s", payment_id, telegram_id)
+                return {'id': payment_id, 'paymentUrl': payment_url}
+
+            invoice_data = create_invoice(telegram_id)
+            if not invoice_data or 'paymentUrl' not in invoice_data:
+                return invoice_data
+
+            payment_id = invoice_data.get('id')
+            reusable_until = int(time.time()) + self.ttl
+            # Сохраняем информацию о платеже в базу данных
+            try:
+                subscriber_index.save_pending_payment(telegram_id, payment_id, invoice_data['paymentUrl'], reusable_until)
+                logger.debug("Saved payment info to database for user %s", telegram_id)
+            except Exception as e:
+                logger.error("Error saving payment info to database: %s", e)
+                return invoice_data
+            if payment_id:
+                self.put(telegram_id, payment_id, invoice_data['paymentUrl'], reusable_until)
+            return invoice_data
+
+
+invoice_cache = InvoiceCache()
@@ -0,0 +1,212 @@
+import logging
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from metrics import LAVA_REQUEST_SECONDS, LAVA_REQUESTS
+from tracing import span
+
+api_logger = logging.getLogger('api')
+
+# Параметры подключения к Lava API
+LAVA_API_URL = os.getenv('LAVA_API_URL', 'https://gate.lava.top')
+LAVA_CONNECT_TIMEOUT = float(os.getenv('LAVA_CONNECT_TIMEOUT', 3.05))
+LAVA_READ_TIMEOUT = float(os.getenv('LAVA_READ_TIMEOUT', 10))
+LAVA_MAX_RETRIES = int(os.getenv('LAVA_MAX_RETRIES', 3))
+LAVA_BACKOFF_BASE = float(os.getenv('LAVA_BACKOFF_BASE', 0.5))
+LAVA_BACKOFF_MAX = float(os.getenv('LAVA_BACKOFF_MAX', 8))
+LAVA_POOL_SIZE = int(os.getenv('LAVA_POOL_SIZE', 10))
+
+INVOICE_PATH = "/api/v2/invoice"
+# Получение инвойса по id для сверки статусов
+INVOICE_STATUS_PATH = os.getenv('LAVA_INVOICE_STATUS_PATH', "/api/v1/invoices/{payment_id}")
+
+# Статусы инвойса Lava -> статусы событий вебхука (остальные считаются неоплаченными)
+LAVA_STATUS_MAP = {
+    'PAID': 'PAID',
+    'COMPLETED': 'PAID',
+    'SUCCESS': 'PAID',
+    'SUBSCRIPTION-ACTIVE': 'PAID',
+    'CANCELED': 'CANCELED',
+    'CANCELLED': 'CANCELED',
+    'FAILED': 'CANCELED',
+    'EXPIRED': 'EXPIRED',
+}
+# Статус неоплаченного инвойса при сверке
+INVOICE_PENDING = 'PENDING'
+
+
+# Базовая логика клиента: запросы, разбор ответов и задержки повторов
+class _LavaClientBase:
+    def __init__(self, api_key, offer_id, base_url=LAVA_API_URL, max_retries=LAVA_MAX_RETRIES,
+                 backoff_base=LAVA_BACKOFF_BASE, backoff_max=LAVA_BACKOFF_MAX):
+        self.api_key = api_key
+        self.offer_id = offer_id
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def _headers(self):
+        return {
+            "X-Api-Key": self.api_key,
+            "Content-Type": "application/json"
+        }
+
+    def _invoice_payload(self, telegram_id):
+        # Используем точный формат из примера
+        return {
+            "email": f"{telegram_id}@t.me",  # Формат должен быть TELEGRAM_ID@t.me
+            "offerId": self.offer_id,
+            "periodicity": "MONTHLY",
+            "currency": "RUB",
+            "buyerLanguage": "RU",
+            "paymentMethod": "BANK131",
+            "clientUtm": {}
+        }
+
+    # Экспоненциальная задержка с "полным" джиттером, чтобы повторы разных
+    # пользователей не приходили в Lava одновременно
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # Разбор ответа на создание инвойса. Возвращает данные инвойса или None
+    def _parse_invoice_response(self, telegram_id, status_code, text, json_body):
+        api_logger.debug("Response status code: %s", status_code)
+        if status_code == 400:
+            api_logger.error("Bad Request: %s", text)
+            # Попробуем получить детали ошибки
+            try:
+                api_logger.error("Error details: %s", json_body())
+            except Exception:
+                pass
+            return None
+        elif status_code == 401:
+            api_logger.error("Authentication failed: Invalid API key or unauthorized access")
+            return None
+        elif status_code >= 400:
+            api_logger.error("Error creating Lava invoice: HTTP %s", status_code)
+            api_logger.error("Response body: %s", text)
+            return None
+        api_logger.debug("Lava API response: %s", text)
+        try:
+            data = json_body()
+        except ValueError as e:
+            api_logger.error("Invalid JSON in Lava API response: %s", e)
+            return None
+        api_logger.info("Successfully created invoice for user %s", telegram_id)
+        return data
+
+    # Результат создания инвойса в span-е: по payment_id трассу находят при разборе обращений
+    def _trace_invoice(self, lava_span, status_code, invoice):
+        lava_span.set_attribute('status_code', status_code)
+        if isinstance(invoice, dict) and invoice.get('id'):
+            lava_span.set_attribute('payment_id', invoice['id'])
+        elif status_code >= 400:
+            lava_span.set_error(f"HTTP {status_code}")
+
+    def _parse_status_response(self, payment_id, status_code, text, json_body):
+        if status_code == 404:
+            api_logger.warning("Lava invoice %s not found", payment_id)
+            return None
+        if status_code >= 400:
+            api_logger.error("Error getting Lava invoice %s: HTTP %s", payment_id, status_code)
+            api_logger.error("Response body: %s", text)
+            return None
+        try:
+            status = str(json_body().get('status', '')).upper()
+        except (ValueError, AttributeError) as e:
+            api_logger.error("Invalid JSON in Lava API response: %s", e)
+            return None
+        return LAVA_STATUS_MAP.get(status, INVOICE_PENDING)
+
+
+# Ошибка установки соединения: запрос до Lava не дошел
+def _is_connect_error(e):
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+# Клиент Lava API: keep-alive сессия с пулом соединений, таймауты на подключение
+# и чтение, повтор при сетевых ошибках и ответах 5xx. Неидемпотентные запросы (создание
+# инвойса) повторяются только при ошибке подключения: после таймаута чтения или 5xx
+# Lava могла уже создать инвойс, и повтор создал бы второй
+class LavaClient(_LavaClientBase):
+    def __init__(self, api_key, offer_id, connect_timeout=LAVA_CONNECT_TIMEOUT,
+                 read_timeout=LAVA_READ_TIMEOUT, pool_size=LAVA_POOL_SIZE, **kwargs):
+        super().__init__(api_key, offer_id, **kwargs)
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update(self._headers())
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _request(self, method, path, **kwargs):
+        url = self.base_url + path
+        idempotent = method in ('GET', 'HEAD')
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.max_retries or not (idempotent or _is_connect_error(e)):
+                    raise
+                api_logger.warning(
+                    "Lava API %s %s failed (%s), retry %s/%s", method, path, e, attempt + 1, self.max_retries
+                )
+            else:
+                if response.status_code < 500 or attempt >= self.max_retries or not idempotent:
+                    return response
+                api_logger.warning(
+                    "Lava API %s %s returned %s, retry %s/%s",
+                    method, path, response.status_code, attempt + 1, self.max_retries
+                )
+            time.sleep(self._backoff(attempt))
+
+    # Создание инвойса для пользователя. Возвращает данные инвойса или None
+    def create_invoice(self, telegram_id):
+        payload = self._invoice_payload(telegram_id)
+        api_logger.debug("Creating Lava invoice for user %s", telegram_id)
+        api_logger.debug("Request payload: %s", payload)
+        with span('lava.create_invoice', telegram_id=telegram_id) as lava_span:
+            with LAVA_REQUEST_SECONDS.time(operation='create_invoice'):
+                try:
+                    response = self._request("POST", INVOICE_PATH, json=payload)
+                except requests.exceptions.RequestException as e:
+                    api_logger.error("Error creating Lava invoice: %s", e)
+                    LAVA_REQUESTS.inc(operation='create_invoice', outcome='network_error')
+                    lava_span.set_error(e)
+                    return None
+            LAVA_REQUESTS.inc(operation='create_invoice', outcome=str(response.status_code))
+            invoice = self._parse_invoice_response(telegram_id, response.status_code, response.text, response.json)
+            self._trace_invoice(lava_span, response.status_code, invoice)
+            return invoice
+
+    # Статус инвойса в терминах вебхука: PAID, CANCELED, EXPIRED или PENDING.
+    # None, если статус получить не удалось
+    def get_invoice_status(self, payment_id):
+        path = INVOICE_STATUS_PATH.format(payment_id=payment_id)
+        with span('lava.get_invoice', payment_id=payment_id) as lava_span:
+            with LAVA_REQUEST_SECONDS.time(operation='get_invoice'):
+                try:
+                    response = self._request("GET", path)
+                except requests.exceptions.RequestException as e:
+                    api_logger.error("Error getting Lava invoice %s: %s", payment_id, e)
+                    LAVA_REQUESTS.inc(operation='get_invoice', outcome='network_error')
+                    lava_span.set_error(e)
+                    return None
+            LAVA_REQUESTS.inc(operation='get_invoice', outcome=str(response.status_code))
+            lava_span.set_attribute('status_code', response.status_code)
+            status = self._parse_status_response(payment_id, response.status_code, response.text, response.json)
+            lava_span.set_attribute('invoice_status', status)
+            return status
+
+    def close(self):
+        self.session.close()
+
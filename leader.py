@@ -0,0 +1,85 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from database import acquire_lease, release_lease
+
+logger = logging.getLogger('leader')
+
+# Срок аренды ведущего и интервал ее продления (секунды). Если ведущий процесс
+# завершится аварийно, его обязанности перейдут другому не позже чем через LEADER_LEASE_TTL
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', 30))
+LEADER_RENEW_INTERVAL = float(os.getenv('LEADER_RENEW_INTERVAL', 10))
+
+
+# Выбор ведущего процесса через аренду в базе (таблица leases).
+# Каждый процесс периодически пытается захватить или продлить аренду; получивший
+# ее вызывает on_elected, а потерявший (не смог продлить за ttl) - on_demoted
+class LeaderElection:
+    def __init__(self, name, on_elected, on_demoted, ttl=LEADER_LEASE_TTL, renew_interval=LEADER_RENEW_INTERVAL):
+        self.name = name
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.ttl = ttl
+        self.renew_interval = min(renew_interval, ttl / 3)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._renewed_at = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=f"leader-{self.name}", daemon=True)
+        self._thread.start()
+
+    # Остановка с освобождением аренды, чтобы другой процесс не ждал ее истечения
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.is_leader:
+            self._demote()
+            try:
+                release_lease(self.name, self.owner)
+            except Exception as e:
+                logger.error("Error releasing lease %s: %s", self.name, e)
+
+    def _elect(self):
+        self.is_leader = True
+        logger.info("Process %s became leader for %s", self.owner, self.name)
+        try:
+            self.on_elected()
+        except Exception as e:
+            logger.error("Error starting leader duties for %s: %s", self.name, e, exc_info=True)
+
+    def _demote(self):
+        self.is_leader = False
+        logger.warning("Process %s is no longer leader for %s", self.owner, self.name)
+        try:
+            self.on_demoted()
+        except Exception as e:
+            logger.error("Error stopping leader duties for %s: %s", self.name, e, exc_info=True)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                acquired = acquire_lease(self.name, self.owner, self.ttl)
+            except Exception as e:
+                logger.error("Error renewing lease %s: %s", self.name, e)
+                # Без связи с базой считаем себя ведущим, пока аренда не могла истечь
+                acquired = self.is_leader and time.monotonic() - self._renewed_at < self.ttl - self.renew_interval
+            else:
+                if acquired:
+                    self._renewed_at = time.monotonic()
+            if acquired and not self.is_leader:
+                self._elect()
+            elif not acquired and self.is_leader:
+                self._demote()
+            self._stopped.wait(self.renew_interval)
@@ -0,0 +1,121 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from tracing import TraceContextFilter
+
+# Настройки логирования из переменных окружения:
+# LOG_LEVEL - уровень корневого логгера, LOG_LEVELS - уровни отдельных логгеров
+# в формате "api=DEBUG,webhook=INFO", LOG_FORMAT - text или json
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+
+# trace_id - идентификатор трассы текущего обновления или вебхука (см. tracing.py), '-' вне трассы
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
+_listener = None
+_lock = threading.Lock()
+
+
+# Форматтер для структурированных логов: одна JSON-строка на запись
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        trace_id = getattr(record, 'trace_id', '-')
+        if trace_id != '-':
+            entry['trace_id'] = trace_id
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Пропускает только записи указанного логгера и его потомков
+class _LoggerNameFilter(logging.Filter):
+    def filter(self, record):
+        return record.name == self.name or record.name.startswith(self.name + '.')
+
+
+def _parse_levels(value):
+    levels = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _file_handler(filename, formatter, level=logging.NOTSET, backup_count=5, only=None):
+    handler = RotatingFileHandler(
+        os.path.join(LOG_DIR, filename),
+        maxBytes=5*1024*1024,  # 5 МБ
+        backupCount=backup_count,
+        encoding='utf-8'
+    )
+    handler.setLevel(level)
+    handler.setFormatter(formatter)
+    if only:
+        handler.addFilter(_LoggerNameFilter(only))
+    return handler
+
+
+# Общая настройка логирования для бота и вебхук-сервера.
+# Потоки приложения только кладут записи в очередь (QueueHandler), а запись в файлы
+# и консоль выполняет отдельный поток QueueListener. Повторный вызов ничего не делает
+def setup_logging():
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+
+        # Создаем директорию для логов, если она не существует
+        os.makedirs(LOG_DIR, exist_ok=True)
+
+        formatter = JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT)
+
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        handlers = [
+            # Основной лог (10 файлов по 5 МБ) и детальный лог
+            _file_handler('bot.log', formatter, logging.INFO, backup_count=10),
+            _file_handler('debug.log', formatter, logging.DEBUG),
+            console_handler,
+            # Отдельные файлы для запросов к API и для вебхуков
+            _file_handler('api.log', formatter, only='api'),
+            _file_handler('webhook.log', formatter, only='webhook'),
+        ]
+
+        log_queue = queue.SimpleQueue()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        # Идентификатор трассы берется в потоке, который пишет в лог
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(TraceContextFilter())
+        root.addHandler(queue_handler)
+        root.setLevel(LOG_LEVEL)
+        for name, level in _parse_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+
+# Остановка потока записи логов с выгрузкой оставшихся записей
+def stop_logging():
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
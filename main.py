@@ -2,368 +2,645 @@ import telebot
 from telebot.types import LabeledPrice, InlineKeyboardMarkup, InlineKeyboardButton
 import os
 from dotenv import load_dotenv
+import argparse
+import functools
 import logging
-from logging.handlers import RotatingFileHandler
 import time
-import sys
+from datetime import datetime
 import signal
-import sqlite3
-import requests
-import json
 import threading
-import uvicorn
-from webhook_server import app, set_bot_instance
-
-# Настройка логирования
-def setup_logging():
-    # Создаем директорию для логов, если она не существует
-    log_dir = 'logs'
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    
-    # Настройка основного логгера
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    
-    # Форматтер для логов
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
-    # Обработчик для файла с ротацией (10 файлов по 5 МБ)
-    file_handler = RotatingFileHandler(
-        os.path.join(log_dir, 'bot.log'), 
-        maxBytes=5*1024*1024,  # 5 МБ
-        backupCount=10
-    )
-    file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(formatter)
-    
-    # Обработчик для файла с детальными логами
-    debug_handler = RotatingFileHandler(
-        os.path.join(log_dir, 'debug.log'), 
-        maxBytes=5*1024*1024,  # 5 МБ
-        backupCount=5
-    )
-    debug_handler.setLevel(logging.DEBUG)
-    debug_handler.setFormatter(formatter)
-    
-    # Обработчик для консоли
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.DEBUG)
-    console_handler.setFormatter(formatter)
-    
-    # Добавляем обработчики к логгеру
-    logger.addHandler(file_handler)
-    logger.addHandler(debug_handler)
-    logger.addHandler(console_handler)
-    
-    # Отдельный логгер для запросов к API
-    api_logger = logging.getLogger('api')
-    api_file_handler = RotatingFileHandler(
-        os.path.join(log_dir, 'api.log'), 
-        maxBytes=5*1024*1024,
-        backupCount=5
-    )
-    api_file_handler.setFormatter(formatter)
-    api_logger.addHandler(api_file_handler)
-    api_logger.setLevel(logging.DEBUG)
-    
-    return logger, api_logger
-
-# Инициализация логгеров
-logger, api_logger = setup_logging()
 
-# Загрузка переменных окружения из файла .env
+# Загрузка переменных окружения из файла .env до импорта модулей, читающих настройки
 load_dotenv()
-TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-if not TOKEN:
-    logger.critical("No TELEGRAM_BOT_TOKEN provided")
-    raise ValueError("No TELEGRAM_BOT_TOKEN provided")
 
-PRIVATE_CHANNEL_ID = os.getenv('PRIVATE_CHANNEL_ID')
-if not PRIVATE_CHANNEL_ID:
-    logger.critical("No PRIVATE_CHANNEL_ID provided")
-    raise ValueError("No PRIVATE_CHANNEL_ID provided")
+# Роли процесса: all - все в одном процессе (по умолчанию), web - только веб-сервер
+# (вебхуки Lava и Telegram, метрики), bot - прием обновлений Telegram, scheduler -
+# фоновые задачи (outbox, рассылки, пул ссылок, истечение подписок, сверка, обслуживание базы)
+ROLES = ('all', 'web', 'bot', 'scheduler')
+WEB_ROLES = ('all', 'web')
 
-LAVA_API_KEY = os.getenv('LAVA_API_KEY')
-if not LAVA_API_KEY:
-    logger.critical("No LAVA_API_KEY provided")
-    raise ValueError("No LAVA_API_KEY provided")
+def parse_args():
+    parser = argparse.ArgumentParser(description="BuryatFilms subscription bot")
+    parser.add_argument('--role', choices=ROLES, default=os.getenv('APP_ROLE', 'all'),
+                        help="process role (default: APP_ROLE or all)")
+    return parser.parse_args()
+
+# Роль задается аргументом --role или переменной APP_ROLE. Аргумент переносится в окружение,
+# чтобы его получили и воркеры uvicorn, заново импортирующие этот модуль
+if __name__ == "__main__":
+    os.environ['APP_ROLE'] = parse_args().role
+APP_ROLE = os.getenv('APP_ROLE', 'all')
+
+from log_config import setup_logging
+from lava_client import LavaClient
+from dispatcher import (init_dispatcher, PRIORITY_LOW, TELEGRAM_GLOBAL_RATE, TELEGRAM_WEB_RATE,
+                        TELEGRAM_PER_CHAT_RATE, TELEGRAM_RESULT_TIMEOUT)
+from database import init_db
+from subscribers import subscriber_index
+from broadcast import start_broadcast
+from stats import build_stats, format_stats, STATS_DAYS
+from leader import LeaderElection
+from invoices import invoice_cache
+from metrics import EXPIRY_REMOVALS, EXPIRY_SWEEP_SECONDS, timed
+from tracing import start_trace, traced
+
+logger = logging.getLogger('bot')
 
+TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+PRIVATE_CHANNEL_ID = os.getenv('PRIVATE_CHANNEL_ID')
+LAVA_API_KEY = os.getenv('LAVA_API_KEY')
 LAVA_OFFER_ID = os.getenv('LAVA_OFFER_ID')
-if not LAVA_OFFER_ID:
-    logger.critical("No LAVA_OFFER_ID provided")
-    raise ValueError("No LAVA_OFFER_ID provided")
 
 # Получаем порт для веб-сервера из переменных окружения или используем порт по умолчанию
 PORT = int(os.getenv('PORT', 8000))
 
-# Путь к базе данных (для Amvera используем постоянное хранилище)
-DB_PATH = os.path.join('data', os.getenv('DATABASE', 'subscribers.db'))
-os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+# Способ получения обновлений Telegram: polling (по умолчанию) или webhook.
+# В режиме webhook обновления приходят на /webhook/telegram того же FastAPI приложения
+TELEGRAM_UPDATE_MODE = os.getenv('TELEGRAM_UPDATE_MODE', 'polling')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+# Размер пула потоков, в котором выполняются обработчики сообщений
+TELEGRAM_HANDLER_THREADS = int(os.getenv('TELEGRAM_HANDLER_THREADS', 8))
+# Адрес Bot API (например, локальный telegram-bot-api сервер); по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 
-logger.info("Environment variables loaded successfully")
+# Параметры обработки истекших подписок: размер порции, через сколько секунд
+# незавершенное удаление захватывается повторно и сколько всего попыток делается
+EXPIRY_CHUNK_SIZE = int(os.getenv('EXPIRY_CHUNK_SIZE', 200))
+EXPIRY_CLAIM_TIMEOUT = int(os.getenv('EXPIRY_CLAIM_TIMEOUT', 600))
+EXPIRY_MAX_ATTEMPTS = int(os.getenv('EXPIRY_MAX_ATTEMPTS', 5))
 
-# Инициализация бота
-bot = telebot.TeleBot(TOKEN)
-logger.info("Telegram bot initialized")
+# Как часто (в минутах) сверять неоплаченные инвойсы со статусами в Lava
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', 30))
+# Час (по времени сервера) ежедневного обслуживания базы: архивация и incremental_vacuum
+MAINTENANCE_HOUR = int(os.getenv('MAINTENANCE_HOUR', 4))
 
-# Инициализация базы данных
-def init_db():
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscribers (
-            telegram_id TEXT PRIMARY KEY,
-            payment_id TEXT,
-            status TEXT,
-            expiry_date TEXT
-        )
-        ''')
-        conn.commit()
-        conn.close()
-        logger.info(f"Database initialized successfully at {DB_PATH}")
-    except Exception as e:
-        logger.error(f"Error initializing database: {e}")
-        raise
+# Число процессов веб-сервера. Фоновые задачи и прием обновлений Telegram выполняют
+# ведущие процессы, выбранные через аренду в базе (см. leader.py)
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', 1))
+# Как часто процесс перечитывает индекс подписчиков из базы, если подписчиков
+# меняют и другие процессы (WEB_WORKERS > 1 или роли в отдельных процессах)
+SUBSCRIBER_INDEX_REFRESH = int(os.getenv('SUBSCRIBER_INDEX_REFRESH', 60))
+
+# Задержка перед перезапуском упавшего polling: растет от POLLING_RESTART_MIN вдвое
+# до POLLING_RESTART_MAX и сбрасывается, если polling проработал дольше POLLING_RESTART_MAX
+POLLING_RESTART_MIN = float(os.getenv('POLLING_RESTART_MIN', 1))
+POLLING_RESTART_MAX = float(os.getenv('POLLING_RESTART_MAX', 30))
+
+# Пул потоков обработчиков нужен только процессам, получающим обновления:
+# ролям all и bot, а в режиме webhook - и роли web
+HANDLES_UPDATES = APP_ROLE in ('all', 'bot') or (APP_ROLE == 'web' and TELEGRAM_UPDATE_MODE == 'webhook')
+
+# Бот, очередь исходящих сообщений и клиент Lava создаются в init_process
+bot = None
+dispatcher = None
+lava_client = None
+
+# Проверка обязательных настроек: ошибка в логе и ValueError
+def _validate_settings():
+    errors = []
+    if APP_ROLE not in ROLES:
+        errors.append(f"Unknown APP_ROLE: {APP_ROLE}")
+    for name, value in (('TELEGRAM_BOT_TOKEN', TOKEN), ('PRIVATE_CHANNEL_ID', PRIVATE_CHANNEL_ID),
+                        ('LAVA_API_KEY', LAVA_API_KEY), ('LAVA_OFFER_ID', LAVA_OFFER_ID)):
+        if not value:
+            errors.append(f"No {name} provided")
+    if TELEGRAM_UPDATE_MODE not in ('polling', 'webhook'):
+        errors.append(f"Unknown TELEGRAM_UPDATE_MODE: {TELEGRAM_UPDATE_MODE}")
+    elif TELEGRAM_UPDATE_MODE == 'webhook' and not TELEGRAM_WEBHOOK_SECRET:
+        errors.append("No TELEGRAM_WEBHOOK_SECRET provided for webhook mode")
+    for error in errors:
+        logger.critical(error)
+    if errors:
+        raise ValueError(errors[0])
+
+# Настройка логирования (общая для всех ролей) и проверка настроек. Только это нужно
+# и родительскому процессу uvicorn при WEB_WORKERS > 1, который лишь управляет воркерами
+_settings_checked = False
+
+def init_settings():
+    global _settings_checked
+    if _settings_checked:
+        return
+    setup_logging()
+    _validate_settings()
+    logger.info("Environment variables loaded successfully")
+    _settings_checked = True
+
+# Инициализация процесса: логирование, проверка настроек, бот с обработчиками,
+# очередь Telegram и клиент Lava. Импорт модуля ничего не создает, поэтому воркеры
+# uvicorn, повторно импортирующие main.py, не получают второй экземпляр бота и пулов
+def init_process():
+    global bot, dispatcher, lava_client
+    if bot is not None:
+        return
+    init_settings()
+    
+    if TELEGRAM_API_URL:
+        telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+    
+    # Инициализация бота и регистрация обработчиков
+    new_bot = telebot.TeleBot(TOKEN, threaded=HANDLES_UPDATES, num_threads=TELEGRAM_HANDLER_THREADS)
+    new_bot.register_message_handler(welcome, commands=['start'])
+    new_bot.register_message_handler(broadcast, commands=['broadcast'])
+    new_bot.register_message_handler(stats, commands=['stats'])
+    new_bot.register_message_handler(handle_text, content_types=['text'])
+    logger.info("Telegram bot initialized")
+    
+    # Очередь исходящих сообщений с учетом лимитов Telegram (запускается в setup_process)
+    dispatcher = init_dispatcher(new_bot, global_rate=telegram_rate(()))
+    
+    # Клиент Lava API с пулом keep-alive соединений, таймаутами и повторами
+    lava_client = LavaClient(LAVA_API_KEY, LAVA_OFFER_ID)
+    bot = new_bot
+
+# Лимит очереди Telegram для процесса по выполняемым обязанностям ведущего. При нескольких
+# воркерах веб-сервера TELEGRAM_WEB_RATE для ответов пользователям получает процесс,
+# принимающий обновления: в режиме polling - ведущий 'bot', в режиме webhook обновления
+# приходят любому воркеру, и лимит делится между ними. Ведущий 'scheduler' (рассылки,
+# истечение подписок, outbox) получает остаток общего лимита. Процесс без отправок
+# сохраняет минимальный лимит для редких вызовов. Отдельные процессы и единственный
+# воркер используют весь TELEGRAM_GLOBAL_RATE
+def telegram_rate(duties):
+    if APP_ROLE not in WEB_ROLES or WEB_WORKERS == 1:
+        return TELEGRAM_GLOBAL_RATE
+    rate = 0
+    if TELEGRAM_UPDATE_MODE == 'webhook':
+        rate += TELEGRAM_WEB_RATE / WEB_WORKERS
+    elif 'bot' in duties:
+        rate += TELEGRAM_WEB_RATE
+    if 'scheduler' in duties:
+        rate += TELEGRAM_GLOBAL_RATE - TELEGRAM_WEB_RATE
+    return rate or TELEGRAM_PER_CHAT_RATE
 
 # Функция для создания инвойса в Lava API
 def create_lava_invoice(telegram_id):
-    url = "https://gate.lava.top/api/v2/invoice"
-    headers = {
-        "X-Api-Key": LAVA_API_KEY,
-        "Content-Type": "application/json"
-    }
-    
-    # Используем точный формат из примера
-    payload = {
-        "email": f"{telegram_id}@t.me",  # Формат должен быть TELEGRAM_ID@t.me
-        "offerId": LAVA_OFFER_ID,
-        "periodicity": "MONTHLY",
-        "currency": "RUB",  # Изменено на RUB вместо USD
-        "buyerLanguage": "RU",
-        "paymentMethod": "BANK131",
-        "clientUtm": {}
-    }
-    
-    api_logger.debug(f"Creating Lava invoice for user {telegram_id}")
-    api_logger.debug(f"Request payload: {json.dumps(payload)}")
-    api_logger.debug(f"Using X-Api-Key header for authentication")
-    
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        api_logger.debug(f"Response status code: {response.status_code}")
-        
-        if response.status_code == 400:
-            api_logger.error(f"Bad Request: {response.text}")
-            # Попробуем получить детали ошибки
-            try:
-                error_details = response.json()
-                api_logger.error(f"Error details: {json.dumps(error_details)}")
-            except:
-                pass
-            return None
-        elif response.status_code == 401:
-            api_logger.error("Authentication failed: Invalid API key or unauthorized access")
-            return None
-            
-        response.raise_for_status()
-        api_logger.debug(f"Lava API response: {response.text}")
-        api_logger.info(f"Successfully created invoice for user {telegram_id}")
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        api_logger.error(f"Error creating Lava invoice: {e}")
-        if hasattr(e, 'response') and e.response:
-            api_logger.error(f"Response status: {e.response.status_code}")
-            api_logger.error(f"Response body: {e.response.text}")
-        return None
+    return lava_client.create_invoice(telegram_id)
+
+# Трассировка обработчика: каждое обновление Telegram - отдельная трасса,
+# ее идентификатор попадает во все записи логов обработки
+def traced_update(name):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(message):
+            with start_trace(name, user_id=message.from_user.id):
+                return handler(message)
+        return wrapper
+    return decorator
 
 # Обработчик команды /start
-@bot.message_handler(commands=['start'])
+@traced_update('bot.start')
 def welcome(message):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
-    logger.info(f"User {user_id} (@{username}) started the bot")
+    logger.info("User %s (@%s) started the bot", user_id, username)
     
     if message.chat.type == 'private':
         keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
         button_buy = telebot.types.KeyboardButton(text="✅ Оплатить доступ")
         keyboard.add(button_buy)
-        bot.send_message(
+        dispatcher.send_message(
             message.chat.id,
             'Приветствую! '
             'Я помогу Вам получить доступ в платный канал BuryatFilms.',
             reply_markup=keyboard
         )
-        logger.debug(f"Sent welcome message to user {user_id}")
+        logger.debug("Queued welcome message to user %s", user_id)
+
+# Проверка, что команду отправил администратор
+def is_admin(message):
+    return str(message.from_user.id) == str(os.getenv('ADMIN_TELEGRAM_ID'))
+
+# Обработчик команды /broadcast <текст> - рассылка всем активным подписчикам (только администратор)
+@traced_update('bot.broadcast')
+def broadcast(message):
+    user_id = message.from_user.id
+    if not is_admin(message):
+        logger.warning("User %s tried to start a broadcast", user_id)
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    text = parts[1] if len(parts) > 1 else ''
+    if not text:
+        dispatcher.send_message(message.chat.id, "Использование: /broadcast <текст сообщения>")
+        return
+    
+    broadcast_id = start_broadcast(text)
+    logger.info("Admin %s started broadcast %s", user_id, broadcast_id)
+    dispatcher.send_message(
+        message.chat.id,
+        f"Рассылка #{broadcast_id} запущена. По завершении придет отчет."
+    )
+
+# Обработчик команды /stats [дни] - сводка по подпискам (только администратор)
+@traced_update('bot.stats')
+def stats(message):
+    if not is_admin(message):
+        logger.warning("User %s requested stats", message.from_user.id)
+        return
+    
+    parts = message.text.split()
+    days = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else STATS_DAYS
+    try:
+        text = format_stats(build_stats(days))
+    except Exception as e:
+        logger.error("Error building stats: %s", e, exc_info=True)
+        text = "Не удалось получить статистику. Попробуйте позже."
+    dispatcher.send_message(message.chat.id, text)
 
 # Обработчик текстовых сообщений
-@bot.message_handler(content_types=['text'])
+@traced_update('bot.text')
 def handle_text(message):
     user_id = message.from_user.id
     text = message.text
-    logger.debug(f"Received text message from user {user_id}: {text}")
+    logger.debug("Received text message from user %s: %s", user_id, text)
     
     if message.text == "✅ Оплатить доступ":
-        logger.info(f"User {user_id} requested payment")
+        logger.info("User %s requested payment", user_id)
         process_payment(message)
 
 # Функция обработки оплаты
 def process_payment(message):
     telegram_id = message.from_user.id
-    logger.info(f"Processing payment for user {telegram_id}")
+    logger.info("Processing payment for user %s", telegram_id)
     
-    invoice_data = create_lava_invoice(telegram_id)
+    # Активному подписчику новый инвойс не выдается, чтобы он не оплатил дважды.
+    # Статус читается из базы, если оплату мог обработать другой процесс
+    subscriber = subscriber_index.get_fresh(telegram_id)
+    if subscriber is not None and subscriber.is_active():
+        logger.info("User %s already has an active subscription, skipping invoice", telegram_id)
+        expiry_date = datetime.fromtimestamp(subscriber.expiry_date).strftime('%Y-%m-%d %H:%M:%S')
+        dispatcher.send_message(
+            message.chat.id,
+            f"У Вас уже есть активная подписка до {expiry_date}. Повторная оплата не требуется."
+        )
+        return
+    
+    # Повторное нажатие возвращает еще действующий инвойс без обращения к Lava
+    invoice_data = invoice_cache.get_or_create(telegram_id, create_lava_invoice)
     
     if invoice_data and 'paymentUrl' in invoice_data:
         payment_url = invoice_data['paymentUrl']
-        payment_id = invoice_data.get('id', 'unknown')
-        logger.info(f"Created invoice {payment_id} for user {telegram_id}")
-        
-        # Сохраняем информацию о платеже в базу данных
-        try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO subscribers (telegram_id, payment_id, status) VALUES (?, ?, ?)",
-                (str(telegram_id), payment_id, "pending")
-            )
-            conn.commit()
-            conn.close()
-            logger.debug(f"Saved payment info to database for user {telegram_id}")
-        except Exception as e:
-            logger.error(f"Error saving payment info to database: {e}")
+        payment_id = invoice_data.get('id')
+        logger.info("Using invoice %s for user %s", payment_id, telegram_id)
         
         # Создаем инлайн-клавиатуру с кнопкой для оплаты
         keyboard = InlineKeyboardMarkup()
         payment_button = InlineKeyboardButton(text="Перейти к оплате", url=payment_url)
         keyboard.add(payment_button)
         
-        bot.send_message(
+        dispatcher.send_message(
             message.chat.id,
             "Для оплаты доступа к каналу, пожалуйста, нажмите на кнопку ниже:",
             reply_markup=keyboard
         )
-        logger.debug(f"Sent payment button to user {telegram_id}")
+        logger.debug("Queued payment button to user %s", telegram_id)
     else:
-        logger.error(f"Failed to create invoice for user {telegram_id}")
-        bot.send_message(
+        logger.error("Failed to create invoice for user %s", telegram_id)
+        dispatcher.send_message(
             message.chat.id,
             "Извините, произошла ошибка при создании платежа. Пожалуйста, попробуйте позже."
         )
 
-# Функция для проверки и удаления пользователей с истекшей подпиской
+# Обработка порции захваченных истекших подписок: удаление из канала идет параллельно
+# через очередь Telegram, результат по каждому пользователю записывается в базу.
+# Исключение (kick) и снятие бана (unban, чтобы пользователь мог вернуться после оплаты) -
+# отдельные задачи очереди: каждая расходует свой токен лимита, а ответ 429 на unban
+# повторяет только unban. Возвращает (число успешно удаленных, число неудачных)
+def remove_expired_users(expired_users):
+    kicks = {}
+    for telegram_id in expired_users:
+        logger.info("Processing expired subscription for user %s", telegram_id)
+        kicks[telegram_id] = dispatcher.submit(
+            bot.kick_chat_member, PRIVATE_CHANNEL_ID, telegram_id, priority=PRIORITY_LOW
+        )
+    
+    failed = []
+    unbans = {}
+    for telegram_id, future in kicks.items():
+        try:
+            future.result(timeout=TELEGRAM_RESULT_TIMEOUT)
+        except Exception as e:
+            logger.error("Error removing user %s from channel: %s", telegram_id, e)
+            failed.append(telegram_id)
+            continue
+        logger.debug("Kicked user %s from channel", telegram_id)
+        unbans[telegram_id] = dispatcher.submit(
+            bot.unban_chat_member, PRIVATE_CHANNEL_ID, telegram_id, priority=PRIORITY_LOW
+        )
+    
+    succeeded = []
+    for telegram_id, future in unbans.items():
+        try:
+            future.result(timeout=TELEGRAM_RESULT_TIMEOUT)
+        except Exception as e:
+            logger.error("Error unbanning user %s in channel: %s", telegram_id, e)
+            failed.append(telegram_id)
+            continue
+        logger.debug("Unbanned user %s from channel", telegram_id)
+        succeeded.append(telegram_id)
+        dispatcher.send_message(
+            telegram_id,
+            "Ваша подписка истекла. Для продления доступа, пожалуйста, оплатите подписку снова.",
+            priority=PRIORITY_LOW
+        )
+        logger.debug("Queued expiration notification to user %s", telegram_id)
+    
+    gave_up = subscriber_index.finish_expiry(succeeded, failed, EXPIRY_MAX_ATTEMPTS)
+    for telegram_id in gave_up:
+        logger.error("Giving up removing user %s from channel after %s attempts", telegram_id, EXPIRY_MAX_ATTEMPTS)
+    EXPIRY_REMOVALS.inc(len(succeeded), outcome='removed')
+    EXPIRY_REMOVALS.inc(len(failed) - len(gave_up), outcome='retry')
+    EXPIRY_REMOVALS.inc(len(gave_up), outcome='gave_up')
+    return len(succeeded), len(failed)
+
+# Обработка подписок, истечение которых наступило по планировщику
+@traced('expiry.due')
+def handle_due_expiries(telegram_ids):
+    try:
+        # Захватываются только подписки, которые не были продлены в последний момент
+        remove_expired_users(subscriber_index.claim_subscribers(telegram_ids))
+    except Exception as e:
+        logger.error("Error processing due expiries: %s", e)
+
+# Функция для проверки и удаления пользователей с истекшей подпиской.
+# Основную работу делает планировщик истечений, полная проверка - страховка.
+# Подписки захватываются порциями по EXPIRY_CHUNK_SIZE, поэтому память не зависит
+# от их числа, а неудачные удаления повторяются следующими проверками
+@traced('expiry.sweep')
+@timed(EXPIRY_SWEEP_SECONDS)
 def check_expired_subscriptions():
     logger.info("Checking for expired subscriptions")
+    removed = failed = 0
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Находим пользователей с истекшей подпиской
-        cursor.execute(
-            "SELECT telegram_id FROM subscribers WHERE status = 'active' AND expiry_date < datetime('now')"
-        )
-        expired_users = cursor.fetchall()
-        
-        if expired_users:
-            logger.info(f"Found {len(expired_users)} expired subscriptions")
-        else:
-            logger.info("No expired subscriptions found")
-        
-        # Обновляем статус
-        cursor.execute(
-            "UPDATE subscribers SET status = 'expired' WHERE status = 'active' AND expiry_date < datetime('now')"
-        )
-        conn.commit()
-        conn.close()
-        
-        # Удаляем пользователей из канала
-        for user in expired_users:
-            telegram_id = user[0]
-            logger.info(f"Processing expired subscription for user {telegram_id}")
-            try:
-                bot.kick_chat_member(PRIVATE_CHANNEL_ID, telegram_id)
-                logger.debug(f"Kicked user {telegram_id} from channel")
-                bot.unban_chat_member(PRIVATE_CHANNEL_ID, telegram_id)
-                logger.debug(f"Unbanned user {telegram_id} from channel")
-                bot.send_message(
-                    telegram_id,
-                    "Ваша подписка истекла. Для продления доступа, пожалуйста, оплатите подписку снова."
-                )
-                logger.debug(f"Sent expiration notification to user {telegram_id}")
-            except Exception as e:
-                logger.error(f"Error removing user {telegram_id} from channel: {e}")
+        # Подписки, процесс которых упал во время последней попытки удаления
+        for telegram_id in subscriber_index.abandon_stale_expiries(EXPIRY_CLAIM_TIMEOUT, EXPIRY_MAX_ATTEMPTS):
+            logger.error("Giving up removing user %s from channel after %s attempts", telegram_id, EXPIRY_MAX_ATTEMPTS)
+            EXPIRY_REMOVALS.inc(outcome='gave_up')
+        while True:
+            expired_users = subscriber_index.claim_expired_subscribers(EXPIRY_CHUNK_SIZE, EXPIRY_CLAIM_TIMEOUT, EXPIRY_MAX_ATTEMPTS)
+            if not expired_users:
+                break
+            logger.info("Claimed %s expired subscriptions", len(expired_users))
+            
+            # Удаляем пользователей из канала
+            chunk_removed, chunk_failed = remove_expired_users(expired_users)
+            removed += chunk_removed
+            failed += chunk_failed
     except Exception as e:
-        logger.error(f"Error checking expired subscriptions: {e}")
+        logger.error("Error checking expired subscriptions: %s", e)
+    
+    if removed or failed:
+        logger.info("Expired subscriptions processed: %s removed, %s failed", removed, failed)
+    else:
+        logger.info("No expired subscriptions found")
 
-# Обработчик сигнала для корректного завершения работы
+# Остановка процесса без веб-сервера (роли bot и scheduler)
+_stop_event = threading.Event()
+
+# Обработчик сигнала для корректного завершения работы: аренды ведущего
+# освобождаются, чтобы после перезапуска или редеплоя новый процесс не ждал их истечения
 def signal_handler(sig, frame):
-    logger.info("Program interrupted by user.")
-    sys.exit(0)
+    logger.info("Received %s, shutting down", signal.Signals(sig).name)
+    _stop_event.set()
 
-# Основное тело скрипта
-def main():
-    logger.info("Starting application")
-    
-    # Инициализация базы данных
-    init_db()
-    
-    # Настройка планировщика для проверки истекших подписок
-    from apscheduler.schedulers.background import BackgroundScheduler
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(check_expired_subscriptions, 'interval', hours=24)
-    scheduler.start()
-    logger.info("Scheduler started")
-    
-    # Передаем экземпляр бота в FastAPI приложение
-    set_bot_instance(bot, PRIVATE_CHANNEL_ID)
-    logger.info("Bot instance set for webhook server")
-    
-    # Получаем публичный URL для вебхука из переменных окружения
-    # Для Amvera используем автоматически сгенерированный URL
+# Публичный URL сервиса из переменных окружения.
+# Для Amvera используем автоматически сгенерированный URL
+def get_public_url():
     public_url = os.getenv('PUBLIC_URL')
     if not public_url:
         # Если PUBLIC_URL не задан, пытаемся получить его из переменных окружения Amvera
         amvera_app_host = os.getenv('AMVERA_APP_HOST')
         if amvera_app_host:
             public_url = f"https://{amvera_app_host}"
-            logger.info(f"Using Amvera host as public URL: {public_url}")
+    return public_url
+
+# Получение обновлений Telegram через long polling, пока процесс остается ведущим
+def run_polling(stop_event):
+    # Вебхук мог остаться от запуска в режиме webhook - без его удаления getUpdates не работает
+    try:
+        bot.remove_webhook()
+    except Exception as e:
+        logger.error("Error removing Telegram webhook: %s", e)
+    
+    delay = POLLING_RESTART_MIN
+    while not stop_event.is_set():
+        started = time.monotonic()
+        try:
+            logger.info("Starting bot polling...")
+            bot.polling(none_stop=True, timeout=25)
+        except Exception as e:
+            logger.error("Bot stopped with an error: %s", e, exc_info=True)
+            # Единичный сбой после долгой работы перезапускается почти сразу,
+            # а при постоянных ошибках ожидание растет, чтобы не перезапускаться часто
+            if time.monotonic() - started > POLLING_RESTART_MAX:
+                delay = POLLING_RESTART_MIN
+            logger.info("Waiting %.0f seconds before restart", delay)
+            stop_event.wait(delay)
+            delay = min(delay * 2, POLLING_RESTART_MAX)
+
+# Остановка запущенных обязанностей ведущего процесса по имени аренды
+_leader_stoppers = {}
+
+# Пересчет лимита очереди Telegram по обязанностям, выполняемым сейчас. При остановке
+# обязанность удаляется из _leader_stoppers до вызова ее функций остановки
+def _update_telegram_rate():
+    rate = telegram_rate(_leader_stoppers.keys())
+    if rate != dispatcher.rate:
+        dispatcher.set_rate(rate)
+
+def _stop_leader_services(name):
+    stoppers = _leader_stoppers.pop(name, [])
+    while stoppers:
+        try:
+            stoppers.pop()()
+        except Exception as e:
+            logger.error("Error stopping leader service: %s", e)
+
+# Фоновые задачи, которые должны выполняться ровно в одном экземпляре.
+# Их модули импортируются здесь, чтобы процессы других ролей их не загружали
+def start_scheduler_services():
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from archive import run_maintenance
+    from broadcast import init_broadcast_engine
+    from expiry import init_expiry_scheduler
+    from invite_links import init_invite_pool
+    from notifications import init_notifications
+    from outbox import init_outbox_worker
+    from reconcile import InvoiceReconciler
+    stoppers = _leader_stoppers.setdefault('scheduler', [])
+    
+    # Массовые отправки идут из этого процесса: ему отдается остаток общего лимита
+    _update_telegram_rate()
+    stoppers.append(_update_telegram_rate)
+    
+    # Доставка уведомлений об оплате из outbox
+    init_notifications(bot, PRIVATE_CHANNEL_ID)
+    outbox_worker = init_outbox_worker(admin_id=os.getenv('ADMIN_TELEGRAM_ID'))
+    outbox_worker.start()
+    stoppers.append(outbox_worker.stop)
+    
+    # Рассылки администратора (продолжает прерванную рассылку после перезапуска)
+    broadcast_engine = init_broadcast_engine(admin_id=os.getenv('ADMIN_TELEGRAM_ID'))
+    broadcast_engine.start()
+    stoppers.append(broadcast_engine.stop)
+    
+    # Пул готовых ссылок-приглашений для мгновенной выдачи после оплаты
+    invite_pool = init_invite_pool(bot, PRIVATE_CHANNEL_ID)
+    invite_pool.start()
+    stoppers.append(invite_pool.stop)
+    
+    # Планировщик точного истечения подписок
+    expiry_scheduler = init_expiry_scheduler(handle_due_expiries)
+    expiry_scheduler.start()
+    stoppers.append(expiry_scheduler.stop)
+    
+    # Настройка планировщика для страховочной проверки истекших подписок
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(check_expired_subscriptions, 'interval', hours=1)
+    # Сверка со статусами Lava на случай потерянных вебхуков
+    scheduler.add_job(InvoiceReconciler(lava_client).run, 'interval', minutes=RECONCILE_INTERVAL)
+    # Архивация старых записей и возврат свободного места в базе
+    scheduler.add_job(run_maintenance, 'cron', hour=MAINTENANCE_HOUR)
+    scheduler.start()
+    stoppers.append(lambda: scheduler.shutdown(wait=False))
+    logger.info("Scheduler started")
+
+def stop_scheduler_services():
+    _stop_leader_services('scheduler')
+
+# Прием обновлений Telegram: polling в этом процессе или установка вебхука
+def start_bot_services():
+    stoppers = _leader_stoppers.setdefault('bot', [])
+    # В режиме polling ответы пользователям отправляет этот процесс
+    _update_telegram_rate()
+    stoppers.append(_update_telegram_rate)
+    public_url = get_public_url()
+    if TELEGRAM_UPDATE_MODE == 'webhook':
+        # Обновления Telegram приходят на /webhook/telegram любого воркера
+        telegram_webhook_url = f"{public_url}/webhook/telegram"
+        bot.remove_webhook()
+        bot.set_webhook(url=telegram_webhook_url, secret_token=TELEGRAM_WEBHOOK_SECRET)
+        logger.info("Telegram webhook set to %s", telegram_webhook_url)
+    else:
+        stop_polling = threading.Event()
+        threading.Thread(target=run_polling, args=(stop_polling,), name="telegram-polling", daemon=True).start()
+        stoppers.append(bot.stop_polling)
+        stoppers.append(stop_polling.set)
     
     if public_url:
         webhook_url = f"{public_url}/webhook/lava"
-        logger.info(f"Webhook URL: {webhook_url}")
+        logger.info("Webhook URL: %s", webhook_url)
         
         # Отправляем URL администратору бота
         admin_id = os.getenv('ADMIN_TELEGRAM_ID')
         if admin_id:
             try:
-                bot.send_message(admin_id, f"Бот запущен. URL для вебхука Lava API: {webhook_url}")
+                dispatcher.send_message(admin_id, f"Бот запущен. URL для вебхука Lava API: {webhook_url}")
             except Exception as e:
-                logger.error(f"Error sending webhook URL to admin: {e}")
+                logger.error("Error sending webhook URL to admin: %s", e)
     else:
         logger.warning("PUBLIC_URL not set and AMVERA_APP_HOST not found. Webhook URL will not be available.")
+
+def stop_bot_services():
+    _stop_leader_services('bot')
+
+# Обязанности ведущего по имени аренды: каждую выполняет один процесс из всех,
+# участвующих в выборе (см. leader.py), и какие аренды разыгрывает процесс каждой роли
+LEADER_DUTIES = {
+    'bot': (start_bot_services, stop_bot_services),
+    'scheduler': (start_scheduler_services, stop_scheduler_services),
+}
+ROLE_DUTIES = {
+    'all': ('bot', 'scheduler'),
+    'web': (),
+    'bot': ('bot',),
+    'scheduler': ('scheduler',),
+}
+
+# Подготовка процесса любой роли: база, индекс подписчиков, очередь Telegram
+# и участие в выборе ведущего. Возвращает список выборов для остановки
+def setup_process():
+    init_process()
     
-    # Запуск FastAPI в отдельном потоке
-    webhook_thread = threading.Thread(
-        target=uvicorn.run,
-        args=(app,),
-        kwargs={"host": "0.0.0.0", "port": PORT},
-        daemon=True
-    )
-    webhook_thread.start()
-    logger.info(f"Webhook server started on port {PORT}")
+    # Инициализация базы данных
+    init_db()
     
-    while True:
-        try:
-            logger.info("Starting bot polling...")
-            bot.polling(none_stop=True, timeout=25)
-        except Exception as e:
-            logger.error(f"Bot stopped with an error: {e}", exc_info=True)
-            # Ожидание перед перезапуском,
-            # чтобы избежать частых перезапусков при постоянных ошибках
-            logger.info("Waiting 5 seconds before restart")
-            time.sleep(5)
+    # Загрузка состояния подписчиков в память. Если подписчиков меняют и другие процессы
+    # (несколько воркеров или роли в отдельных процессах), индекс периодически перечитывается
+    subscriber_index.load()
+    if WEB_WORKERS > 1 or APP_ROLE != 'all':
+        subscriber_index.start_refresh(SUBSCRIBER_INDEX_REFRESH)
+    
+    # Запуск очереди исходящих сообщений Telegram
+    dispatcher.start()
+    
+    elections = []
+    for name in ROLE_DUTIES[APP_ROLE]:
+        election = LeaderElection(name, *LEADER_DUTIES[name])
+        election.start()
+        elections.append(election)
+    return elections
+
+# Фабрика FastAPI приложения для ролей all и web (воркеры uvicorn при WEB_WORKERS > 1
+# и app.py). FastAPI и вебхук-сервер загружаются только здесь
+def create_worker_app():
+    init_process()
+    if APP_ROLE not in WEB_ROLES:
+        logger.critical("APP_ROLE=%s does not serve HTTP", APP_ROLE)
+        raise ValueError(f"APP_ROLE={APP_ROLE} does not serve HTTP")
+    # Обязанности ведущего начинают работу, пока загружается FastAPI
+    elections = setup_process()
+    import webhook_server
+    
+    # Передаем экземпляр бота в FastAPI приложение
+    webhook_server.set_bot_instance(bot, PRIVATE_CHANNEL_ID)
+    logger.info("Bot instance set for webhook server")
+    if TELEGRAM_UPDATE_MODE == 'webhook':
+        webhook_server.enable_telegram_webhook(TELEGRAM_WEBHOOK_SECRET)
+    
+    # Аренды освобождаются при остановке сервера, чтобы ведущим сразу стал другой процесс
+    for election in elections:
+        webhook_server.add_shutdown_callback(functools.partial(election.stop, 5))
+    return webhook_server.app
+
+# Роли bot и scheduler: процесс без веб-сервера работает до SIGTERM/SIGINT
+def run_background_role():
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+    elections = setup_process()
+    logger.info("Role %s started", APP_ROLE)
+    _stop_event.wait()
+    for election in elections:
+        election.stop(5)
+    dispatcher.stop(timeout=5)
+    logger.info("Role %s stopped", APP_ROLE)
+
+# Основное тело скрипта
+def main():
+    init_settings()
+    logger.info("Starting application with role %s", APP_ROLE)
+    
+    if TELEGRAM_UPDATE_MODE == 'webhook' and 'bot' in ROLE_DUTIES[APP_ROLE] and not get_public_url():
+        logger.critical("PUBLIC_URL is required for TELEGRAM_UPDATE_MODE=webhook")
+        raise ValueError("PUBLIC_URL is required for TELEGRAM_UPDATE_MODE=webhook")
+    
+    if APP_ROLE not in WEB_ROLES:
+        run_background_role()
+        return
+    
+    import uvicorn
+    if WEB_WORKERS > 1:
+        # Несколько процессов веб-сервера; каждый воркер выполняет фабрику app.create_app,
+        # а фоновые задачи достаются выбранным ведущим
+        # Миграции схемы (в том числе однократный VACUUM) выполняются один раз до запуска воркеров
+        init_db()
+        logger.info("Starting webhook server on port %s with %s workers", PORT, WEB_WORKERS)
+        uvicorn.run("app:create_app", factory=True, host="0.0.0.0", port=PORT, workers=WEB_WORKERS)
+        return
+    
+    app = create_worker_app()
+    logger.info("Role %s started, webhook server on port %s", APP_ROLE, PORT)
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGINT, signal_handler)  # Обработка SIGINT
-    main() 
\ No newline at end of file
+    main()
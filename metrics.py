@@ -0,0 +1,214 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('metrics')
+
+# Границы корзин гистограмм задержек (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Базовый класс метрики: значения хранятся по кортежу значений меток
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+# Gauge: значение задается явно через set() или вычисляется при каждом сборе
+# функцией, которая возвращает число или словарь {кортеж значений меток: число}
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, func=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._func = func
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, func):
+        self._func = func
+
+    def _samples(self):
+        if self._func is None:
+            return super()._samples()
+        try:
+            value = self._func()
+        except Exception as e:
+            logger.error("Error collecting gauge %s: %s", self.name, e)
+            return []
+        if isinstance(value, dict):
+            return [(self.name, key, None, v) for key, v in value.items()]
+        return [(self.name, (), None, value)]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    # Замер длительности блока кода: with histogram.time(operation='...'):
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + '_bucket', key, ('le', _format_value(bound)), cumulative))
+                samples.append((self.name + '_sum', key, None, total))
+                samples.append((self.name + '_count', key, None, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    # Текстовый формат Prometheus (version 0.0.4)
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+# Декоратор для замера длительности функции в гистограмме
+def timed(histogram, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Метрики приложения
+LAVA_REQUEST_SECONDS = Histogram(
+    'lava_request_duration_seconds', 'Lava API request latency, including retries', ['operation'])
+LAVA_REQUESTS = Counter(
+    'lava_requests_total', 'Lava API requests by outcome', ['operation', 'outcome'])
+DB_OPERATION_SECONDS = Histogram(
+    'db_operation_duration_seconds', 'SQLite repository operation latency', ['operation'])
+DB_LOCK_WAIT_SECONDS = Histogram(
+    'db_lock_wait_seconds', 'Time spent waiting for the SQLite write lock (BEGIN IMMEDIATE)')
+TELEGRAM_REQUEST_SECONDS = Histogram(
+    'telegram_request_duration_seconds', 'Telegram Bot API call latency', ['method'])
+TELEGRAM_REQUESTS = Counter(
+    'telegram_requests_total', 'Telegram Bot API calls by outcome', ['method', 'outcome'])
+TELEGRAM_QUEUE_DEPTH = Gauge(
+    'telegram_queue_depth', 'Outbound Telegram calls waiting in the dispatcher queue')
+WEBHOOK_EVENTS = Counter(
+    'lava_webhook_events_total', 'Processed Lava webhook events', ['status', 'outcome'])
+WEBHOOK_SECONDS = Histogram(
+    'lava_webhook_duration_seconds', 'Lava webhook handling latency')
+EXPIRY_SWEEP_SECONDS = Histogram(
+    'expiry_sweep_duration_seconds', 'Full expired subscriptions sweep duration',
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+EXPIRY_REMOVALS = Counter(
+    'expiry_removals_total', 'Expired subscribers removed from the channel', ['outcome'])
+INVITE_LINKS_AVAILABLE = Gauge(
+    'invite_links_available', 'Pre-generated invite links ready to be issued')
+INVITE_LINKS_ISSUED = Counter(
+    'invite_links_issued_total', 'Invite links sent after payment by source', ['source'])
+OUTBOX_DELIVERIES = Counter(
+    'outbox_deliveries_total', 'Outbox side effect delivery attempts by outcome', ['kind', 'outcome'])
+OUTBOX_ENTRIES = Gauge(
+    'outbox_entries', 'Outbox entries by status', ['status'])
+RECONCILE_INVOICES = Counter(
+    'reconcile_invoices_total', 'Pending invoices checked against Lava by outcome', ['outcome'])
+BROADCAST_MESSAGES = Counter(
+    'broadcast_messages_total', 'Broadcast messages by outcome', ['outcome'])
+ARCHIVED_ROWS = Counter(
+    'archived_rows_total', 'Rows moved from the database to archive segments', ['table'])
+SPANS_DROPPED = Counter(
+    'trace_spans_dropped_total', 'Finished spans dropped because the export queue was full')
+SUBSCRIBERS = Gauge(
+    'subscribers', 'Subscribers by status', ['status'])
+PENDING_INVOICES = Gauge(
+    'pending_invoices', 'Unpaid invoices that can still be reused')
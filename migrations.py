@@ -0,0 +1,413 @@
+import logging
+
+logger = logging.getLogger('db')
+
+
+# Исходная схема (совпадает с таблицей, которую создавал init_db)
+def _initial_schema(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS subscribers (
+        telegram_id TEXT PRIMARY KEY,
+        payment_id TEXT,
+        status TEXT,
+        expiry_date TEXT
+    )
+    ''')
+
+
+# Дата окончания подписки хранится как unix-время (INTEGER) вместо текста,
+# добавляются индексы для поиска по payment_id и для выборки истекших подписок
+def _epoch_expiry_and_indexes(conn):
+    conn.execute('''
+    CREATE TABLE subscribers_new (
+        telegram_id TEXT PRIMARY KEY,
+        payment_id TEXT,
+        status TEXT,
+        expiry_date INTEGER
+    )
+    ''')
+    # Заглушки 'unknown' и повторяющиеся payment_id не пройдут уникальный индекс,
+    # поэтому оставляем payment_id только у одной (последней) записи
+    conn.execute('''
+    INSERT INTO subscribers_new (telegram_id, payment_id, status, expiry_date)
+    SELECT
+        telegram_id,
+        CASE
+            WHEN payment_id IS NULL OR payment_id IN ('', 'unknown') THEN NULL
+            WHEN rowid = (SELECT MAX(s2.rowid) FROM subscribers s2 WHERE s2.payment_id = subscribers.payment_id)
+                THEN payment_id
+            ELSE NULL
+        END,
+        status,
+        CASE
+            WHEN expiry_date IS NULL OR expiry_date = '' THEN NULL
+            ELSE CAST(strftime('%s', expiry_date) AS INTEGER)
+        END
+    FROM subscribers
+    ''')
+    conn.execute("DROP TABLE subscribers")
+    conn.execute("ALTER TABLE subscribers_new RENAME TO subscribers")
+    conn.execute("CREATE UNIQUE INDEX idx_subscribers_payment_id ON subscribers (payment_id)")
+    conn.execute("CREATE INDEX idx_subscribers_status_expiry ON subscribers (status, expiry_date)")
+
+
+# История всех инвойсов пользователя: поздняя оплата старого инвойса
+# по-прежнему находит пользователя, а неоплаченный инвойс можно выдать повторно
+def _invoices_history(conn):
+    conn.execute('''
+    CREATE TABLE invoices (
+        payment_id TEXT PRIMARY KEY,
+        telegram_id TEXT NOT NULL,
+        payment_url TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_at INTEGER NOT NULL,
+        reusable_until INTEGER
+    )
+    ''')
+    conn.execute("CREATE INDEX idx_invoices_telegram_id ON invoices (telegram_id, created_at)")
+    conn.execute('''
+    INSERT INTO invoices (payment_id, telegram_id, status, created_at)
+    SELECT
+        payment_id,
+        telegram_id,
+        CASE WHEN expiry_date IS NOT NULL THEN 'paid' ELSE COALESCE(status, 'pending') END,
+        CAST(strftime('%s', 'now') AS INTEGER)
+    FROM subscribers
+    WHERE payment_id IS NOT NULL
+    ''')
+
+
+# Журнал обработанных событий Lava для идемпотентной обработки повторных вебхуков
+def _processed_events(conn):
+    conn.execute('''
+    CREATE TABLE processed_events (
+        payment_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        outcome TEXT NOT NULL,
+        processed_at INTEGER NOT NULL,
+        PRIMARY KEY (payment_id, status)
+    ) WITHOUT ROWID
+    ''')
+
+
+# Колонки для захвата истекших подписок порциями: статус 'expiring' с временем захвата
+# и счетчиком попыток, чтобы неудачное удаление из канала повторялось, а не терялось
+def _expiry_claims(conn):
+    conn.execute("ALTER TABLE subscribers ADD COLUMN claimed_at INTEGER")
+    conn.execute("ALTER TABLE subscribers ADD COLUMN kick_attempts INTEGER NOT NULL DEFAULT 0")
+
+
+# Пул заранее созданных одноразовых ссылок-приглашений в канал
+# (status: available - ждет выдачи, issued - выдана пользователю, revoked - отозвана)
+def _invite_links(conn):
+    conn.execute('''
+    CREATE TABLE invite_links (
+        invite_link TEXT PRIMARY KEY,
+        status TEXT NOT NULL DEFAULT 'available',
+        created_at INTEGER NOT NULL,
+        expire_date INTEGER NOT NULL,
+        telegram_id TEXT,
+        issued_at INTEGER
+    )
+    ''')
+    conn.execute("CREATE INDEX idx_invite_links_status_expire ON invite_links (status, expire_date)")
+
+
+# Очередь побочных эффектов (transactional outbox): запись добавляется в той же
+# транзакции, что и изменение статуса, а доставку выполняет фоновый обработчик.
+# next_attempt_at - когда запись можно (снова) взять в работу
+def _outbox(conn):
+    conn.execute('''
+    CREATE TABLE outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        telegram_id TEXT,
+        payload TEXT NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        last_error TEXT
+    )
+    ''')
+    conn.execute("CREATE INDEX idx_outbox_status_next ON outbox (status, next_attempt_at)")
+
+
+# Аренды (leases) для выбора одного ведущего процесса среди нескольких
+def _leases(conn):
+    conn.execute('''
+    CREATE TABLE leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    ''')
+
+
+# Контрольные точки длительных заданий (сверка с Lava и т.п.): позиция в виде JSON,
+# чтобы прерванное задание продолжалось с места остановки. Индекс для постраничного
+# обхода неоплаченных инвойсов по времени создания
+def _checkpoints(conn):
+    conn.execute('''
+    CREATE TABLE checkpoints (
+        name TEXT PRIMARY KEY,
+        position TEXT NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX idx_invoices_status_created ON invoices (status, created_at, payment_id)")
+
+
+# Рассылки администратора: текст, прогресс (последний обработанный telegram_id)
+# и счетчики, чтобы прерванная рассылка продолжалась с места остановки
+def _broadcasts(conn):
+    conn.execute('''
+    CREATE TABLE broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at INTEGER NOT NULL,
+        finished_at INTEGER,
+        last_telegram_id TEXT NOT NULL DEFAULT '',
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        elapsed REAL NOT NULL DEFAULT 0
+    )
+    ''')
+
+
+# Счетчики подписчиков по статусам и дневные итоги переходов (даты в UTC).
+# Обновляются триггерами в той же транзакции, что и само изменение статуса, поэтому
+# любой путь записи (вебхук, сверка, истечение подписок) учитывается без сканирования таблиц
+def _stats(conn):
+    conn.execute('''
+    CREATE TABLE stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE stats_daily (
+        day TEXT NOT NULL,
+        name TEXT NOT NULL,
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, name)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TRIGGER stats_subscriber_insert AFTER INSERT ON subscribers
+    BEGIN
+        INSERT INTO stats_counters (name, value) VALUES ('subscribers_' || COALESCE(NEW.status, 'unknown'), 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        INSERT INTO stats_daily (day, name, value) VALUES (date('now'), 'new_users', 1)
+        ON CONFLICT (day, name) DO UPDATE SET value = value + 1;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER stats_subscriber_status AFTER UPDATE OF status ON subscribers
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'subscribers_' || COALESCE(OLD.status, 'unknown');
+        INSERT INTO stats_counters (name, value) VALUES ('subscribers_' || COALESCE(NEW.status, 'unknown'), 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        INSERT INTO stats_daily (day, name, value) VALUES (date('now'), 'to_' || COALESCE(NEW.status, 'unknown'), 1)
+        ON CONFLICT (day, name) DO UPDATE SET value = value + 1;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER stats_subscriber_delete AFTER DELETE ON subscribers
+    BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'subscribers_' || COALESCE(OLD.status, 'unknown');
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER stats_invoice_insert AFTER INSERT ON invoices
+    BEGIN
+        INSERT INTO stats_daily (day, name, value) VALUES (date('now'), 'invoices', 1)
+        ON CONFLICT (day, name) DO UPDATE SET value = value + 1;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER stats_invoice_paid AFTER UPDATE OF status ON invoices
+    WHEN NEW.status = 'paid' AND OLD.status IS NOT 'paid'
+    BEGIN
+        INSERT INTO stats_daily (day, name, value) VALUES (date('now'), 'payments', 1)
+        ON CONFLICT (day, name) DO UPDATE SET value = value + 1;
+    END
+    ''')
+    # Начальные значения: текущие статусы и оплаты из журнала событий
+    conn.execute('''
+    INSERT INTO stats_counters (name, value)
+    SELECT 'subscribers_' || COALESCE(status, 'unknown'), COUNT(*) FROM subscribers GROUP BY 1
+    ''')
+    conn.execute('''
+    INSERT INTO stats_daily (day, name, value)
+    SELECT date(processed_at, 'unixepoch'), 'payments', COUNT(*) FROM processed_events
+    WHERE status = 'PAID' AND outcome = 'applied' GROUP BY 1
+    ''')
+
+
+# Неизменяемая история событий подписчиков и инвойсов. Записи добавляют триггеры
+# при каждом изменении, поэтому прежние статусы, сроки и платежи не теряются при
+# обновлении строк. Старые записи переносятся в архив (archive.py), поэтому
+# добавлены индексы по времени для выборки архивируемых строк
+def _events_history(conn):
+    conn.execute('''
+    CREATE TABLE events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        telegram_id TEXT,
+        payment_id TEXT,
+        data TEXT
+    )
+    ''')
+    conn.execute("CREATE INDEX idx_events_telegram_id ON events (telegram_id, id)")
+    conn.execute("CREATE INDEX idx_events_created_at ON events (created_at)")
+    conn.execute("CREATE INDEX idx_processed_events_processed_at ON processed_events (processed_at)")
+    conn.execute("CREATE INDEX idx_invoices_created_at ON invoices (created_at)")
+    conn.execute('''
+    CREATE TRIGGER events_append_only BEFORE UPDATE ON events
+    BEGIN
+        SELECT RAISE(ABORT, 'events are append-only');
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER events_subscriber_insert AFTER INSERT ON subscribers
+    BEGIN
+        INSERT INTO events (created_at, kind, telegram_id, payment_id, data)
+        VALUES (CAST(strftime('%s', 'now') AS INTEGER), 'subscriber_created', NEW.telegram_id, NEW.payment_id,
+                json_object('status', NEW.status, 'expiry_date', NEW.expiry_date));
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER events_subscriber_update AFTER UPDATE OF status, expiry_date, payment_id ON subscribers
+    WHEN OLD.status IS NOT NEW.status OR OLD.expiry_date IS NOT NEW.expiry_date OR OLD.payment_id IS NOT NEW.payment_id
+    BEGIN
+        INSERT INTO events (created_at, kind, telegram_id, payment_id, data)
+        VALUES (CAST(strftime('%s', 'now') AS INTEGER), 'subscriber_updated', NEW.telegram_id, NEW.payment_id,
+                json_object('from', OLD.status, 'to', NEW.status, 'expiry_date', NEW.expiry_date,
+                            'previous_expiry_date', OLD.expiry_date, 'previous_payment_id', OLD.payment_id));
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER events_subscriber_delete AFTER DELETE ON subscribers
+    BEGIN
+        INSERT INTO events (created_at, kind, telegram_id, payment_id, data)
+        VALUES (CAST(strftime('%s', 'now') AS INTEGER), 'subscriber_archived', OLD.telegram_id, OLD.payment_id,
+                json_object('status', OLD.status, 'expiry_date', OLD.expiry_date));
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER events_invoice_insert AFTER INSERT ON invoices
+    BEGIN
+        INSERT INTO events (created_at, kind, telegram_id, payment_id, data)
+        VALUES (CAST(strftime('%s', 'now') AS INTEGER), 'invoice_created', NEW.telegram_id, NEW.payment_id,
+                json_object('payment_url', NEW.payment_url));
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER events_invoice_status AFTER UPDATE OF status ON invoices
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        INSERT INTO events (created_at, kind, telegram_id, payment_id, data)
+        VALUES (CAST(strftime('%s', 'now') AS INTEGER), 'invoice_' || NEW.status, NEW.telegram_id, NEW.payment_id,
+                json_object('from', OLD.status));
+    END
+    ''')
+    # Подписчики удаляются только при архивации: в статистике они переходят в archived
+    conn.execute("DROP TRIGGER stats_subscriber_delete")
+    conn.execute('''
+    CREATE TRIGGER stats_subscriber_delete AFTER DELETE ON subscribers
+    BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'subscribers_' || COALESCE(OLD.status, 'unknown');
+        INSERT INTO stats_counters (name, value) VALUES ('subscribers_archived', 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    END
+    ''')
+
+
+# Истечение в статистике разделяется: отток - подписка оплатившего пользователя
+# закончилась (active/expiring -> expired), а истечение неоплаченного инвойса
+# (pending -> expired) считается отдельно. Начальные значения берутся из истории событий
+def _stats_churn(conn):
+    conn.execute('''
+    CREATE TRIGGER stats_subscriber_lapsed AFTER UPDATE OF status ON subscribers
+    WHEN NEW.status = 'expired' AND OLD.status IS NOT 'expired'
+    BEGIN
+        INSERT INTO stats_daily (day, name, value)
+        VALUES (date('now'), CASE WHEN OLD.status IN ('active', 'expiring') THEN 'churned' ELSE 'unpaid_expired' END, 1)
+        ON CONFLICT (day, name) DO UPDATE SET value = value + 1;
+    END
+    ''')
+    conn.execute('''
+    INSERT INTO stats_daily (day, name, value)
+    SELECT date(created_at, 'unixepoch'),
+           CASE WHEN json_extract(data, '$.from') IN ('active', 'expiring') THEN 'churned' ELSE 'unpaid_expired' END,
+           COUNT(*)
+    FROM events
+    WHERE kind = 'subscriber_updated' AND json_extract(data, '$.to') = 'expired'
+      AND json_extract(data, '$.from') IS NOT 'expired'
+    GROUP BY 1, 2
+    ''')
+
+
+# Режим incremental auto_vacuum: ежедневное обслуживание (archive.py) возвращает
+# свободные страницы файловой системе. Для существующей базы нужен однократный полный
+# VACUUM, поэтому он выполняется при запуске, до начала работы, а не в час обслуживания.
+# VACUUM нельзя выполнить в транзакции (см. OUTSIDE_TRANSACTION); повторный запуск
+# после сбоя безопасен
+def _incremental_vacuum(conn):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+# Список миграций: (версия, описание, функция). Номера версий только растут,
+# примененная миграция никогда не меняется - для изменений добавляется новая
+MIGRATIONS = [
+    (1, "initial subscribers table", _initial_schema),
+    (2, "integer expiry_date, payment_id and status/expiry indexes", _epoch_expiry_and_indexes),
+    (3, "invoices history table", _invoices_history),
+    (4, "processed webhook events ledger", _processed_events),
+    (5, "expiry claim columns", _expiry_claims),
+    (6, "invite links pool", _invite_links),
+    (7, "side effects outbox", _outbox),
+    (8, "leader leases", _leases),
+    (9, "job checkpoints and pending invoices index", _checkpoints),
+    (10, "admin broadcasts", _broadcasts),
+    (11, "stats counters and daily rollups", _stats),
+    (12, "append-only events history and archival indexes", _events_history),
+    (13, "separate churn from unpaid invoice expiry in stats", _stats_churn),
+    (14, "incremental auto_vacuum", _incremental_vacuum),
+]
+# Миграции, которые выполняются вне транзакции; версия записывается после них
+OUTSIDE_TRANSACTION = {14}
+
+
+# Применение недостающих миграций. Текущая версия схемы хранится в PRAGMA user_version,
+# каждая миграция выполняется в отдельной транзакции вместе с обновлением версии
+def migrate(conn):
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("Applying migration %s: %s", version, description)
+        if version in OUTSIDE_TRANSACTION:
+            apply(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Версию перечитываем под блокировкой: миграцию мог уже применить другой процесс
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            if version not in OUTSIDE_TRANSACTION:
+                apply(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        current = version
+    return current
@@ -0,0 +1,66 @@
+import logging
+from datetime import datetime, timedelta
+
+from database import OUTBOX_ACTIVATION_INVITE, OUTBOX_PAYMENT_STATUS
+from dispatcher import get_dispatcher, PRIORITY_HIGH, TELEGRAM_RESULT_TIMEOUT
+from invite_links import take_pooled_invite
+from metrics import INVITE_LINKS_ISSUED
+from outbox import outbox_handler
+
+# Доставка уведомлений об оплате из outbox. Модуль не зависит от веб-сервера,
+# поэтому процесс фоновых задач (APP_ROLE=scheduler) не загружает FastAPI
+logger = logging.getLogger('webhook.notifications')
+
+# Экземпляр бота и ID канала для создания ссылок-приглашений
+bot_instance = None
+channel_id = None
+
+
+def init_notifications(bot, channel):
+    global bot_instance, channel_id
+    bot_instance = bot
+    channel_id = channel
+
+
+# Доставка ссылки-приглашения после активации подписки (запись outbox).
+# Готовая ссылка берется из пула, если пул пуст - создается через очередь Telegram
+# с высоким приоритетом. Исключение оставляет запись в outbox для повтора
+@outbox_handler(OUTBOX_ACTIVATION_INVITE)
+def deliver_activation_invite(telegram_id, payload):
+    expiry_date = datetime.fromtimestamp(payload['expiry_date']).strftime('%Y-%m-%d %H:%M:%S')
+    pooled = take_pooled_invite(telegram_id)
+    if pooled:
+        invite_url, link_expire_date = pooled
+        INVITE_LINKS_ISSUED.inc(source='pool')
+    else:
+        link_expire_date = int((datetime.now() + timedelta(days=1)).timestamp())
+        invite_url = get_dispatcher().submit(
+            bot_instance.create_chat_invite_link,
+            channel_id,
+            member_limit=1,
+            expire_date=link_expire_date,
+            priority=PRIORITY_HIGH
+        ).result(timeout=TELEGRAM_RESULT_TIMEOUT).invite_link
+        INVITE_LINKS_ISSUED.inc(source='direct')
+        logger.debug("Created invite link for user %s", telegram_id)
+
+    link_expiry = datetime.fromtimestamp(link_expire_date).strftime('%Y-%m-%d %H:%M:%S')
+    # Отправляем сообщение пользователю
+    get_dispatcher().send_message(
+        telegram_id,
+        f"Спасибо за оплату! Ваша подписка активирована до {expiry_date}.\n\n"
+        f"Для доступа к каналу используйте эту ссылку: {invite_url}\n\n"
+        f"Ссылка действительна до {link_expiry}.",
+        priority=PRIORITY_HIGH
+    ).result(timeout=TELEGRAM_RESULT_TIMEOUT)
+    logger.info("Sent invite link to user %s", telegram_id)
+
+
+# Уведомление пользователя об отмене или истечении платежа (запись outbox)
+@outbox_handler(OUTBOX_PAYMENT_STATUS)
+def deliver_payment_status_notice(telegram_id, payload):
+    get_dispatcher().send_message(
+        telegram_id,
+        f"Ваш платеж был {payload['status']}. Для получения доступа к каналу, пожалуйста, оплатите подписку."
+    ).result(timeout=TELEGRAM_RESULT_TIMEOUT)
+    logger.debug("Sent payment %s notification to user %s", payload['status'], telegram_id)
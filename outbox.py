@@ -0,0 +1,173 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from database import claim_outbox, finish_outbox, delete_done_outbox
+from dispatcher import get_dispatcher, PRIORITY_NORMAL
+from metrics import OUTBOX_DELIVERIES
+from tracing import span, parse_traceparent
+
+logger = logging.getLogger('outbox')
+
+# Размер порции, число параллельных доставок и время, на которое захватывается порция
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 8))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', 120))
+# Повторы: экспоненциальная задержка с джиттером, после OUTBOX_MAX_ATTEMPTS - dead letter
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', 5))
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', 600))
+# Как часто проверять outbox без уведомлений и сколько дней хранить доставленные записи
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 5))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', 7))
+
+# Обработчики по виду записи: handler(telegram_id, payload), исключение - неудача
+_handlers = {}
+
+
+# Регистрация обработчика записей outbox:
+# @outbox_handler('activation_invite')
+# def deliver(telegram_id, payload): ...
+def outbox_handler(kind):
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+# Фоновая доставка записей outbox порциями. Каждая запись доставляется минимум
+# один раз: неудачная повторяется с растущей задержкой, а исчерпавшая попытки
+# помечается dead и сообщается администратору
+class OutboxWorker:
+    def __init__(self, admin_id=None, batch_size=OUTBOX_BATCH_SIZE, concurrency=OUTBOX_CONCURRENCY,
+                 lease=OUTBOX_LEASE, max_attempts=OUTBOX_MAX_ATTEMPTS, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.admin_id = admin_id
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix="outbox-delivery")
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._next_cleanup = 0
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="outbox-worker", daemon=True)
+        self._thread.start()
+        logger.info("Outbox worker started")
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self._executor.shutdown(wait=False)
+
+    # Уведомление о новых записях: порция берется сразу, не дожидаясь опроса
+    def notify(self):
+        self._wake.set()
+
+    def _backoff(self, attempts):
+        return random.uniform(0.5, 1) * min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+
+    # Доставка продолжает трассу события, создавшего запись (traceparent в payload)
+    def _deliver(self, kind, telegram_id, payload):
+        parent = parse_traceparent(payload.pop('traceparent', None))
+        with span(f"outbox.{kind}", parent=parent, telegram_id=telegram_id):
+            handler = _handlers.get(kind)
+            if handler is None:
+                raise LookupError(f"No outbox handler for {kind}")
+            handler(telegram_id, payload)
+
+    # Обработка одной порции. Возвращает число захваченных записей
+    def process_batch(self):
+        batch = claim_outbox(self.batch_size, self.lease)
+        if not batch:
+            return 0
+        futures = [
+            (entry_id, kind, telegram_id, attempts, self._executor.submit(self._deliver, kind, telegram_id, payload))
+            for entry_id, kind, telegram_id, payload, attempts in batch
+        ]
+        done, retry, dead = [], [], []
+        now = time.time()
+        for entry_id, kind, telegram_id, attempts, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                if attempts >= self.max_attempts:
+                    logger.error("Outbox %s %s for user %s failed permanently: %s", kind, entry_id, telegram_id, error)
+                    dead.append((entry_id, kind, telegram_id, error))
+                    OUTBOX_DELIVERIES.inc(kind=kind, outcome='dead')
+                else:
+                    logger.warning("Outbox %s %s for user %s failed (attempt %s): %s", kind, entry_id, telegram_id, attempts, error)
+                    retry.append((entry_id, now + self._backoff(attempts), error))
+                    OUTBOX_DELIVERIES.inc(kind=kind, outcome='retry')
+                continue
+            done.append(entry_id)
+            OUTBOX_DELIVERIES.inc(kind=kind, outcome='delivered')
+        finish_outbox(done, retry, [(entry_id, error) for entry_id, _, _, error in dead])
+        if dead:
+            self._report_dead(dead)
+        return len(batch)
+
+    # Отчет администратору о записях, доставить которые не удалось
+    def _report_dead(self, dead):
+        if not self.admin_id:
+            return
+        lines = [f"#{entry_id} {kind} для {telegram_id}: {error}" for entry_id, kind, telegram_id, error in dead[:20]]
+        if len(dead) > 20:
+            lines.append(f"... и еще {len(dead) - 20}")
+        try:
+            get_dispatcher().send_message(
+                self.admin_id,
+                f"Не удалось доставить {len(dead)} уведомлений после {self.max_attempts} попыток:\n" + "\n".join(lines),
+                priority=PRIORITY_NORMAL
+            )
+        except Exception as e:
+            logger.error("Error reporting dead outbox entries to admin: %s", e)
+
+    def _cleanup(self):
+        now = time.time()
+        if now < self._next_cleanup:
+            return
+        self._next_cleanup = now + 3600
+        deleted = delete_done_outbox(now - OUTBOX_RETENTION_DAYS * 24 * 3600)
+        if deleted:
+            logger.info("Deleted %s delivered outbox entries", deleted)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.clear()
+            try:
+                self._cleanup()
+                # Полная порция - скорее всего, есть еще записи
+                if self.process_batch() >= self.batch_size:
+                    continue
+            except Exception as e:
+                logger.error("Error processing outbox: %s", e)
+            self._wake.wait(self.poll_interval)
+
+
+_worker = None
+
+
+def init_outbox_worker(**kwargs):
+    global _worker
+    _worker = OutboxWorker(**kwargs)
+    return _worker
+
+
+# Уведомление обработчика о новых записях. В процессе без обработчика ничего
+# не делает - записи заберет обработчик при очередном опросе
+def notify_outbox():
+    if _worker is not None:
+        _worker.notify()
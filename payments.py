@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from database import EVENT_APPLIED, EVENT_DUPLICATE, EVENT_UNKNOWN_PAYMENT
+from expiry import schedule_expiry
+from invoices import invoice_cache
+from outbox import notify_outbox
+from subscribers import subscriber_index
+
+# Размер LRU-кэша обработанных событий перед таблицей processed_events
+PROCESSED_EVENTS_CACHE_SIZE = int(os.getenv('PROCESSED_EVENTS_CACHE_SIZE', 10000))
+
+# Срок подписки после оплаты
+SUBSCRIPTION_DAYS = 30
+
+
+# LRU обработанных событий (payment_id, status): повторная доставка вебхука
+# отбрасывается без обращения к базе и Telegram
+class ProcessedEventsCache:
+    def __init__(self, capacity=PROCESSED_EVENTS_CACHE_SIZE):
+        self.capacity = capacity
+        self._events = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, payment_id, status):
+        key = (payment_id, status)
+        with self._lock:
+            if key in self._events:
+                self._events.move_to_end(key)
+                return True
+        return False
+
+    def add(self, payment_id, status):
+        with self._lock:
+            self._events[(payment_id, status)] = True
+            self._events.move_to_end((payment_id, status))
+            while len(self._events) > self.capacity:
+                self._events.popitem(last=False)
+
+
+processed_events = ProcessedEventsCache()
+
+
+# Обработка события оплаты: сначала LRU, затем журнал в базе (через индекс подписчиков).
+# Возвращает (результат, telegram_id) - см. EVENT_* в database
+def process_payment_event(payment_id, status, expiry_date=None):
+    if processed_events.seen(payment_id, status):
+        return EVENT_DUPLICATE, None
+    outcome, telegram_id = subscriber_index.apply_payment_event(payment_id, status, expiry_date)
+    if outcome != EVENT_UNKNOWN_PAYMENT:
+        processed_events.add(payment_id, status)
+    return outcome, telegram_id
+
+
+# Полная обработка события оплаты (вебхук Lava или сверка): запись статуса
+# с уведомлением в outbox, затем обновление кэшей и планировщика истечений.
+# Возвращает (результат, telegram_id)
+def handle_payment_event(payment_id, status):
+    expiry_date = int(time.time()) + SUBSCRIPTION_DAYS * 24 * 3600
+    outcome, telegram_id = process_payment_event(payment_id, status, expiry_date)
+    if outcome == EVENT_APPLIED:
+        invoice_cache.invalidate(telegram_id)
+        if status == 'PAID':
+            schedule_expiry(telegram_id, expiry_date)
+        # Уведомление пользователя записано в outbox в той же транзакции
+        notify_outbox()
+    return outcome, telegram_id
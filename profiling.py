@@ -0,0 +1,59 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Ограничения профилирования по запросу администратора
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 60))
+PROFILE_DEFAULT_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.01))
+
+_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _collapse(thread_name, frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ';'.join(reversed(stack))
+
+
+# Семплирующий профилировщик всех потоков процесса: каждые interval секунд
+# снимает стеки через sys._current_frames. В отличие от cProfile не замедляет
+# обработку запросов и видит потоки очереди Telegram, outbox и планировщика.
+# Возвращает (Counter свернутых стеков, число снимков). Одновременно - один профиль
+def sample_stacks(seconds, interval=PROFILE_DEFAULT_INTERVAL):
+    seconds = max(0.1, min(float(seconds), PROFILE_MAX_SECONDS))
+    interval = max(0.001, float(interval))
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("Profiling is already running")
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+            samples += 1
+            time.sleep(interval)
+        return stacks, samples
+    finally:
+        _lock.release()
+
+
+# Отчет в формате свернутых стеков (flamegraph.pl, speedscope): "стек число"
+def format_collapsed(stacks, samples, limit=None):
+    lines = [f"# {samples} samples"]
+    for stack, count in stacks.most_common(limit):
+        lines.append(f"{stack} {count}")
+    return "\n".join(lines) + "\n"
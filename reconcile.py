@@ -0,0 +1,86 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from database import EVENT_APPLIED, get_pending_invoices_page, get_checkpoint, save_checkpoint, clear_checkpoint
+from dispatcher import TokenBucket
+from lava_client import INVOICE_PENDING
+from metrics import RECONCILE_INVOICES
+from payments import handle_payment_event
+from tracing import span, current_span, traced
+
+logger = logging.getLogger('reconcile')
+
+# Сверяются неоплаченные инвойсы не моложе RECONCILE_MIN_AGE (вебхук еще может прийти)
+# и не старше RECONCILE_MAX_AGE секунд
+RECONCILE_MIN_AGE = int(os.getenv('RECONCILE_MIN_AGE', 15 * 60))
+RECONCILE_MAX_AGE = int(os.getenv('RECONCILE_MAX_AGE', 3 * 24 * 3600))
+# Размер страницы, число параллельных запросов к Lava и их предельная частота (в секунду)
+RECONCILE_PAGE_SIZE = int(os.getenv('RECONCILE_PAGE_SIZE', 100))
+RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', 4))
+RECONCILE_RATE = float(os.getenv('RECONCILE_RATE', 5))
+
+CHECKPOINT_NAME = 'reconcile_invoices'
+
+
+# Сверка неоплаченных инвойсов со статусами в Lava на случай потерянных вебхуков.
+# Инвойсы читаются страницами по индексу (status, created_at, payment_id), после
+# каждой страницы позиция сохраняется в checkpoints, поэтому прерванная сверка
+# продолжается с места остановки. Найденные изменения проходят тот же путь, что и вебхук
+class InvoiceReconciler:
+    def __init__(self, lava_client, page_size=RECONCILE_PAGE_SIZE, concurrency=RECONCILE_CONCURRENCY,
+                 rate=RECONCILE_RATE, min_age=RECONCILE_MIN_AGE, max_age=RECONCILE_MAX_AGE):
+        self.lava_client = lava_client
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.rate = rate
+        self.min_age = min_age
+        self.max_age = max_age
+
+    # Запрос выполняется в пуле потоков: span привязывается к трассе прохода явно
+    def _check(self, bucket, parent, payment_id):
+        with span('reconcile.check', parent=parent, payment_id=payment_id):
+            bucket.acquire()
+            return self.lava_client.get_invoice_status(payment_id)
+
+    def _apply(self, payment_id, status):
+        if status is None:
+            RECONCILE_INVOICES.inc(outcome='error')
+            return False
+        if status == INVOICE_PENDING:
+            RECONCILE_INVOICES.inc(outcome='pending')
+            return False
+        outcome, telegram_id = handle_payment_event(payment_id, status)
+        RECONCILE_INVOICES.inc(outcome=f"{status.lower()}_{outcome}")
+        if outcome == EVENT_APPLIED:
+            logger.warning("Reconciled missed %s event for payment %s (user %s)", status, payment_id, telegram_id)
+            return True
+        return False
+
+    # Один полный проход. Возвращает (проверено инвойсов, применено изменений)
+    @traced('reconcile.run')
+    def run(self):
+        now = time.time()
+        created_from, created_until = now - self.max_age, now - self.min_age
+        position = get_checkpoint(CHECKPOINT_NAME)
+        if position:
+            logger.info("Resuming invoice reconciliation after %s", position)
+        bucket = TokenBucket(self.rate)
+        parent = current_span()
+        checked = applied = 0
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="reconcile") as executor:
+            while True:
+                page = get_pending_invoices_page(created_from, created_until, position, self.page_size)
+                if not page:
+                    break
+                payment_ids = [payment_id for payment_id, _ in page]
+                statuses = executor.map(lambda payment_id: self._check(bucket, parent, payment_id), payment_ids)
+                for payment_id, status in zip(payment_ids, statuses):
+                    applied += self._apply(payment_id, status)
+                checked += len(page)
+                position = list(page[-1][::-1])  # [created_at, payment_id]
+                save_checkpoint(CHECKPOINT_NAME, position)
+        clear_checkpoint(CHECKPOINT_NAME)
+        logger.info("Invoice reconciliation finished: %s checked, %s applied", checked, applied)
+        return checked, applied
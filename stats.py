@@ -0,0 +1,72 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+from database import get_stats_counters, get_daily_stats
+
+# Цена подписки в рублях для оценки выручки (число оплат * цена)
+SUBSCRIPTION_PRICE = float(os.getenv('SUBSCRIPTION_PRICE', 0))
+# Период статистики по умолчанию и максимальный период (дни)
+STATS_DAYS = int(os.getenv('STATS_DAYS', 30))
+STATS_MAX_DAYS = 366
+
+# Дневные итоги, которые попадают в отчет: имя в stats_daily -> ключ отчета
+DAILY_FIELDS = {
+    'new_users': 'new_users',
+    'invoices': 'invoices',
+    'payments': 'payments',
+    'to_active': 'activations',
+    'to_canceled': 'cancellations',
+    'churned': 'expirations',
+    'unpaid_expired': 'expired_invoices',
+}
+
+
+# Сводка по подпискам за последние days дней из заранее посчитанных счетчиков
+# и дневных итогов (таблицы подписчиков и инвойсов не сканируются)
+def build_stats(days=STATS_DAYS):
+    days = max(1, min(int(days), STATS_MAX_DAYS))
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    subscribers = get_stats_counters()
+    daily = [
+        dict({'day': day}, **{key: values.get(name, 0) for name, key in DAILY_FIELDS.items()})
+        for day, values in get_daily_stats(since).items()
+    ]
+    totals = {key: sum(row[key] for row in daily) for key in DAILY_FIELDS.values()}
+    active = subscribers.get('active', 0)
+    # Отток: доля оплаченных подписок, истекших за период, среди активных в течение периода
+    # (истечение неоплаченных инвойсов в отток не входит)
+    churned = totals['expirations']
+    churn = churned / (active + churned) if active + churned else 0.0
+    return {
+        'days': days,
+        'since': since,
+        'subscribers': subscribers,
+        'totals': totals,
+        'churn_rate': round(churn, 4),
+        'revenue': round(totals['payments'] * SUBSCRIPTION_PRICE, 2),
+        'daily': daily,
+    }
+
+
+# Текст сводки для администратора в Telegram
+def format_stats(stats):
+    subscribers = stats['subscribers']
+    totals = stats['totals']
+    lines = [
+        f"Подписчики: активных {subscribers.get('active', 0)}, "
+        f"ожидают оплаты {subscribers.get('pending', 0)}, "
+        f"истекших {subscribers.get('expired', 0)}, "
+        f"отмененных {subscribers.get('canceled', 0)}",
+        "",
+        f"За {stats['days']} дн. (с {stats['since']}):",
+        f"Новых пользователей: {totals['new_users']}",
+        f"Инвойсов: {totals['invoices']}",
+        f"Оплат: {totals['payments']}",
+        f"Отмен: {totals['cancellations']}",
+        f"Истекло подписок: {totals['expirations']}",
+        f"Истекло неоплаченных инвойсов: {totals['expired_invoices']}",
+        f"Отток: {stats['churn_rate'] * 100:.1f}%",
+    ]
+    if SUBSCRIPTION_PRICE:
+        lines.append(f"Выручка: {stats['revenue']:.0f} ₽")
+    return "\n".join(lines)
@@ -0,0 +1,219 @@
+import logging
+import threading
+import time
+
+import database
+from database import EVENT_APPLIED
+
+logger = logging.getLogger('subscribers')
+
+
+# Состояние подписчика в памяти. Записи не изменяются на месте, а заменяются
+# целиком, поэтому читатели без блокировки не видят наполовину обновленную запись
+class Subscriber:
+    __slots__ = ('telegram_id', 'status', 'expiry_date', 'payment_id')
+
+    def __init__(self, telegram_id, status, expiry_date=None, payment_id=None):
+        self.telegram_id = telegram_id
+        self.status = status
+        self.expiry_date = expiry_date
+        self.payment_id = payment_id
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return Subscriber(**values)
+
+    def is_active(self, now=None):
+        now = now if now is not None else time.time()
+        return self.status == 'active' and self.expiry_date is not None and self.expiry_date > now
+
+
+# Индекс подписчиков в памяти: telegram_id -> Subscriber и payment_id -> telegram_id
+# для неоплаченных инвойсов. Загружается из базы один раз, дальше все изменения
+# подписчиков проходят через методы индекса: сначала запись в базу, затем в память.
+# Записи упорядочены блокировкой, чтобы память менялась в том же порядке, что и база;
+# чтение идет без блокировки
+class SubscriberIndex:
+    def __init__(self):
+        self._by_id = {}
+        self._by_payment = {}
+        self._write_lock = threading.RLock()
+        self._loaded = False
+        # Подписчиков меняют и другие процессы: память может отставать от базы до перезагрузки
+        self.shared = False
+
+    def load(self):
+        with self._write_lock:
+            by_id = {
+                str(telegram_id): Subscriber(str(telegram_id), status, expiry_date, payment_id)
+                for telegram_id, status, expiry_date, payment_id in database.load_subscribers()
+            }
+            by_payment = {payment_id: str(telegram_id) for payment_id, telegram_id in database.load_pending_invoice_owners()}
+            self._by_id, self._by_payment = by_id, by_payment
+            self._loaded = True
+        logger.debug("Subscriber index loaded: %s subscribers, %s pending invoices", len(by_id), len(by_payment))
+
+    # Периодическая перезагрузка из базы: нужна, когда подписчиков меняют и другие
+    # процессы (несколько воркеров веб-сервера)
+    def start_refresh(self, interval):
+        self.shared = True
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.load()
+                except Exception as e:
+                    logger.error("Error refreshing subscriber index: %s", e)
+
+        threading.Thread(target=run, name="subscriber-index-refresh", daemon=True).start()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._write_lock:
+                if not self._loaded:
+                    self.load()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def get(self, telegram_id):
+        self._ensure_loaded()
+        return self._by_id.get(str(telegram_id))
+
+    # Подписчик по данным базы, если память может отставать от других процессов
+    # (например, оплата пришла вебхуком в другой воркер). Память обновляется
+    def get_fresh(self, telegram_id):
+        if not self.shared:
+            return self.get(telegram_id)
+        self._ensure_loaded()
+        telegram_id = str(telegram_id)
+        with self._write_lock:
+            row = database.get_subscriber(telegram_id)
+            if row is None:
+                self._by_id.pop(telegram_id, None)
+                return None
+            subscriber = Subscriber(telegram_id, *row)
+            self._by_id[telegram_id] = subscriber
+        return subscriber
+
+    def is_active(self, telegram_id, now=None):
+        subscriber = self.get(telegram_id)
+        return subscriber is not None and subscriber.is_active(now)
+
+    # Владелец неоплаченного инвойса или None (тогда владельца ищет база)
+    def owner(self, payment_id):
+        self._ensure_loaded()
+        return self._by_payment.get(payment_id)
+
+    def count_by_status(self):
+        self._ensure_loaded()
+        counts = {}
+        for subscriber in list(self._by_id.values()):
+            counts[subscriber.status] = counts.get(subscriber.status, 0) + 1
+        return counts
+
+    def _set_statuses(self, telegram_ids, status, only_from=None):
+        for telegram_id in telegram_ids:
+            subscriber = self._by_id.get(str(telegram_id))
+            if subscriber is not None and (only_from is None or subscriber.status == only_from):
+                self._by_id[subscriber.telegram_id] = subscriber.replace(status=status)
+
+    # Сохранение нового инвойса (см. database.save_pending_payment)
+    def save_pending_payment(self, telegram_id, payment_id, payment_url=None, reusable_until=None):
+        self._ensure_loaded()
+        telegram_id = str(telegram_id)
+        with self._write_lock:
+            database.save_pending_payment(telegram_id, payment_id, payment_url, reusable_until)
+            subscriber = self._by_id.get(telegram_id)
+            if subscriber is None:
+                subscriber = Subscriber(telegram_id, 'pending', payment_id=payment_id)
+            else:
+                subscriber = subscriber.replace(
+                    payment_id=payment_id,
+                    status=subscriber.status if subscriber.status in ('active', 'expiring') else 'pending'
+                )
+            self._by_id[telegram_id] = subscriber
+            if payment_id is not None:
+                self._by_payment[payment_id] = telegram_id
+
+    # Применение события оплаты (см. database.apply_payment_event). Владелец инвойса
+    # берется из памяти, если он известен
+    def apply_payment_event(self, payment_id, status, expiry_date=None):
+        self._ensure_loaded()
+        with self._write_lock:
+            outcome, telegram_id = database.apply_payment_event(
+                payment_id, status, expiry_date, self._by_payment.get(payment_id)
+            )
+            if outcome != EVENT_APPLIED:
+                return outcome, telegram_id
+            telegram_id = str(telegram_id)
+            # Инвойс больше не в статусе pending: последующие события по нему редки
+            # и находят владельца через базу
+            self._by_payment.pop(payment_id, None)
+            subscriber = self._by_id.get(telegram_id)
+            if status == 'PAID':
+                self._by_id[telegram_id] = Subscriber(telegram_id, 'active', expiry_date, payment_id)
+            elif (subscriber is not None and subscriber.payment_id == payment_id
+                  and subscriber.status not in ('active', 'expiring')):
+                self._by_id[telegram_id] = subscriber.replace(status=status.lower())
+        return outcome, telegram_id
+
+    # Захват истекших подписок (см. database.claim_expired_subscribers)
+    def claim_expired_subscribers(self, limit, claim_timeout, max_attempts, now=None):
+        self._ensure_loaded()
+        with self._write_lock:
+            claimed = database.claim_expired_subscribers(limit, claim_timeout, max_attempts, now)
+            self._set_statuses(claimed, 'expiring')
+        return claimed
+
+    # Захват подписчиков, истекших по планировщику (см. database.claim_subscribers).
+    # Продленные в последний момент подписки отсеиваются по памяти, без запроса к базе
+    def claim_subscribers(self, telegram_ids, now=None):
+        self._ensure_loaded()
+        now = now if now is not None else time.time()
+        due = [
+            telegram_id for telegram_id in telegram_ids
+            if (subscriber := self._by_id.get(str(telegram_id))) is None
+            or (subscriber.status == 'active' and (subscriber.expiry_date or 0) <= now)
+        ]
+        if not due:
+            return []
+        with self._write_lock:
+            claimed = database.claim_subscribers(due, now)
+            self._set_statuses(claimed, 'expiring')
+        return claimed
+
+    # Перевод зависших после последней попытки подписок в expired
+    # (см. database.abandon_stale_expiries)
+    def abandon_stale_expiries(self, claim_timeout, max_attempts, now=None):
+        self._ensure_loaded()
+        with self._write_lock:
+            abandoned = database.abandon_stale_expiries(claim_timeout, max_attempts, now)
+            self._set_statuses(abandoned, 'expired', only_from='expiring')
+        return abandoned
+
+    # Завершение обработки захваченных подписок (см. database.finish_expiry)
+    def finish_expiry(self, succeeded, failed, max_attempts):
+        self._ensure_loaded()
+        with self._write_lock:
+            gave_up = database.finish_expiry(succeeded, failed, max_attempts)
+            self._set_statuses(list(succeeded) + list(gave_up), 'expired', only_from='expiring')
+        return gave_up
+
+    # Перенос порции записей в архив (см. database.archive_batch):
+    # из памяти убираются архивированные подписчики и инвойсы
+    def archive_batch(self, table, before, limit, store):
+        self._ensure_loaded()
+        with self._write_lock:
+            deleted = database.archive_batch(table, before, limit, store)
+            if table == 'subscribers':
+                for (telegram_id,) in deleted:
+                    self._by_id.pop(str(telegram_id), None)
+            elif table == 'invoices':
+                for (payment_id,) in deleted:
+                    self._by_payment.pop(payment_id, None)
+        return deleted
+
+
+subscriber_index = SubscriberIndex()
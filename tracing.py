@@ -0,0 +1,252 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from metrics import SPANS_DROPPED
+
+logger = logging.getLogger('tracing')
+
+# Экспорт span-ов: file - JSONL-файл TRACE_FILE, otlp - OTLP/HTTP JSON на TRACE_OTLP_URL
+# (например, http://collector:4318/v1/traces), off - только идентификаторы в логах
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', 'file').lower()
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(os.getenv('LOG_DIR', 'logs'), 'traces.jsonl'))
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', 20 * 1024 * 1024))
+TRACE_OTLP_URL = os.getenv('TRACE_OTLP_URL')
+# Доля трасс, span-ы которых экспортируются (идентификатор в логах есть всегда)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'buryatfilmsbot')
+# Сколько завершенных span-ов может ждать выгрузки. Если коллектор не отвечает,
+# лишние span-ы отбрасываются (trace_spans_dropped_total), а не копятся в памяти
+TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', 10000))
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+
+# Участок трассы: идентификаторы, время, атрибуты и результат
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'sampled', 'name', 'attributes',
+                 'start_time', 'end_time', '_start', 'error')
+
+    def __init__(self, name, trace_id=None, parent_id=None, sampled=None, attributes=None):
+        self.trace_id = trace_id or f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.sampled = random.random() < TRACE_SAMPLE_RATE if sampled is None else sampled
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.end_time = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+
+    @property
+    def duration(self):
+        return (self.end_time - self.start_time) if self.end_time else time.perf_counter() - self._start
+
+    # Заголовок W3C traceparent для передачи контекста в другой процесс или в outbox
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self):
+        entry = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start_time, 6),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+        }
+        if self.error:
+            entry['error'] = self.error
+        return entry
+
+
+# Родительский контекст из заголовка traceparent: (trace_id, span_id, sampled) или None
+def parse_traceparent(value):
+    parts = (value or '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == '01'
+
+
+def current_span():
+    return _current.get()
+
+
+def current_trace_id():
+    span = _current.get()
+    return span.trace_id if span else None
+
+
+def current_traceparent():
+    span = _current.get()
+    return span.traceparent if span else None
+
+
+# Span вокруг блока кода. По умолчанию дочерний к текущему span-у (или начало новой трассы);
+# parent - явный родитель: Span, результат parse_traceparent или None для новой трассы.
+# Исключение из блока отмечается в span-е и пробрасывается дальше
+@contextmanager
+def span(name, parent=..., **attributes):
+    if parent is ...:
+        parent = _current.get()
+    if isinstance(parent, Span):
+        parent = (parent.trace_id, parent.span_id, parent.sampled)
+    trace_id, parent_id, sampled = parent or (None, None, None)
+    current = Span(name, trace_id, parent_id, sampled, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set_error(e)
+        raise
+    finally:
+        _current.reset(token)
+        current.end_time = current.start_time + (time.perf_counter() - current._start)
+        if current.sampled:
+            _export(current)
+
+
+# Новая трасса (обновление Telegram, вебхук, фоновая задача) независимо от текущего span-а
+def start_trace(name, **attributes):
+    return span(name, parent=None, **attributes)
+
+
+# Декоратор: вызов функции - span с именем name
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Добавляет trace_id текущего span-а в записи логов (для связи логов с трассами)
+class TraceContextFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = current_trace_id() or '-'
+        return True
+
+
+# Фоновая выгрузка завершенных span-ов порциями, чтобы запись в файл или
+# отправка в коллектор не задерживали обработку запросов
+class SpanExporter:
+    def __init__(self, mode=TRACE_EXPORT, path=TRACE_FILE, url=TRACE_OTLP_URL,
+                 max_bytes=TRACE_FILE_MAX_BYTES, batch_size=512, flush_interval=1.0, queue_size=TRACE_QUEUE_SIZE):
+        self.mode = mode
+        self.path = path
+        self.url = url
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._session = None
+
+    def export(self, span):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            SPANS_DROPPED.inc()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                if self.mode == 'otlp':
+                    self._send_otlp(batch)
+                else:
+                    self._write_file(batch)
+            except Exception as e:
+                logger.warning("Error exporting %s spans: %s", len(batch), e)
+
+    def _write_file(self, batch):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            os.replace(self.path, self.path + '.1')
+        data = ''.join(json.dumps(span.to_dict(), ensure_ascii=False) + '\n' for span in batch)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(data)
+
+    @staticmethod
+    def _otlp_value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def _otlp_span(self, span):
+        entry = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,
+            'startTimeUnixNano': str(int(span.start_time * 1e9)),
+            'endTimeUnixNano': str(int(span.end_time * 1e9)),
+            'attributes': [{'key': key, 'value': self._otlp_value(value)} for key, value in span.attributes.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+        }
+        if span.parent_id:
+            entry['parentSpanId'] = span.parent_id
+        return entry
+
+    def _send_otlp(self, batch):
+        if self._session is None:
+            self._session = requests.Session()
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': TRACE_SERVICE_NAME}}]},
+            'scopeSpans': [{'scope': {'name': TRACE_SERVICE_NAME}, 'spans': [self._otlp_span(span) for span in batch]}],
+        }]}
+        response = self._session.post(self.url, json=body, timeout=5)
+        response.raise_for_status()
+
+
+_exporter = None
+if TRACE_EXPORT == 'otlp' and not TRACE_OTLP_URL:
+    logger.warning("TRACE_EXPORT=otlp requires TRACE_OTLP_URL, spans are not exported")
+elif TRACE_EXPORT in ('file', 'otlp'):
+    _exporter = SpanExporter()
+
+
+def _export(span):
+    if _exporter is not None:
+        _exporter.export(span)
@@ -1,69 +1,72 @@
 from fastapi import FastAPI, Request, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import logging
-from logging.handlers import RotatingFileHandler
 import os
-import sqlite3
-from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 import secrets
-import json
-import traceback
-
-# Загрузка переменных окружения
-load_dotenv()
-
-# Настройка логирования для вебхуков
-def setup_webhook_logging():
-    # Создаем директорию для логов, если она не существует
-    log_dir = 'logs'
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    
-    # Настройка логгера для вебхуков
-    webhook_logger = logging.getLogger('webhook')
-    webhook_logger.setLevel(logging.DEBUG)
-    
-    # Форматтер для логов
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
-    # Обработчик для файла с ротацией
-    file_handler = RotatingFileHandler(
-        os.path.join(log_dir, 'webhook.log'), 
-        maxBytes=5*1024*1024,  # 5 МБ
-        backupCount=5
-    )
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(formatter)
-    
-    # Обработчик для консоли
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(formatter)
-    
-    # Добавляем обработчики к логгеру
-    webhook_logger.addHandler(file_handler)
-    webhook_logger.addHandler(console_handler)
-    
-    return webhook_logger
+import telebot
+
+from database import EVENT_APPLIED, EVENT_DUPLICATE, EVENT_UNKNOWN_PAYMENT, count_reusable_invoices, count_outbox_by_status
+from metrics import (REGISTRY, WEBHOOK_EVENTS, WEBHOOK_SECONDS, SUBSCRIBERS, PENDING_INVOICES,
+                     TELEGRAM_QUEUE_DEPTH, OUTBOX_ENTRIES)
+from payments import processed_events, handle_payment_event
+from dispatcher import get_dispatcher
+from subscribers import subscriber_index
+from stats import build_stats, STATS_DAYS
+from tracing import span, current_span, parse_traceparent
+from profiling import sample_stacks, format_collapsed, ProfilerBusy, PROFILE_DEFAULT_INTERVAL
 
-webhook_logger = setup_webhook_logging()
+# Переменные окружения и логирование настраивает точка входа (main.py), которая
+# импортирует этот модуль только в ролях с веб-сервером
+webhook_logger = logging.getLogger('webhook')
 
 # Получение учетных данных для аутентификации вебхука
 WEBHOOK_USERNAME = os.getenv("WEBHOOK_USERNAME")
 WEBHOOK_PASSWORD = os.getenv("WEBHOOK_PASSWORD")
 
-# Путь к базе данных (для Amvera используем постоянное хранилище)
-DB_PATH = os.path.join('data', os.getenv('DATABASE', 'subscribers.db'))
-os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+# Функции, вызываемые при остановке веб-сервера (например, освобождение аренды ведущего)
+_shutdown_callbacks = []
+
+def add_shutdown_callback(func):
+    _shutdown_callbacks.append(func)
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    for callback in reversed(_shutdown_callbacks):
+        try:
+            await run_in_threadpool(callback)
+        except Exception as e:
+            webhook_logger.error("Error in shutdown callback: %s", e)
 
 # Создание FastAPI приложения
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 security = HTTPBasic()
+# Для административных эндпоинтов: без учетных данных ответ зависит от настроек (см. verify_admin)
+admin_security = HTTPBasic(auto_error=False)
+
+# Трассировка вебхуков: у каждого запроса своя трасса (или продолжение трассы из
+# заголовка traceparent), ее идентификатор возвращается в заголовке X-Trace-Id
+@app.middleware("http")
+async def trace_webhooks(request: Request, call_next):
+    if not request.url.path.startswith("/webhook/"):
+        return await call_next(request)
+    parent = parse_traceparent(request.headers.get("traceparent"))
+    with span(f"{request.method} {request.url.path}", parent=parent) as request_span:
+        response = await call_next(request)
+        request_span.set_attribute("status_code", response.status_code)
+        response.headers["X-Trace-Id"] = request_span.trace_id
+        return response
 
 # Глобальные переменные для хранения экземпляра бота и ID канала
 bot_instance = None
 channel_id = None
 
+# Секрет для проверки обновлений Telegram (задается только в режиме webhook)
+telegram_webhook_secret = None
+
 # Функция для установки экземпляра бота
 def set_bot_instance(bot, channel):
     global bot_instance, channel_id
@@ -71,6 +74,12 @@ def set_bot_instance(bot, channel):
     channel_id = channel
     webhook_logger.info("Bot instance and channel ID set for webhook server")
 
+# Включение приема обновлений Telegram через /webhook/telegram
+def enable_telegram_webhook(secret):
+    global telegram_webhook_secret
+    telegram_webhook_secret = secret
+    webhook_logger.info("Telegram webhook route enabled")
+
 # Функция для проверки учетных данных
 def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
     if not WEBHOOK_USERNAME or not WEBHOOK_PASSWORD:
@@ -81,123 +90,156 @@ def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
     correct_password = secrets.compare_digest(credentials.password, WEBHOOK_PASSWORD)
     
     if not (correct_username and correct_password):
-        webhook_logger.warning(f"Authentication failed for user: {credentials.username}")
+        webhook_logger.warning("Authentication failed for user: %s", credentials.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials",
             headers={"WWW-Authenticate": "Basic"},
         )
     
-    webhook_logger.debug(f"Authentication successful for user: {credentials.username}")
+    webhook_logger.debug("Authentication successful for user: %s", credentials.username)
     return True
 
-# Обработчик вебхука от Lava API
+# Проверка доступа к административным эндпоинтам. В отличие от verify_credentials
+# закрыта, если учетные данные не настроены: эндпоинт отвечает 404
+def verify_admin(credentials: HTTPBasicCredentials = Depends(admin_security)):
+    if not WEBHOOK_USERNAME or not WEBHOOK_PASSWORD:
+        webhook_logger.warning("Admin endpoint called but authentication is not configured")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if credentials is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Basic"},
+        )
+    return verify_credentials(credentials)
+
+# Обработчик вебхука от Lava API.
+# В цикле событий выполняется только разбор запроса: запись в базу идет в пуле потоков,
+# а вызовы Telegram API ставятся в очередь исходящих сообщений
 @app.post("/webhook/lava")
 async def lava_webhook(request: Request, authenticated: bool = Depends(verify_credentials)):
+    with WEBHOOK_SECONDS.time():
+        return await handle_lava_webhook(request)
+
+async def handle_lava_webhook(request):
     webhook_logger.info("Received webhook from Lava API")
     
+    # Получаем данные из запроса. Некорректный запрос повторять бессмысленно - ответ 400
     try:
-        # Получаем данные из запроса
         data = await request.json()
-        webhook_logger.debug(f"Webhook data: {json.dumps(data)}")
+    except ValueError as e:
+        webhook_logger.error("Invalid webhook body: %s", e)
+        return JSONResponse(status_code=400, content={"status": "error", "message": "Invalid JSON"})
+    
+    try:
+        webhook_logger.debug("Webhook data: %s", data)
         
         # Проверяем наличие необходимых полей
-        if 'id' not in data or 'status' not in data:
+        if not isinstance(data, dict) or 'id' not in data or 'status' not in data:
             webhook_logger.error("Invalid webhook data: missing required fields")
             return {"status": "error", "message": "Invalid data format"}
         
         payment_id = data['id']
         status = data['status']
         
-        webhook_logger.info(f"Processing payment {payment_id} with status {status}")
+        webhook_logger.info("Processing payment %s with status %s", payment_id, status)
+        request_span = current_span()
+        if request_span:
+            request_span.set_attribute("payment_id", payment_id)
+            request_span.set_attribute("lava_status", status)
         
         # Проверяем, что у нас есть экземпляр бота и ID канала
         if not bot_instance or not channel_id:
             webhook_logger.error("Bot instance or channel ID not set")
-            return {"status": "error", "message": "Bot not initialized"}
+            return JSONResponse(status_code=503, content={"status": "error", "message": "Bot not initialized"})
+        
+        # Повторная доставка уже обработанного события отвечается сразу, без базы и Telegram
+        if processed_events.seen(payment_id, status):
+            webhook_logger.info("Duplicate webhook for payment %s with status %s, skipping", payment_id, status)
+            WEBHOOK_EVENTS.inc(status=status, outcome=EVENT_DUPLICATE)
+            return {"status": "success"}
         
         # Обрабатываем статус платежа
-        if status == 'PAID':
-            # Находим пользователя по ID платежа
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT telegram_id FROM subscribers WHERE payment_id = ?", (payment_id,))
-            result = cursor.fetchone()
+        if status in ('PAID', 'CANCELED', 'EXPIRED'):
+            # Находим пользователя по ID платежа и обновляем статус подписки
+            outcome, telegram_id = await run_in_threadpool(handle_payment_event, payment_id, status)
+            WEBHOOK_EVENTS.inc(status=status, outcome=outcome)
             
-            if result:
-                telegram_id = result[0]
-                webhook_logger.info(f"Found user {telegram_id} for payment {payment_id}")
-                
-                # Обновляем статус подписки
-                from datetime import datetime, timedelta
-                expiry_date = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')
-                
-                cursor.execute(
-                    "UPDATE subscribers SET status = ?, expiry_date = ? WHERE payment_id = ?",
-                    ("active", expiry_date, payment_id)
-                )
-                conn.commit()
-                webhook_logger.debug(f"Updated subscription status for user {telegram_id}")
-                
-                # Добавляем пользователя в канал
-                try:
-                    # Создаем ссылку-приглашение
-                    invite_link = bot_instance.create_chat_invite_link(
-                        channel_id,
-                        member_limit=1,
-                        expire_date=int((datetime.now() + timedelta(days=1)).timestamp())
-                    )
-                    invite_url = invite_link.invite_link
-                    webhook_logger.debug(f"Created invite link for user {telegram_id}")
-                    
-                    # Отправляем сообщение пользователю
-                    bot_instance.send_message(
-                        telegram_id,
-                        f"Спасибо за оплату! Ваша подписка активирована до {expiry_date}.\n\n"
-                        f"Для доступа к каналу используйте эту ссылку: {invite_url}\n\n"
-                        f"Ссылка действительна в течение 24 часов."
-                    )
-                    webhook_logger.info(f"Sent invite link to user {telegram_id}")
-                except Exception as e:
-                    webhook_logger.error(f"Error adding user to channel: {e}")
-                    webhook_logger.error(traceback.format_exc())
+            if outcome == EVENT_UNKNOWN_PAYMENT:
+                # Инвойс мог быть создан, но еще не сохранен (вебхук обогнал запись):
+                # ответ 503, чтобы Lava повторила доставку, когда владелец уже известен
+                webhook_logger.warning("User not found for payment %s, asking Lava to retry", payment_id)
+                return JSONResponse(status_code=503, content={"status": "error", "message": "Unknown payment"})
+            if outcome != EVENT_APPLIED:
+                webhook_logger.info("Webhook for payment %s with status %s is %s, skipping", payment_id, status, outcome)
+            elif status == 'PAID':
+                # Ссылка-приглашение отправляется из outbox
+                webhook_logger.info("Activated subscription of user %s for payment %s", telegram_id, payment_id)
             else:
-                webhook_logger.warning(f"User not found for payment {payment_id}")
-            
-            conn.close()
-        elif status == 'CANCELED' or status == 'EXPIRED':
-            # Обновляем статус платежа в базе данных
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("UPDATE subscribers SET status = ? WHERE payment_id = ?", (status.lower(), payment_id))
-            conn.commit()
-            
-            # Находим пользователя по ID платежа
-            cursor.execute("SELECT telegram_id FROM subscribers WHERE payment_id = ?", (payment_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                telegram_id = result[0]
-                webhook_logger.info(f"Payment {payment_id} for user {telegram_id} was {status.lower()}")
-                
-                # Отправляем сообщение пользователю
-                try:
-                    bot_instance.send_message(
-                        telegram_id,
-                        f"Ваш платеж был {status.lower()}. Для получения доступа к каналу, пожалуйста, оплатите подписку."
-                    )
-                    webhook_logger.debug(f"Sent payment {status.lower()} notification to user {telegram_id}")
-                except Exception as e:
-                    webhook_logger.error(f"Error sending notification to user: {e}")
-            
-            conn.close()
+                webhook_logger.info("Payment %s for user %s was %s", payment_id, telegram_id, status.lower())
         
         return {"status": "success"}
     except Exception as e:
-        webhook_logger.error(f"Error processing webhook: {e}")
-        webhook_logger.error(traceback.format_exc())
-        return {"status": "error", "message": str(e)}
+        # Событие не записано в базу: ответ 5xx, чтобы Lava повторила доставку
+        # (повтор безопасен - обработанные события отсекает журнал событий)
+        webhook_logger.error("Error processing webhook: %s", e, exc_info=True)
+        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
+
 
+# Обработчик обновлений Telegram в режиме webhook.
+# Обновление только передается в пул потоков бота (TeleBot с threaded=True),
+# поэтому медленный обработчик одного пользователя не задерживает остальных
+@app.post("/webhook/telegram")
+async def telegram_webhook(request: Request):
+    if not telegram_webhook_secret or not bot_instance:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secrets.compare_digest(token, telegram_webhook_secret):
+        webhook_logger.warning("Telegram webhook called with invalid secret token")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid secret token")
+    
+    try:
+        update = telebot.types.Update.de_json(await request.json())
+        bot_instance.process_new_updates([update])
+    except Exception as e:
+        webhook_logger.error("Error processing Telegram update: %s", e, exc_info=True)
+    return {"ok": True}
+
+
+# Метрики, вычисляемые при каждом сборе
+SUBSCRIBERS.set_function(lambda: {(status,): count for status, count in subscriber_index.count_by_status().items()})
+PENDING_INVOICES.set_function(count_reusable_invoices)
+OUTBOX_ENTRIES.set_function(lambda: {(status,): count for status, count in count_outbox_by_status().items()})
+TELEGRAM_QUEUE_DEPTH.set_function(lambda: get_dispatcher().qsize() if get_dispatcher() else 0)
+
+# Метрики в текстовом формате Prometheus (включают счетчики подписчиков, поэтому доступ
+# как у административных эндпоинтов). Обработчик синхронный: FastAPI выполняет
+# его в пуле потоков, поэтому запросы к базе при сборе не блокируют цикл событий
+@app.get("/metrics")
+def metrics(authenticated: bool = Depends(verify_admin)):
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+# Статистика подписок за последние days дней: счетчики по статусам, итоги, отток,
+# выручка и дневные итоги. Читаются заранее посчитанные значения, без сканирования таблиц
+@app.get("/stats")
+def stats(days: int = STATS_DAYS, authenticated: bool = Depends(verify_admin)):
+    return build_stats(days)
+
+
+# Семплирующий профиль всех потоков процесса за seconds секунд в формате свернутых
+# стеков (для flamegraph/speedscope). Запрос ждет окончания профилирования
+@app.get("/admin/profile")
+def profile(seconds: float = 10, interval: float = PROFILE_DEFAULT_INTERVAL, limit: int = 200,
+            authenticated: bool = Depends(verify_admin)):
+    webhook_logger.info("Profiling for %ss requested", seconds)
+    try:
+        stacks, samples = sample_stacks(seconds, interval)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return PlainTextResponse(format_collapsed(stacks, samples, limit or None))
 
 # Простой эндпоинт для проверки работоспособности сервера
 @app.get("/")